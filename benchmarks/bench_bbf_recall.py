@@ -0,0 +1,63 @@
+"""Benchmark recall and query time of best-bin-first searches with max_leaves and max_checks
+
+Usage: python benchmarks/bench_bbf_recall.py [--n-data N] [--n-query M] [--dims D [D ...]] [--k K]
+                                          [--max-leaves L [L ...]] [--max-checks C [C ...]]
+                                          [--workers W]
+
+The neighbours of each limited search are compared with those of the exact
+search. Recall is the fraction of the exact k nearest neighbours that are
+found, the p99 column is the 99th percentile of the distances computed per
+query point, which bounds the latency of single queries.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pykdtree.kdtree import KDTree
+
+
+def recall(idxs, exact_idxs):
+    """Fraction of the exact neighbours found per query point"""
+    found = (idxs[:, :, None] == exact_idxs[:, None, :]).any(axis=1)
+    return found.mean(axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-data', type=int, default=200_000)
+    parser.add_argument('--n-query', type=int, default=10_000)
+    parser.add_argument('--dims', type=int, nargs='+', default=[10, 20, 30])
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--max-leaves', type=int, nargs='+', default=[1, 8, 32, 128, 512])
+    parser.add_argument('--max-checks', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print('%4s %-18s %8s %8s %10s %8s' % ('dims', 'limit', 'recall', 'min', 'dists p99', 'time [s]'))
+    for dims in args.dims:
+        # Clustered points, like feature vectors, rather than a uniform cube
+        centers = rng.random((100, dims))
+        data_pts = centers[rng.integers(0, 100, args.n_data)] + 0.05 * rng.standard_normal((args.n_data, dims))
+        query_pts = centers[rng.integers(0, 100, args.n_query)] + 0.05 * rng.standard_normal((args.n_query, dims))
+        kdtree = KDTree(data_pts)
+
+        limits = [('exact', {})]
+        limits += [('max_leaves=%d' % n, {'max_leaves': n}) for n in args.max_leaves]
+        limits += [('max_checks=%d' % n, {'max_checks': n}) for n in args.max_checks]
+        exact_idxs = None
+        for name, kwargs in limits:
+            start = time.perf_counter()
+            _, idxs = kdtree.query(query_pts, k=args.k, workers=args.workers, **kwargs)
+            elapsed = time.perf_counter() - start
+            _, _, stats = kdtree.query(query_pts, k=args.k, workers=args.workers, return_stats=True, **kwargs)
+            if exact_idxs is None:
+                exact_idxs = idxs
+            point_recall = recall(idxs, exact_idxs)
+            print('%4d %-18s %8.4f %8.2f %10d %8.3f' % (dims, name, point_recall.mean(), point_recall.min(),
+                                                      np.percentile(stats['dist_evals'], 99), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Benchmark kd-tree queries for an increasing number of neighbours k
+
+Usage: python benchmarks/bench_query_k.py [--n-data N] [--n-query M] [--dims D]
+                                       [--reorder-data]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pykdtree.kdtree import KDTree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-data', type=int, default=1_000_000)
+    parser.add_argument('--n-query', type=int, default=20_000)
+    parser.add_argument('--dims', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--reorder-data', action='store_true',
+                        help='keep a leaf ordered copy of the data points')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data_pts = rng.random((args.n_data, args.dims))
+    query_pts = rng.random((args.n_query, args.dims))
+    kdtree = KDTree(data_pts, reorder_data=args.reorder_data)
+
+    print('%6s %12s %14s' % ('k', 'time [s]', 'us / query'))
+    k = 1
+    while k <= 1024:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            kdtree.query(query_pts, k=k)
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        print('%6d %12.4f %14.2f' % (k, best, 1e6 * best / args.n_query))
+        k *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark queries of coherent and shuffled query points with and without reorder_queries
+
+Usage: python benchmarks/bench_query_order.py [--n-data N] [--n-query M] [--k K [K ...]]
+                                           [--workers W] [--reorder-data]
+
+The same query points are searched in three orders: row by row like the
+pixels of an image (coherent), in random order (shuffled) and as small
+coherent tiles in random order (tiles), as produced by gathering many
+scattered tiles into one query.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from pykdtree.kdtree import KDTree
+
+
+def query_orders(rng, n_query):
+    """Permutations of row major grid points"""
+    side = int(np.sqrt(n_query))
+    tile = 16
+    rows, cols = np.divmod(np.arange(side * side), side)
+    tile_id = (rows // tile) * (side // tile + 1) + cols // tile
+    tile_rank = rng.permutation(tile_id.max() + 1)[tile_id]
+    return {
+        'coherent': np.arange(side * side),
+        'shuffled': rng.permutation(side * side),
+        'tiles': np.argsort(tile_rank, kind='stable'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-data', type=int, default=2_000_000)
+    parser.add_argument('--n-query', type=int, default=1_000_000)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--reorder-data', action='store_true',
+                        help='keep a leaf ordered copy of the data points')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data_pts = rng.random((args.n_data, 3))
+    kdtree = KDTree(data_pts, reorder_data=args.reorder_data)
+    # Query points on a surface through the data, like the pixels of a swath
+    side = int(np.sqrt(args.n_query))
+    u, v = np.meshgrid(np.linspace(0, 1, side), np.linspace(0, 1, side))
+    grid = np.column_stack([u.ravel(), v.ravel(), 0.5 + 0.2 * np.sin(3 * u.ravel())])
+
+    print('%-9s %4s %10s %10s %8s' % ('order', 'k', 'plain [s]', 'morton [s]', 'speedup'))
+    for name, order in query_orders(rng, args.n_query).items():
+        query_pts = grid[order]
+        for k in args.k:
+            best = {}
+            for reorder in (False, True):
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    kdtree.query(query_pts, k=k, workers=args.workers, reorder_queries=reorder)
+                    timings.append(time.perf_counter() - start)
+                best[reorder] = min(timings)
+            print('%-9s %4d %10.4f %10.4f %8.2f' % (name, k, best[False], best[True],
+                                                  best[False] / best[True]))
+
+
+if __name__ == '__main__':
+    main()
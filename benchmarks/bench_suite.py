@@ -0,0 +1,210 @@
+"""Benchmark suite for tree construction and queries on reproducible datasets
+
+Usage: python benchmarks/bench_suite.py [--n-data N] [--n-query M] [--repeat R]
+                                     [--threads T [T ...]] [--no-scipy]
+                                     [--output results.json]
+                                     [--compare baseline.json] [--tolerance F]
+
+Every dataset is generated from a fixed seed so runs on different versions or
+machines measure the same work. Results are written as JSON with one record
+per measurement. With --compare the best times are checked against an earlier
+output file and the script exits with status 1 if any case got slower than
+the tolerance allows.
+"""
+import argparse
+import datetime
+import importlib.metadata
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+import pykdtree.kdtree
+from pykdtree.kdtree import KDTree
+
+
+def uniform_dataset(rng, n):
+    """Points uniformly distributed in the unit cube"""
+    return rng.random((n, 3))
+
+
+def clustered_dataset(rng, n):
+    """Points in 50 gaussian blobs of varying spread"""
+    centers = rng.random((50, 3))
+    spread = 10 ** rng.uniform(-3, -1.5, 50)
+    labels = rng.integers(0, 50, n)
+    return centers[labels] + rng.standard_normal((n, 3)) * spread[labels, None]
+
+
+def surface_dataset(rng, n):
+    """Points on the surface of the unit sphere, like geospatial data"""
+    pts = rng.standard_normal((n, 3))
+    return pts / np.linalg.norm(pts, axis=1)[:, None]
+
+
+DATASETS = {
+    'uniform': uniform_dataset,
+    'clustered': clustered_dataset,
+    'surface': surface_dataset,
+}
+
+
+def timeit(func, repeat):
+    """Return the wall clock times of repeat calls of func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def package_version(name):
+    """Installed version of a package, None when run from a source checkout"""
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def case_key(record):
+    return tuple(record[name] for name in ('library', 'dataset', 'dtype', 'index',
+                                           'operation', 'k', 'masked', 'threads'))
+
+
+def run_pykdtree(results, name, data_pts, query_pts, mask, args):
+    for dtype in (np.float32, np.float64):
+        data = data_pts.astype(dtype)
+        query = query_pts.astype(dtype)
+        for index in ('int32', 'int64'):
+            # Force 64-bit indices on trees that would otherwise use 32-bit ones
+            limit = pykdtree.kdtree._INT32_INDEX_LIMIT
+            if index == 'int64':
+                pykdtree.kdtree._INT32_INDEX_LIMIT = 0
+            try:
+                kdtree = KDTree(data, leafsize=args.leafsize)
+                record = dict(library='pykdtree', dataset=name,
+                              dtype=np.dtype(dtype).name, index=index,
+                              operation='build', k=None, masked=False, threads=None)
+                record['times'] = timeit(lambda: KDTree(data, leafsize=args.leafsize),
+                                         args.repeat)
+                results.append(record)
+                report(record, len(data))
+            finally:
+                pykdtree.kdtree._INT32_INDEX_LIMIT = limit
+
+            for k, query_mask in ((1, None), (8, None), (8, mask)):
+                for threads in args.threads:
+                    record = dict(library='pykdtree', dataset=name,
+                                  dtype=np.dtype(dtype).name, index=index,
+                                  operation='query', k=k,
+                                  masked=query_mask is not None, threads=threads)
+                    record['times'] = timeit(
+                        lambda: kdtree.query(query, k=k, mask=query_mask,
+                                             workers=threads),
+                        args.repeat)
+                    results.append(record)
+                    report(record, len(query))
+
+
+def run_scipy(results, name, data_pts, query_pts, args):
+    from scipy.spatial import cKDTree
+
+    record = dict(library='scipy', dataset=name, dtype='float64', index=None,
+                  operation='build', k=None, masked=False, threads=None)
+    record['times'] = timeit(lambda: cKDTree(data_pts, leafsize=args.leafsize),
+                             args.repeat)
+    results.append(record)
+    report(record, len(data_pts))
+    kdtree = cKDTree(data_pts, leafsize=args.leafsize)
+    for k in (1, 8):
+        for threads in args.threads:
+            record = dict(library='scipy', dataset=name, dtype='float64', index=None,
+                          operation='query', k=k, masked=False, threads=threads)
+            record['times'] = timeit(lambda: kdtree.query(query_pts, k=k, workers=threads),
+                                     args.repeat)
+            results.append(record)
+            report(record, len(query_pts))
+
+
+def report(record, n):
+    best = min(record['times'])
+    print('%-9s %-10s %-8s %-6s %-6s %4s %-6s %8s %10.4f %10.3f' % (
+        record['library'], record['dataset'], record['dtype'], record['index'],
+        record['operation'], record['k'] or '-', record['masked'],
+        record['threads'] or '-', best, 1e6 * best / n))
+
+
+def compare(results, baseline_file, tolerance):
+    """Print the cases slower than tolerance times the baseline and count them"""
+    with open(baseline_file) as fd:
+        baseline = {case_key(record): record for record in json.load(fd)['results']}
+    regressions = 0
+    for record in results:
+        old = baseline.get(case_key(record))
+        if old is None:
+            continue
+        ratio = min(record['times']) / min(old['times'])
+        if ratio > tolerance:
+            regressions += 1
+            print('regression: %s %.2fx slower' % (case_key(record), ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-data', type=int, default=1_000_000)
+    parser.add_argument('--n-query', type=int, default=200_000)
+    parser.add_argument('--leafsize', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--datasets', nargs='+', choices=sorted(DATASETS),
+                        default=sorted(DATASETS))
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=sorted({1, os.cpu_count() or 1}),
+                        help='worker counts to measure query scaling with')
+    parser.add_argument('--no-scipy', action='store_true',
+                        help='skip the scipy.spatial.cKDTree comparison')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON output of an earlier run to check against')
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help='allowed slowdown relative to the baseline')
+    args = parser.parse_args()
+
+    results = []
+    print('%-9s %-10s %-8s %-6s %-6s %4s %-6s %8s %10s %10s' % (
+        'library', 'dataset', 'dtype', 'index', 'op', 'k', 'masked', 'threads',
+        'time [s]', 'us / point'))
+    for name in args.datasets:
+        rng = np.random.default_rng(args.seed)
+        data_pts = DATASETS[name](rng, args.n_data)
+        query_pts = DATASETS[name](rng, args.n_query)
+        mask = rng.random(args.n_data) < 0.5
+        run_pykdtree(results, name, data_pts, query_pts, mask, args)
+        if not args.no_scipy:
+            try:
+                run_scipy(results, name, data_pts, query_pts, args)
+            except ImportError:
+                pass
+
+    if args.output:
+        meta = dict(
+            pykdtree=package_version('pykdtree'), numpy=np.__version__,
+            python=platform.python_version(), platform=platform.platform(),
+            processor=platform.processor(), cpu_count=os.cpu_count(),
+            timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            args=vars(args),
+        )
+        with open(args.output, 'w') as fd:
+            json.dump(dict(meta=meta, results=results), fd, indent=1)
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Benchmark kd-tree construction, queries and teardown
+
+Usage: python benchmarks/bench_tree_lifecycle.py [--n-data N [N ...]] [--n-query M] [--dims D]
+                                              [--k K [K ...]] [--leafsize L]
+
+Teardown is the time of deleting the last reference to the tree, which
+frees the node array and the index of the data points.
+"""
+import argparse
+import gc
+import time
+
+import numpy as np
+
+from pykdtree.kdtree import KDTree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-data', type=int, nargs='+', default=[1_000_000, 5_000_000])
+    parser.add_argument('--n-query', type=int, default=1_000_000)
+    parser.add_argument('--dims', type=int, default=3)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--leafsize', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    query_pts = rng.random((args.n_query, args.dims))
+    print('%10s %-10s %12s' % ('n', 'step', 'time [ms]'))
+    for n_data in args.n_data:
+        data_pts = rng.random((n_data, args.dims))
+        timings = {'build': []}
+        timings.update({'query k=%d' % k: [] for k in args.k})
+        timings['free'] = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            kdtree = KDTree(data_pts, leafsize=args.leafsize)
+            timings['build'].append(time.perf_counter() - start)
+            for k in args.k:
+                start = time.perf_counter()
+                kdtree.query(query_pts, k=k)
+                timings['query k=%d' % k].append(time.perf_counter() - start)
+            # Collect garbage first so only the tree is freed while timing
+            gc.collect()
+            start = time.perf_counter()
+            del kdtree
+            timings['free'].append(time.perf_counter() - start)
+        for step, step_timings in timings.items():
+            print('%10d %-10s %12.2f' % (n_data, step, 1e3 * min(step_timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,44 @@ Anne M. Archibald and libANN by David M. Mount and Sunil Arya.
 #include <stdlib.h>
 #include <stdint.h>
 #include <float.h>
+#include <string.h>
+#include <math.h>
+
+<%!
+# Metrics of the specialised distance kernels: a Minkowski norm and whether
+# the coordinate differences are scaled by per dimension weights.
+# The unweighted Euclidean metric is handled by the generic kernels.
+METRICS = [(norm, weighted) for weighted in (False, True)
+           for norm in ('l1', 'l2', 'linf', 'lp') if weighted or norm != 'l2']
+
+def metric_name(norm, weighted):
+    return ('w' if weighted else '') + norm
+
+def metric_case(norm, weighted):
+    return 'NORM_%s%s' % (norm.upper(), ' | NORM_WEIGHTED' if weighted else '')
+
+def norm_term(norm, dtype, x):
+    """C expression of the contribution of a coordinate difference to a distance"""
+    if norm == 'l2':
+        return '%s * %s' % (x, x)
+    if norm == 'lp':
+        return 'POW_%s(ABS_%s(%s), p)' % (dtype, dtype, x)
+    return 'ABS_%s(%s)' % (dtype, x)
+
+def add_term(norm, dtype, dist, x):
+    """C expression of a distance with the contribution of a coordinate difference added"""
+    term = norm_term(norm, dtype, x)
+    if norm == 'linf':
+        return '(%s > %s) ? %s : %s' % (term, dist, term, dist)
+    return '%s + %s' % (dist, term)
+
+def replace_term(norm, dtype, dist, old, new):
+    """C expression of a distance with the contribution of a coordinate difference
+    replaced by the contribution of a larger difference"""
+    if norm == 'linf':
+        return add_term(norm, dtype, dist, new)
+    return '%s - %s + %s' % (dist, norm_term(norm, dtype, old), norm_term(norm, dtype, new))
+%>
 
 #define PA(i,d)			(pa[no_dims * pidx[i] + d])
 % for ITYPE in ['int32_t', 'int64_t']:
@@ -37,24 +75,150 @@ Anne M. Archibald and libANN by David M. Mount and Sunil Arya.
 #define IDX_MAX_int64_t UINT64_MAX
 #define DIST_MAX_float FLT_MAX
 #define DIST_MAX_double DBL_MAX
+#define DIST_MIN_float FLT_MIN
+#define DIST_MIN_double DBL_MIN
+#define DIST_EPSILON_float FLT_EPSILON
+#define DIST_EPSILON_double DBL_EPSILON
+#define SQRT_float sqrtf
+#define SQRT_double sqrt
+#define ABS_float fabsf
+#define ABS_double fabs
+#define POW_float powf
+#define POW_double pow
+
+/* Element types of query points, converted to the type of the tree
+   one point at a time while searching */
+<% POINT_TYPES = ['float', 'double', 'int8_t', 'int16_t', 'int32_t', 'int64_t', 'uint8_t', 'uint16_t', 'uint32_t', 'uint64_t'] %>
+% for i, PTYPE in enumerate(POINT_TYPES):
+#define POINT_TYPE_${PTYPE} ${i}
+% endfor
+
+/* Flag of a POINT_TYPE_* for query points given as longitude and latitude
+   in degrees, converted to unit vectors on the sphere while searching */
+#define POINT_LONLAT 256
+#define DEG_TO_RAD (3.14159265358979323846 / 180)
 
 #ifdef _MSC_VER
 #define restrict __restrict
 #endif
 
+#ifdef _OPENMP
+#include <omp.h>
+#define OMP_MAX_THREADS() omp_get_max_threads()
+#define OMP_THREAD_NUM() omp_get_thread_num()
+#define OMP_WTIME() omp_get_wtime()
+#else
+#include <time.h>
+#define OMP_MAX_THREADS() 1
+#define OMP_THREAD_NUM() 0
+#define OMP_WTIME() ((double)clock() / CLOCKS_PER_SEC)
+#endif
+
+/* OpenMP tasks and runtime control of the loop schedule are only
+   available from OpenMP 3.0 (MSVC implements 2.0) */
+#if defined(_OPENMP) && _OPENMP >= 200805
+#define KDTREE_OMP_TASKS
+#define KDTREE_OMP_SCHEDULE
+#endif
+
+/* Loop schedules of the queries */
+#define SCHEDULE_DEFAULT 0
+#define SCHEDULE_STATIC 1
+#define SCHEDULE_DYNAMIC 2
+#define SCHEDULE_GUIDED 3
+
+/* Threading options of the calling thread */
+typedef struct
+{
+    int num_threads;
+    int schedule;
+    int chunk_size;
+} ParallelOptions;
+
+/* Morton key of a query point and the position of the point in the query */
+typedef struct
+{
+    uint32_t key;
+    int64_t idx;
+} MortonKey;
+
+/* Bits of the radix sort digits of the Morton keys */
+#define MORTON_DIGIT_BITS 11
+
+/* Minimum number of points in a subtree before its children are built as
+   separate OpenMP tasks. Smaller subtrees are built serially by the task that
+   owns them to keep the task overhead low.
+*/
+#define PARALLEL_BUILD_MIN_N 65536
+
+/* Minimum number of points in a pair of nodes before the pair
+   is searched as a separate OpenMP task in dual tree searches */
+#define PARALLEL_PAIRS_MIN_N 16384
+
+/* Number of leaf points whose distances are calculated at once
+   when scanning the leaf ordered copy of the data points */
+#define LEAF_BLOCK_SIZE 64
+
+/* Rules for choosing the cutting plane of a split node */
+#define SPLIT_SLIDING_MIDPOINT 0
+#define SPLIT_MEDIAN 1
+#define SPLIT_COST 2
+
+/* Number of points sampled per split node by the cost based split rule */
+#define COST_SAMPLE_SIZE 64
+
+/* The k nearest neighbours found so far are kept in a sorted array
+   for small k and in a max-heap for larger k where shifting the
+   sorted array on every insertion dominates the query time */
+#ifndef KNN_HEAP_MIN_K
+#define KNN_HEAP_MIN_K 64
+#endif
+#define KNN_WORST(k) ((k) < KNN_HEAP_MIN_K ? (k) - 1 : 0)
+
+/* Minkowski norms of the distance kernels. Distances are handled as the
+   sum of the p-th powers of the coordinate differences, or their maximum
+   for the infinity norm, and only turned into distances in the results.
+   NORM_WEIGHTED is or'ed to the norm when the coordinate differences are
+   scaled by per dimension weights. */
+#define NORM_L2 0
+#define NORM_L1 1
+#define NORM_LINF 2
+#define NORM_LP 3
+#define NORM_WEIGHTED 4
+
+/* Counters of a query collected by the stats variant of the search.
+   The plain search does not touch them so queries without stats pay nothing. */
+#define STAT_NODES 0
+#define STAT_LEAVES 1
+#define STAT_DISTS 2
+#define STAT_PRUNED 3
+#define NUM_STATS 4
+
+/* Weights of the neighbours in interpolate_tree */
+#define WEIGHT_IDW 0
+#define WEIGHT_GAUSSIAN 1
+
+/* Bit of the point at leaf order position i in a bit-packed mask */
+#define LEAF_MASKED(leaf_mask, i) (((leaf_mask)[(i) >> 3] >> ((i) & 7)) & 1)
+
 % for DTYPE in ['float', 'double']:
 % for ITYPE in ['int32_t', 'int64_t']:
 
+/*
+Nodes are stored in one contiguous array in depth-first (pre-order) layout.
+The left child of a split node is the next node in the array and the right
+child is found at offset right_child from the node itself. Offsets are
+relative so a subtree can be moved as one block of memory.
+*/
 typedef struct
 {
     ${DTYPE} cut_val;
-    int8_t cut_dim;
-    u${ITYPE} start_idx;
-    u${ITYPE} n;
     ${DTYPE} cut_bounds_lv;
     ${DTYPE} cut_bounds_hv;
-    struct Node_${DTYPE}_${ITYPE} *left_child;
-    struct Node_${DTYPE}_${ITYPE} *right_child;
+    u${ITYPE} start_idx;
+    u${ITYPE} n;
+    u${ITYPE} right_child;
+    int8_t cut_dim;
 } Node_${DTYPE}_${ITYPE};
 
 typedef struct
@@ -62,9 +226,95 @@ typedef struct
     ${DTYPE} *bbox;
     int8_t no_dims;
     u${ITYPE} *pidx;
-    struct Node_${DTYPE}_${ITYPE} *root;
+    Node_${DTYPE}_${ITYPE} *nodes;
+    u${ITYPE} num_nodes;
+    int owns_arrays;
+    ${DTYPE} *leaf_data;
+    ${DTYPE} *boxsize;
+    uint8_t *leaf_mask;
+    uint8_t *node_masked;
+    ${DTYPE} sphere_radius;
 } Tree_${DTYPE}_${ITYPE};
 
+/* Growable array of nodes used during construction */
+typedef struct
+{
+    Node_${DTYPE}_${ITYPE} *nodes;
+    u${ITYPE} num_nodes;
+    u${ITYPE} capacity;
+} NodeArray_${DTYPE}_${ITYPE};
+
+/* Subtree pending in a best-bin-first search */
+typedef struct
+{
+    ${DTYPE} min_dist;
+    u${ITYPE} node;
+} QueueEntry_${DTYPE}_${ITYPE};
+
+/* Growable min-heap of pending subtrees ordered by their minimum distance */
+typedef struct
+{
+    QueueEntry_${DTYPE}_${ITYPE} *entries;
+    uint64_t size;
+    uint64_t capacity;
+} NodeQueue_${DTYPE}_${ITYPE};
+
+/* Growable arrays of neighbours found by one thread in variable size searches */
+typedef struct
+{
+    u${ITYPE} *idxs;
+    ${DTYPE} *dists;
+    uint64_t size;
+    uint64_t capacity;
+} ResultArray_${DTYPE}_${ITYPE};
+
+#ifdef KDTREE_OMP_TASKS
+/* Subtree built by an OpenMP task before it is copied into the final node array.
+   Either a split node with two task subtrees or a block of nodes built serially. */
+typedef struct TaskSubtree_${DTYPE}_${ITYPE}
+{
+    Node_${DTYPE}_${ITYPE} node;
+    struct TaskSubtree_${DTYPE}_${ITYPE} *left_child;
+    struct TaskSubtree_${DTYPE}_${ITYPE} *right_child;
+    NodeArray_${DTYPE}_${ITYPE} block;
+    u${ITYPE} num_nodes;
+} TaskSubtree_${DTYPE}_${ITYPE};
+#endif
+
+% endfor
+% endfor
+
+% for DTYPE in ['float', 'double']:
+% for ITYPE in ['int32_t', 'int64_t']:
+% for ITYPE2 in ['int32_t', 'int64_t']:
+
+/* Pairs of neighbours found by one thread in dual tree searches */
+typedef struct
+{
+    u${ITYPE} *idxs1;
+    u${ITYPE2} *idxs2;
+    ${DTYPE} *dists;
+    uint64_t size;
+    uint64_t capacity;
+} PairArray_${DTYPE}_${ITYPE}_${ITYPE2};
+
+/* Common arguments of a dual tree search */
+typedef struct
+{
+    ${DTYPE} *pa1;
+    u${ITYPE} *pidx1;
+    ${DTYPE} *pa2;
+    u${ITYPE2} *pidx2;
+    int8_t no_dims;
+    ${DTYPE} radius;
+    int self_join;
+    int count_only;
+    ${DTYPE} *boxsize;
+    PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *thread_pairs;
+    uint64_t *thread_counts;
+} PairSearch_${DTYPE}_${ITYPE}_${ITYPE2};
+
+% endfor
 % endfor
 % endfor
 
@@ -73,31 +323,267 @@ typedef struct
 ${DTYPE} calc_dist_${DTYPE}(${DTYPE} *point1_coord, ${DTYPE} *point2_coord, int8_t no_dims);
 ${DTYPE} get_cube_offset_${DTYPE}(int8_t dim, ${DTYPE} *point_coord, ${DTYPE} *bbox);
 ${DTYPE} get_min_dist_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *bbox);
+${DTYPE} calc_dist_periodic_${DTYPE}(${DTYPE} *point1_coord, ${DTYPE} *point2_coord, int8_t no_dims, ${DTYPE} *boxsize);
+${DTYPE} get_interval_dist_periodic_${DTYPE}(${DTYPE} coord, ${DTYPE} lv, ${DTYPE} hv, ${DTYPE} boxsize);
+${DTYPE} get_min_dist_periodic_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *bbox, ${DTYPE} *boxsize);
+${DTYPE} get_eps_fac_${DTYPE}(${DTYPE} eps, int norm, ${DTYPE} p);
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
+${DTYPE} calc_dist_${M}_${DTYPE}(${DTYPE} *point1_coord, ${DTYPE} *point2_coord, int8_t no_dims, ${DTYPE} p, ${DTYPE} *weights);
+${DTYPE} get_min_dist_${M}_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *bbox, ${DTYPE} p, ${DTYPE} *weights);
+% endfor
+${DTYPE} *wrap_point_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *boxsize, ${DTYPE} *buf);
+${DTYPE} *load_point_${DTYPE}(const char *point, int point_type, int64_t dim_stride, int8_t no_dims, ${DTYPE} *buf);
+void load_points_${DTYPE}(const char *points, int point_type, int64_t point_stride, int64_t dim_stride,
+                int8_t no_dims, uint64_t n, ${DTYPE} *out);
+${DTYPE} chord_to_arc_${DTYPE}(${DTYPE} sqr_chord, ${DTYPE} sphere_radius);
+int64_t *morton_order_${DTYPE}(${DTYPE} *bbox, int8_t no_dims, const char *point_coords, int point_type,
+                     int64_t point_stride, int64_t dim_stride, int64_t num_points);
+void calc_block_dists_${DTYPE}(${DTYPE} *restrict coords, uint64_t dim_stride, int m, int8_t no_dims,
+                     ${DTYPE} *restrict point_coord, ${DTYPE} *restrict dists);
 
 % for ITYPE in ['int32_t', 'int64_t']:
 
 void insert_point_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} pidx, ${DTYPE} cur_dist, u${ITYPE} k);
+void sift_down_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} root, u${ITYPE} k);
+void sort_points_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} k);
+void finish_points_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound,
+                    int mark_out_of_bounds, u${ITYPE} out_of_bounds_idx, int sqr_dists);
 void get_bounding_box_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} n, ${DTYPE} *bbox);
-int partition_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *bbox, int8_t *cut_dim,
+void select_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, int8_t dim, u${ITYPE} start_idx, u${ITYPE} end_idx, u${ITYPE} nth);
+void select_sift_down_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, int8_t dim, int64_t base, int64_t root, int64_t m);
+int choose_split_cost_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, int8_t *cut_dim, ${DTYPE} *cut_val);
+int partition_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *bbox, int split_rule, int8_t *cut_dim,
               ${DTYPE} *cut_val, u${ITYPE} *n_lo);
-Tree_${DTYPE}_${ITYPE}* construct_tree_${DTYPE}_${ITYPE}(${DTYPE} *pa, int8_t no_dims, u${ITYPE} n, u${ITYPE} bsp);
-Node_${DTYPE}_${ITYPE}* construct_subtree_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, u${ITYPE} bsp, ${DTYPE} *bbox);
-Node_${DTYPE}_${ITYPE} * create_node_${DTYPE}_${ITYPE}(u${ITYPE} start_idx, u${ITYPE} n, int is_leaf);
-void delete_subtree_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root);
+Tree_${DTYPE}_${ITYPE}* construct_tree_${DTYPE}_${ITYPE}(${DTYPE} *pa, int8_t no_dims, u${ITYPE} n, u${ITYPE} bsp, int split_rule);
+void construct_subtree_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, u${ITYPE} bsp, int split_rule, ${DTYPE} *bbox,
+                                NodeArray_${DTYPE}_${ITYPE} *node_array);
+#ifdef KDTREE_OMP_TASKS
+TaskSubtree_${DTYPE}_${ITYPE}* construct_subtree_task_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, u${ITYPE} bsp, int split_rule, ${DTYPE} *bbox);
+void flatten_subtree_task_${DTYPE}_${ITYPE}(TaskSubtree_${DTYPE}_${ITYPE} *subtree, Node_${DTYPE}_${ITYPE} *nodes);
+#endif
+void init_node_array_${DTYPE}_${ITYPE}(NodeArray_${DTYPE}_${ITYPE} *node_array, u${ITYPE} n, u${ITYPE} bsp);
+u${ITYPE} create_node_${DTYPE}_${ITYPE}(NodeArray_${DTYPE}_${ITYPE} *node_array, u${ITYPE} start_idx, u${ITYPE} n);
+Tree_${DTYPE}_${ITYPE}* create_tree_view_${DTYPE}_${ITYPE}(int8_t no_dims, ${DTYPE} *bbox, u${ITYPE} *pidx, Node_${DTYPE}_${ITYPE} *nodes, u${ITYPE} num_nodes);
+void build_leaf_data_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa);
+void build_mask_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, uint8_t *mask);
 void delete_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree);
 void print_tree_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, int level);
+uint64_t get_leaf_stats_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, uint32_t *leaf_depths, uint64_t *leaf_sizes);
+void collect_leaf_stats_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, uint32_t depth, uint32_t *leaf_depths, uint64_t *leaf_sizes, uint64_t *num_leaves);
 void search_leaf_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
                  u${ITYPE} k, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist);
 void search_leaf_${DTYPE}_${ITYPE}_mask(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
                  u${ITYPE} k, uint8_t *restrict mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist);
-void search_splitnode_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
-                      ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, u${ITYPE} *  closest_idx, ${DTYPE} *closest_dist);
-void search_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, ${DTYPE} *point_coords,
-                 u${ITYPE} num_points, u${ITYPE} k,  ${DTYPE} distance_upper_bound,
-                 ${DTYPE} eps, uint8_t *mask, u${ITYPE} *closest_idxs, ${DTYPE} *closest_dists);
+void search_leaf_${DTYPE}_${ITYPE}_leaf_mask(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                 u${ITYPE} k, uint8_t *restrict leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist);
+void search_leaf_block_${DTYPE}_${ITYPE}(${DTYPE} *restrict leaf_data, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                       u${ITYPE} k, uint8_t *mask, uint8_t *leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist);
+void search_splitnode_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord,
+                      ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, uint8_t *node_masked,
+                      u${ITYPE} *closest_idx, ${DTYPE} *closest_dist);
+void search_splitnode_stats_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord,
+                      ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, uint8_t *node_masked,
+                      u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, uint64_t *stats);
+void push_node_queue_${DTYPE}_${ITYPE}(NodeQueue_${DTYPE}_${ITYPE} *queue, u${ITYPE} node, ${DTYPE} min_dist);
+void pop_node_queue_${DTYPE}_${ITYPE}(NodeQueue_${DTYPE}_${ITYPE} *queue);
+void search_bbf_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord,
+                ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, uint8_t *node_masked,
+                uint64_t max_leaves, uint64_t max_checks, NodeQueue_${DTYPE}_${ITYPE} *queue,
+                u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, uint64_t *stats);
+void search_leaf_periodic_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                          ${DTYPE} *boxsize, u${ITYPE} k, uint8_t *mask, uint8_t *leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist);
+void search_splitnode_periodic_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                               ${DTYPE} *boxsize, ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask,
+                               u${ITYPE} *closest_idx, ${DTYPE} *closest_dist);
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
+void search_leaf_${M}_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                    ${DTYPE} p, ${DTYPE} *weights, u${ITYPE} k, uint8_t *mask, uint8_t *leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist);
+void search_splitnode_${M}_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                         ${DTYPE} p, ${DTYPE} *weights, ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask,
+                         u${ITYPE} *closest_idx, ${DTYPE} *closest_dist);
+% endfor
+void search_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, const char *point_coords,
+                 int point_type, int64_t point_stride, int64_t dim_stride,
+                 u${ITYPE} num_points, u${ITYPE} k, int64_t *offsets,
+                 ${DTYPE} distance_upper_bound, ${DTYPE} *distance_upper_bounds,
+                 ${DTYPE} eps, int norm, ${DTYPE} p, ${DTYPE} *weights, uint8_t *mask, void *closest_idxs, int idx_size, uint64_t idxs_stride,
+                 ${DTYPE} *closest_dists, uint64_t dists_stride,
+                 int mark_out_of_bounds, u${ITYPE} out_of_bounds_idx, int sqr_dists,
+                 uint64_t *stats, double *thread_times, int reorder_queries,
+                 uint64_t max_leaves, uint64_t max_checks);
+void search_knn_graph_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, u${ITYPE} k, int include_self,
+                      int sqr_dists, void *idxs, int idx_size, ${DTYPE} *dists);
+void interpolate_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, const char *point_coords,
+                      int point_type, int64_t point_stride, int64_t dim_stride,
+                      u${ITYPE} num_points, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps, uint8_t *mask,
+                      ${DTYPE} *values, int64_t num_channels, int weighting, double weight_param, ${DTYPE} fill_value,
+                      ${DTYPE} *out, int reorder_queries);
+void append_result_${DTYPE}_${ITYPE}(ResultArray_${DTYPE}_${ITYPE} *results, u${ITYPE} idx, ${DTYPE} dist);
+void search_leaf_ball_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, ${DTYPE} *restrict leaf_data, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                      ${DTYPE} radius, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results);
+void search_splitnode_ball_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord,
+                           ${DTYPE} min_dist, ${DTYPE} radius, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, uint8_t *node_masked,
+                           ResultArray_${DTYPE}_${ITYPE} *results);
+void search_leaf_ball_periodic_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                               ${DTYPE} *boxsize, ${DTYPE} radius, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results);
+void search_splitnode_ball_periodic_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                                    ${DTYPE} *boxsize, ${DTYPE} min_dist, ${DTYPE} radius, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results);
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
+void search_leaf_ball_${M}_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                         ${DTYPE} p, ${DTYPE} *weights, ${DTYPE} radius, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results);
+void search_splitnode_ball_${M}_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                              ${DTYPE} p, ${DTYPE} *weights, ${DTYPE} min_dist, ${DTYPE} radius, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask,
+                              ResultArray_${DTYPE}_${ITYPE} *results);
+% endfor
+void search_tree_ball_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, const char *point_coords,
+                      int point_type, int64_t point_stride, int64_t dim_stride,
+                      u${ITYPE} num_points, ${DTYPE} radius, ${DTYPE} *radii, ${DTYPE} eps, int norm, ${DTYPE} p, ${DTYPE} *weights, uint8_t *mask,
+                      int64_t *offsets, u${ITYPE} **idxs, ${DTYPE} **dists, int reorder_queries);
+
+% endfor
+% endfor
+
+% for DTYPE in ['float', 'double']:
+% for ITYPE in ['int32_t', 'int64_t']:
+% for ITYPE2 in ['int32_t', 'int64_t']:
+
+void append_pair_${DTYPE}_${ITYPE}_${ITYPE2}(PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *pairs, u${ITYPE} idx1, u${ITYPE2} idx2, ${DTYPE} dist);
+void search_leaf_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} *search, Node_${DTYPE}_${ITYPE} *node1, Node_${DTYPE}_${ITYPE2} *node2);
+void search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} *search, Node_${DTYPE}_${ITYPE} *node1, ${DTYPE} *bbox1,
+                           Node_${DTYPE}_${ITYPE2} *node2, ${DTYPE} *bbox2);
+void search_splitnode_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} *search, Node_${DTYPE}_${ITYPE} *node1, ${DTYPE} *bbox1,
+                               Node_${DTYPE}_${ITYPE2} *node2, ${DTYPE} *bbox2);
+void search_tree_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(Tree_${DTYPE}_${ITYPE} *tree1, ${DTYPE} *pa1, Tree_${DTYPE}_${ITYPE2} *tree2, ${DTYPE} *pa2,
+                          ${DTYPE} radius, int self_join, uint64_t *count,
+                          u${ITYPE} **idxs1, u${ITYPE2} **idxs2, ${DTYPE} **dists);
 
 % endfor
 % endfor
+% endfor
+
+void set_parallel_options(int num_threads, int schedule, int chunk_size, ParallelOptions *saved);
+void restore_parallel_options(ParallelOptions *saved);
+int get_max_threads(void);
+void sort_morton_keys(MortonKey *keys, int64_t n, int key_bits);
+
+/************************************************
+Set the number of threads and the loop schedule of the
+parallel regions started by the calling thread.
+OpenMP keeps these settings per thread so they only apply
+to the calls made by this thread until they are restored.
+Params:
+    num_threads : number of threads, 0 keeps the current setting and
+                  a negative number uses all processors
+    schedule : SCHEDULE_* constant of the query loops
+    chunk_size : chunk size of the query loops
+    saved : previous options of the calling thread (return)
+************************************************/
+void set_parallel_options(int num_threads, int schedule, int chunk_size, ParallelOptions *saved)
+{
+#ifdef _OPENMP
+    saved->num_threads = omp_get_max_threads();
+    if (num_threads < 0)
+    {
+        num_threads = omp_get_num_procs();
+    }
+    if (num_threads > 0)
+    {
+        omp_set_num_threads(num_threads);
+    }
+#endif
+#ifdef KDTREE_OMP_SCHEDULE
+    {
+        omp_sched_t kind;
+        omp_get_schedule(&kind, &saved->chunk_size);
+        saved->schedule = (int)kind;
+        switch (schedule)
+        {
+        case SCHEDULE_STATIC:
+            omp_set_schedule(omp_sched_static, chunk_size);
+            break;
+        case SCHEDULE_DYNAMIC:
+            omp_set_schedule(omp_sched_dynamic, chunk_size);
+            break;
+        case SCHEDULE_GUIDED:
+            omp_set_schedule(omp_sched_guided, chunk_size);
+            break;
+        }
+    }
+#endif
+}
+
+/************************************************
+Restore the threading options of the calling thread
+Params:
+    saved : options returned by set_parallel_options
+************************************************/
+void restore_parallel_options(ParallelOptions *saved)
+{
+#ifdef _OPENMP
+    omp_set_num_threads(saved->num_threads);
+#endif
+#ifdef KDTREE_OMP_SCHEDULE
+    omp_set_schedule((omp_sched_t)saved->schedule, saved->chunk_size);
+#endif
+}
+
+/************************************************
+Maximum number of threads of the next parallel region,
+the size of the thread_times array of search_tree
+************************************************/
+int get_max_threads(void)
+{
+    return OMP_MAX_THREADS();
+}
+
+/************************************************
+Sort Morton keys with a least significant digit radix sort.
+The sort is stable so points with equal keys keep the query order.
+Params:
+    keys : keys to sort (return)
+    n : number of keys
+    key_bits : number of low bits used by the keys
+************************************************/
+void sort_morton_keys(MortonKey *keys, int64_t n, int key_bits)
+{
+    MortonKey *buf = (MortonKey *)malloc(sizeof(MortonKey) * (n + 1));
+    MortonKey *src = keys, *dst = buf, *tmp;
+    const uint32_t digit_mask = (1 << MORTON_DIGIT_BITS) - 1;
+    int64_t count[1 << MORTON_DIGIT_BITS];
+    int64_t i, pos;
+    int shift, digit;
+
+    for (shift = 0; shift < key_bits; shift += MORTON_DIGIT_BITS)
+    {
+        memset(count, 0, sizeof(count));
+        for (i = 0; i < n; i++)
+        {
+            count[(src[i].key >> shift) & digit_mask]++;
+        }
+        pos = 0;
+        for (digit = 0; digit <= (int)digit_mask; digit++)
+        {
+            int64_t digit_count = count[digit];
+            count[digit] = pos;
+            pos += digit_count;
+        }
+        for (i = 0; i < n; i++)
+        {
+            dst[count[(src[i].key >> shift) & digit_mask]++] = src[i];
+        }
+        tmp = src;
+        src = dst;
+        dst = tmp;
+    }
+    if (src != keys)
+    {
+        memcpy(keys, src, sizeof(MortonKey) * n);
+    }
+    free(buf);
+}
 
 % for DTYPE in ['float', 'double']:
 
@@ -169,368 +655,2878 @@ ${DTYPE} get_min_dist_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *
     return cube_offset;
 }
 
-% for ITYPE in ['int32_t', 'int64_t']:
-
 /************************************************
-Insert point into priority queue
+Calculate squared distance between points in a periodic box.
+The coordinates must be inside the box.
 Params:
-    closest_idx : index queue
-    closest_dist : distance queue
-    pidx : permutation index of data points
-    cur_dist : distance to point inserted
-    k : number of neighbours
+    point1_coord : point 1
+    point2_coord : point 2
+    no_dims : number of dimensions
+    boxsize : side lengths of the box
 ************************************************/
-void insert_point_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} pidx, ${DTYPE} cur_dist, u${ITYPE} k)
+${DTYPE} calc_dist_periodic_${DTYPE}(${DTYPE} *point1_coord, ${DTYPE} *point2_coord, int8_t no_dims, ${DTYPE} *boxsize)
 {
-    int i;
-    for (i = k - 1; i > 0; i--)
+    ${DTYPE} dist = 0, dim_dist;
+    int8_t i;
+    for (i = 0; i < no_dims; i++)
     {
-        if (closest_dist[i - 1] > cur_dist)
+        dim_dist = point2_coord[i] - point1_coord[i];
+        if (dim_dist < 0)
         {
-            closest_dist[i] = closest_dist[i - 1];
-            closest_idx[i] = closest_idx[i - 1];
+            dim_dist = -dim_dist;
         }
-        else
+        /* Use the shorter way around the box */
+        if (2 * dim_dist > boxsize[i])
         {
-            break;
+            dim_dist = boxsize[i] - dim_dist;
         }
+        dist += dim_dist * dim_dist;
     }
-    closest_idx[i] = pidx;
-    closest_dist[i] = cur_dist;
+    return dist;
 }
 
 /************************************************
-Get the bounding box of a set of points
+Get distance from a coordinate to an interval in a periodic dimension.
+The coordinate and the interval must be inside the box.
 Params:
-    pa : data points
-    pidx : permutation index of data points
-    no_dims: number of dimensions
-    n : number of points
-    bbox : bounding box (return)
+    coord : coordinate
+    lv : lower end of interval
+    hv : upper end of interval
+    boxsize : side length of the box
 ************************************************/
-void get_bounding_box_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} n, ${DTYPE} *bbox)
+${DTYPE} get_interval_dist_periodic_${DTYPE}(${DTYPE} coord, ${DTYPE} lv, ${DTYPE} hv, ${DTYPE} boxsize)
 {
-    ${DTYPE} cur;
-    int8_t i, j;
-    u${ITYPE} bbox_idx, i2;
-
-    /* Use first data point to initialize */
-    for (i = 0; i < no_dims; i++)
+    ${DTYPE} dist, wrapped;
+    if (coord < lv)
     {
-        bbox[2 * i] = bbox[2 * i + 1] = PA(0, i);
+        /* Left of interval, or right of it across the box boundary */
+        dist = lv - coord;
+        wrapped = coord + boxsize - hv;
     }
-
-    /* Update using rest of data points */
-    for (i2 = 1; i2 < n; i2++)
+    else if (coord > hv)
     {
-        for (j = 0; j < no_dims; j++)
-        {
-            bbox_idx = 2 * j;
-            cur = PA(i2, j);
-            if (cur < bbox[bbox_idx])
-            {
-                bbox[bbox_idx] = cur;
-            }
-            else if (cur > bbox[bbox_idx + 1])
-            {
-                bbox[bbox_idx + 1] = cur;
-            }
-        }
+        /* Right of interval, or left of it across the box boundary */
+        dist = coord - hv;
+        wrapped = lv + boxsize - coord;
+    }
+    else
+    {
+        return 0.;
     }
+    return (wrapped < dist) ? wrapped : dist;
 }
 
 /************************************************
-Partition a range of data points by manipulation the permutation index.
-The sliding midpoint rule is used for the partitioning.
+Get minimum squared distance between point and cube in a periodic box.
 Params:
-    pa : data points
-    pidx : permutation index of data points
-    no_dims: number of dimensions
-    start_idx : index of first data point to use
-    n :  number of data points
-    bbox : bounding box of data points
-    cut_dim : dimension used for partition (return)
-    cut_val : value of cutting point (return)
-    n_lo : number of point below cutting plane (return)
+    point_coord : cartesian coordinates of point
+    no_dims : number of dimensions
+    bbox : cube
+    boxsize : side lengths of the box
 ************************************************/
-int partition_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *bbox, int8_t *cut_dim, ${DTYPE} *cut_val, u${ITYPE} *n_lo)
+${DTYPE} get_min_dist_periodic_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *bbox, ${DTYPE} *boxsize)
 {
-    int8_t dim = 0, i;
-    u${ITYPE} p, q, i2;
-    ${DTYPE} size = 0, min_val, max_val, split, side_len, cur_val;
-    u${ITYPE} end_idx = start_idx + n - 1;
+    ${DTYPE} cube_offset = 0, cube_offset_dim;
+    int8_t i;
 
-    /* Find largest bounding box side */
     for (i = 0; i < no_dims; i++)
     {
-        side_len = bbox[2 * i + 1] - bbox[2 * i];
-        if (side_len > size)
-        {
-            dim = i;
-            size = side_len;
-        }
+        cube_offset_dim = get_interval_dist_periodic_${DTYPE}(point_coord[i], bbox[2 * i], bbox[2 * i + 1], boxsize[i]);
+        cube_offset += cube_offset_dim * cube_offset_dim;
     }
 
-    min_val = bbox[2 * dim];
-    max_val = bbox[2 * dim + 1];
+    return cube_offset;
+}
 
-    /* Check for zero length or inconsistent */
-    if (min_val >= max_val)
-        return 1;
+/************************************************
+Get the factor of the distance to the k-th neighbour
+below which subtrees are searched in an approximate search
+Params:
+    eps : approximation factor
+    norm : NORM_* of the distances
+    p : order of the norm for NORM_LP
+************************************************/
+${DTYPE} get_eps_fac_${DTYPE}(${DTYPE} eps, int norm, ${DTYPE} p)
+{
+    switch (norm & ~NORM_WEIGHTED)
+    {
+    case NORM_L1:
+    case NORM_LINF:
+        return 1 / (1 + eps);
+    case NORM_LP:
+        return 1 / POW_${DTYPE}(1 + eps, p);
+    default:
+        return 1 / ((1 + eps) * (1 + eps));
+    }
+}
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>
+/************************************************
+Calculate ${NORM.upper()} distance between points${' with weighted dimensions' if WEIGHTED else ''},
+as the sum of the p-th powers of the coordinate differences
+or their maximum for the infinity norm
+Params:
+    point1_coord : point 1
+    point2_coord : point 2
+    no_dims : number of dimensions
+    p : order of the norm
+    weights : factors of the coordinate differences
+************************************************/
+${DTYPE} calc_dist_${M}_${DTYPE}(${DTYPE} *point1_coord, ${DTYPE} *point2_coord, int8_t no_dims, ${DTYPE} p, ${DTYPE} *weights)
+{
+    ${DTYPE} dist = 0, dim_dist;
+    int8_t i;
+    for (i = 0; i < no_dims; i++)
+    {
+% if WEIGHTED:
+        dim_dist = weights[i] * (point2_coord[i] - point1_coord[i]);
+% else:
+        dim_dist = point2_coord[i] - point1_coord[i];
+% endif
+        dist = ${add_term(NORM, DTYPE, 'dist', 'dim_dist')};
+    }
+    return dist;
+}
 
-    /* Use middle for splitting */
-    split = (min_val + max_val) / 2;
+/************************************************
+Get minimum ${NORM.upper()} distance between point and cube${' with weighted dimensions' if WEIGHTED else ''},
+in the form returned by calc_dist_${M}_${DTYPE}
+Params:
+    point_coord : cartesian coordinates of point
+    no_dims : number of dimensions
+    bbox : cube
+    p : order of the norm
+    weights : factors of the coordinate differences
+************************************************/
+${DTYPE} get_min_dist_${M}_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *bbox, ${DTYPE} p, ${DTYPE} *weights)
+{
+    ${DTYPE} cube_offset = 0, cube_offset_dim;
+    int8_t i;
 
-    /* Partition all data points around middle */
-    p = start_idx;
-    q = end_idx;
-    while (p <= q)
+    for (i = 0; i < no_dims; i++)
     {
-        if (PA(p, dim) < split)
-        {
+% if WEIGHTED:
+        cube_offset_dim = weights[i] * get_cube_offset_${DTYPE}(i, point_coord, bbox);
+% else:
+        cube_offset_dim = get_cube_offset_${DTYPE}(i, point_coord, bbox);
+% endif
+        cube_offset = ${add_term(NORM, DTYPE, 'cube_offset', 'cube_offset_dim')};
+    }
+
+    return cube_offset;
+}
+% endfor
+
+/************************************************
+Wrap a point into a periodic box [0, boxsize)
+Params:
+    point_coord : cartesian coordinates of point
+    no_dims : number of dimensions
+    boxsize : side lengths of the box
+    buf : buffer of no_dims elements receiving the wrapped point, may be point_coord
+************************************************/
+${DTYPE} *wrap_point_${DTYPE}(${DTYPE} *point_coord, int8_t no_dims, ${DTYPE} *boxsize, ${DTYPE} *buf)
+{
+    int8_t i;
+    ${DTYPE} coord;
+    for (i = 0; i < no_dims; i++)
+    {
+        coord = point_coord[i];
+        if (coord < 0 || coord >= boxsize[i])
+        {
+            coord -= boxsize[i] * floor(coord / boxsize[i]);
+            /* Rounding may give the upper bound for coordinates just below zero */
+            if (coord >= boxsize[i])
+            {
+                coord = 0;
+            }
+        }
+        buf[i] = coord;
+    }
+    return buf;
+}
+
+/************************************************
+Get the coordinates of a query point in the type of the tree.
+Points already of that type and contiguous are used in place,
+other points are converted into a buffer.
+Params:
+    point : first coordinate of query point
+    point_type : POINT_TYPE_* of the coordinates, or'ed with POINT_LONLAT
+                 for longitude and latitude converted to a unit vector
+    dim_stride : distance in bytes between coordinates
+    no_dims : number of dimensions, 3 for POINT_LONLAT
+    buf : buffer of no_dims elements
+************************************************/
+${DTYPE} *load_point_${DTYPE}(const char *point, int point_type, int64_t dim_stride, int8_t no_dims, ${DTYPE} *buf)
+{
+    int8_t i;
+    if (point_type & POINT_LONLAT)
+    {
+        double lonlat_buf[2] = {0, 0};
+        double *lonlat = load_point_double(point, point_type & ~POINT_LONLAT, dim_stride, 2, lonlat_buf);
+        double lon = lonlat[0] * DEG_TO_RAD;
+        double lat = lonlat[1] * DEG_TO_RAD;
+        buf[0] = (${DTYPE})(cos(lat) * cos(lon));
+        buf[1] = (${DTYPE})(cos(lat) * sin(lon));
+        buf[2] = (${DTYPE})sin(lat);
+        return buf;
+    }
+    if (point_type == POINT_TYPE_${DTYPE} && dim_stride == (int64_t)sizeof(${DTYPE}))
+    {
+        return (${DTYPE} *)point;
+    }
+    switch (point_type)
+    {
+% for PTYPE in POINT_TYPES:
+    case POINT_TYPE_${PTYPE}:
+        for (i = 0; i < no_dims; i++)
+        {
+            buf[i] = (${DTYPE})*(const ${PTYPE} *)(point + i * dim_stride);
+        }
+        break;
+% endfor
+    }
+    return buf;
+}
+
+/************************************************
+Convert points to contiguous points of the type of the tree
+Params:
+    points, point_type, point_stride, dim_stride : points, see search_tree
+    no_dims : number of dimensions of the converted points
+    n : number of points
+    out : converted points, n * no_dims elements (return)
+************************************************/
+void load_points_${DTYPE}(const char *points, int point_type, int64_t point_stride, int64_t dim_stride,
+                int8_t no_dims, uint64_t n, ${DTYPE} *out)
+{
+    int64_t i;
+    int64_t local_n = (int64_t)n;
+
+    #pragma omp parallel for schedule(static) if (local_n >= PARALLEL_BUILD_MIN_N)
+    for (i = 0; i < local_n; i++)
+    {
+        ${DTYPE} point_buf[127];
+        ${DTYPE} *point_coord = load_point_${DTYPE}(points + i * point_stride, point_type, dim_stride, no_dims, point_buf);
+        memcpy(out + i * no_dims, point_coord, sizeof(${DTYPE}) * no_dims);
+    }
+}
+
+/************************************************
+Great-circle distance of a chord between two points on the unit sphere
+Params:
+    sqr_chord : squared length of the chord
+    sphere_radius : radius of the sphere the distance is measured on
+************************************************/
+${DTYPE} chord_to_arc_${DTYPE}(${DTYPE} sqr_chord, ${DTYPE} sphere_radius)
+{
+    double half_chord = sqrt((double)sqr_chord) / 2;
+    return (${DTYPE})(2 * asin(half_chord < 1 ? half_chord : 1) * sphere_radius);
+}
+
+/************************************************
+Order query points along a Morton (Z-order) curve through the
+bounding box of the tree. Consecutive query points of the order are
+close to each other, so a thread searching them in this order keeps
+revisiting the same nodes and leaves while they are in cache.
+Each coordinate is quantised to 32 / no_dims bits and the bits are
+interleaved into a 32-bit key; only the first 32 dimensions are used.
+This is fine enough to keep the points of a leaf together and keeps
+the radix sort of the keys short.
+Params:
+    bbox : bounding box of the tree
+    no_dims : number of dimensions
+    point_coords, point_type, point_stride, dim_stride : query points, see search_tree
+    num_points : number of query points
+Returns:
+    malloc'ed array of the positions of the query points in curve order
+************************************************/
+int64_t *morton_order_${DTYPE}(${DTYPE} *bbox, int8_t no_dims, const char *point_coords, int point_type,
+                     int64_t point_stride, int64_t dim_stride, int64_t num_points)
+{
+    int key_dims = no_dims < 32 ? no_dims : 32;
+    int bits = 32 / key_dims;
+    double max_cell = (double)(((uint64_t)1 << bits) - 1);
+    double scale[32];
+    MortonKey *keys = (MortonKey *)malloc(sizeof(MortonKey) * (num_points + 1));
+    int64_t *order = (int64_t *)malloc(sizeof(int64_t) * (num_points + 1));
+    int64_t i;
+    int d;
+
+    for (d = 0; d < key_dims; d++)
+    {
+        double extent = (double)bbox[2 * d + 1] - (double)bbox[2 * d];
+        scale[d] = extent > 0 ? max_cell / extent : 0;
+    }
+
+    #pragma omp parallel for schedule(static)
+    for (i = 0; i < num_points; i++)
+    {
+        ${DTYPE} point_buf[127];
+        ${DTYPE} *point_coord = load_point_${DTYPE}(point_coords + i * point_stride, point_type, dim_stride, no_dims, point_buf);
+        uint32_t cells[32];
+        uint32_t key = 0;
+        double cell;
+        int b, j;
+        for (j = 0; j < key_dims; j++)
+        {
+            cell = ((double)point_coord[j] - (double)bbox[2 * j]) * scale[j];
+            /* Points outside the tree and NaN coordinates go to the nearest cell */
+            if (!(cell > 0))
+            {
+                cell = 0;
+            }
+            else if (cell > max_cell)
+            {
+                cell = max_cell;
+            }
+            cells[j] = (uint32_t)cell;
+        }
+        for (b = bits - 1; b >= 0; b--)
+        {
+            for (j = 0; j < key_dims; j++)
+            {
+                key = (key << 1) | ((cells[j] >> b) & 1);
+            }
+        }
+        keys[i].key = key;
+        keys[i].idx = i;
+    }
+
+    sort_morton_keys(keys, num_points, bits * key_dims);
+    for (i = 0; i < num_points; i++)
+    {
+        order[i] = keys[i].idx;
+    }
+    free(keys);
+    return order;
+}
+
+/************************************************
+Calculate squared distances between a query point and a block of
+points stored dimension by dimension. The loops over the points have
+no dependencies and a fixed number of dimensions for 2, 3 and 4
+dimensions so the compiler can vectorise them.
+Params:
+    coords : first coordinate of block of points
+    dim_stride : distance in elements between the dimensions of a point
+    m : number of points in block
+    no_dims : number of dimensions
+    point_coord : query point
+    dists : squared distances (return)
+************************************************/
+void calc_block_dists_${DTYPE}(${DTYPE} *restrict coords, uint64_t dim_stride, int m, int8_t no_dims,
+                     ${DTYPE} *restrict point_coord, ${DTYPE} *restrict dists)
+{
+    int i;
+    int8_t d;
+    ${DTYPE} dim_dist;
+    switch (no_dims)
+    {
+% for NDIMS in [2, 3, 4]:
+    case ${NDIMS}:
+        for (i = 0; i < m; i++)
+        {
+            ${DTYPE} dist = 0;
+% for d in range(NDIMS):
+            dim_dist = point_coord[${d}] - coords[${d} * dim_stride + i];
+            dist += dim_dist * dim_dist;
+% endfor
+            dists[i] = dist;
+        }
+        break;
+% endfor
+    default:
+        for (i = 0; i < m; i++)
+        {
+            dists[i] = 0;
+        }
+        for (d = 0; d < no_dims; d++)
+        {
+            for (i = 0; i < m; i++)
+            {
+                dim_dist = point_coord[d] - coords[d * dim_stride + i];
+                dists[i] += dim_dist * dim_dist;
+            }
+        }
+    }
+}
+
+% for ITYPE in ['int32_t', 'int64_t']:
+
+/************************************************
+Insert point into priority queue replacing the
+current worst point. The queue is a sorted array if
+k < KNN_HEAP_MIN_K and a max-heap otherwise.
+Params:
+    closest_idx : index queue
+    closest_dist : distance queue
+    pidx : permutation index of data points
+    cur_dist : distance to point inserted
+    k : number of neighbours
+************************************************/
+void insert_point_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} pidx, ${DTYPE} cur_dist, u${ITYPE} k)
+{
+    int i;
+    if (k >= KNN_HEAP_MIN_K)
+    {
+        closest_idx[0] = pidx;
+        closest_dist[0] = cur_dist;
+        sift_down_${DTYPE}_${ITYPE}(closest_idx, closest_dist, 0, k);
+        return;
+    }
+    for (i = k - 1; i > 0; i--)
+    {
+        if (closest_dist[i - 1] > cur_dist)
+        {
+            closest_dist[i] = closest_dist[i - 1];
+            closest_idx[i] = closest_idx[i - 1];
+        }
+        else
+        {
+            break;
+        }
+    }
+    closest_idx[i] = pidx;
+    closest_dist[i] = cur_dist;
+}
+
+/************************************************
+Restore the max-heap property of a priority queue
+below a node
+Params:
+    closest_idx : index queue
+    closest_dist : distance queue
+    root : node to move down
+    k : number of elements in queue
+************************************************/
+void sift_down_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} root, u${ITYPE} k)
+{
+    u${ITYPE} child;
+    u${ITYPE} idx = closest_idx[root];
+    ${DTYPE} dist = closest_dist[root];
+    while ((child = 2 * root + 1) < k)
+    {
+        /* Pick the larger child */
+        if (child + 1 < k && closest_dist[child + 1] > closest_dist[child])
+        {
+            child++;
+        }
+        if (closest_dist[child] <= dist)
+        {
+            break;
+        }
+        closest_idx[root] = closest_idx[child];
+        closest_dist[root] = closest_dist[child];
+        root = child;
+    }
+    closest_idx[root] = idx;
+    closest_dist[root] = dist;
+}
+
+/************************************************
+Sort a priority queue by increasing distance.
+Only queues stored as a max-heap need sorting.
+Params:
+    closest_idx : index queue
+    closest_dist : distance queue
+    k : number of neighbours
+************************************************/
+void sort_points_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} k)
+{
+    u${ITYPE} i, tmp_idx;
+    ${DTYPE} tmp_dist;
+    if (k < KNN_HEAP_MIN_K)
+    {
+        return;
+    }
+    /* Heapsort, move the largest element to the end */
+    for (i = k - 1; i > 0; i--)
+    {
+        tmp_idx = closest_idx[0];
+        tmp_dist = closest_dist[0];
+        closest_idx[0] = closest_idx[i];
+        closest_dist[0] = closest_dist[i];
+        closest_idx[i] = tmp_idx;
+        closest_dist[i] = tmp_dist;
+        sift_down_${DTYPE}_${ITYPE}(closest_idx, closest_dist, 0, i);
+    }
+}
+
+/************************************************
+Turn a priority queue into the result of a query
+Params:
+    closest_idx : index queue
+    closest_dist : distance queue
+    k : number of neighbours
+    distance_upper_bound : squared distance upper bound
+    mark_out_of_bounds : mark neighbours at or beyond the upper bound
+    out_of_bounds_idx : index of neighbours marked as out of bounds,
+                        their distance is set to infinity
+    sqr_dists : keep squared distances instead of taking the square root
+************************************************/
+void finish_points_${DTYPE}_${ITYPE}(u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound,
+                    int mark_out_of_bounds, u${ITYPE} out_of_bounds_idx, int sqr_dists)
+{
+    u${ITYPE} i;
+    sort_points_${DTYPE}_${ITYPE}(closest_idx, closest_dist, k);
+    for (i = 0; i < k; i++)
+    {
+        if (mark_out_of_bounds && closest_dist[i] >= distance_upper_bound)
+        {
+            closest_idx[i] = out_of_bounds_idx;
+            closest_dist[i] = (${DTYPE})INFINITY;
+        }
+        else if (!sqr_dists)
+        {
+            closest_dist[i] = SQRT_${DTYPE}(closest_dist[i]);
+        }
+    }
+}
+
+/************************************************
+Get the bounding box of a set of points
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    n : number of points
+    bbox : bounding box (return)
+************************************************/
+void get_bounding_box_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} n, ${DTYPE} *bbox)
+{
+    int8_t i;
+    /* use signed ints to support all Openmp implementations */
+    int64_t i2;
+    int64_t local_n = (int64_t) n;
+
+    /* Use first data point to initialize */
+    for (i = 0; i < no_dims; i++)
+    {
+        bbox[2 * i] = bbox[2 * i + 1] = PA(0, i);
+    }
+
+    /* Update using rest of data points.
+       Every thread reduces its part of the points into a local box
+       initialized from the first point and merges it afterwards,
+       giving exactly the same box as a serial pass.
+    */
+    #pragma omp parallel if (local_n >= PARALLEL_BUILD_MIN_N)
+    {
+        ${DTYPE} local_bbox[2 * 127];
+        ${DTYPE} cur;
+        int8_t j;
+        int bbox_idx;
+
+        for (j = 0; j < no_dims; j++)
+        {
+            local_bbox[2 * j] = local_bbox[2 * j + 1] = PA(0, j);
+        }
+
+        #pragma omp for schedule(static)
+        for (i2 = 1; i2 < local_n; i2++)
+        {
+            for (j = 0; j < no_dims; j++)
+            {
+                bbox_idx = 2 * j;
+                cur = PA(i2, j);
+                if (cur < local_bbox[bbox_idx])
+                {
+                    local_bbox[bbox_idx] = cur;
+                }
+                else if (cur > local_bbox[bbox_idx + 1])
+                {
+                    local_bbox[bbox_idx + 1] = cur;
+                }
+            }
+        }
+
+        #pragma omp critical
+        {
+            for (j = 0; j < no_dims; j++)
+            {
+                bbox_idx = 2 * j;
+                if (local_bbox[bbox_idx] < bbox[bbox_idx])
+                {
+                    bbox[bbox_idx] = local_bbox[bbox_idx];
+                }
+                if (local_bbox[bbox_idx + 1] > bbox[bbox_idx + 1])
+                {
+                    bbox[bbox_idx + 1] = local_bbox[bbox_idx + 1];
+                }
+            }
+        }
+    }
+}
+
+/************************************************
+Reorder a range of the permutation index so the point at position nth
+has the value it would have if the range was sorted along a dimension.
+Points before nth are not greater and points after nth are not smaller.
+Quickselect with median of three pivots is used. Ranges still unresolved
+after 2 log2(n) rounds are heapsorted to bound the worst case.
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    dim : dimension to select along
+    start_idx : index of first data point of the range
+    end_idx : index of last data point of the range
+    nth : position to select
+************************************************/
+void select_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, int8_t dim, u${ITYPE} start_idx, u${ITYPE} end_idx, u${ITYPE} nth)
+{
+    /* use signed ints as the partition may step below the range */
+    int64_t lo = (int64_t)start_idx, hi = (int64_t)end_idx, target = (int64_t)nth;
+    int64_t i, j, mid, m;
+    int depth_limit = 0;
+    ${DTYPE} pivot;
+
+    for (m = hi - lo + 1; m > 1; m >>= 1)
+    {
+        depth_limit += 2;
+    }
+
+    while (hi > lo)
+    {
+        if (depth_limit-- == 0)
+        {
+            /* Heapsort the remaining range */
+            m = hi - lo + 1;
+            for (i = m / 2 - 1; i >= 0; i--)
+            {
+                select_sift_down_${DTYPE}_${ITYPE}(pa, pidx, no_dims, dim, lo, i, m);
+            }
+            for (i = m - 1; i > 0; i--)
+            {
+                /* Move the largest point to the end of the heap */
+                PASWAP_${ITYPE}(lo, lo + i);
+                select_sift_down_${DTYPE}_${ITYPE}(pa, pidx, no_dims, dim, lo, 0, i);
+            }
+            return;
+        }
+
+        /* Order first, middle and last point giving the median as pivot
+           and sentinels for both scans */
+        mid = lo + (hi - lo) / 2;
+        if (PA(mid, dim) < PA(lo, dim))
+            PASWAP_${ITYPE}(mid, lo);
+        if (PA(hi, dim) < PA(lo, dim))
+            PASWAP_${ITYPE}(hi, lo);
+        if (PA(hi, dim) < PA(mid, dim))
+            PASWAP_${ITYPE}(hi, mid);
+        pivot = PA(mid, dim);
+
+        /* Hoare partition. Points equal to the pivot are spread over both
+           sides which keeps ranges with many duplicates balanced. */
+        i = lo;
+        j = hi;
+        while (i <= j)
+        {
+            while (PA(i, dim) < pivot)
+                i++;
+            while (PA(j, dim) > pivot)
+                j--;
+            if (i <= j)
+            {
+                PASWAP_${ITYPE}(i, j);
+                i++;
+                j--;
+            }
+        }
+
+        if (target <= j)
+        {
+            hi = j;
+        }
+        else if (target >= i)
+        {
+            lo = i;
+        }
+        else
+        {
+            return;
+        }
+    }
+}
+
+/************************************************
+Sift a point down a max-heap of points ordered along one dimension.
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    dim : dimension to order by
+    base : index of the first point of the heap
+    root : heap position of the point to sift down
+    m : number of points in the heap
+************************************************/
+void select_sift_down_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, int8_t dim, int64_t base, int64_t root, int64_t m)
+{
+    int64_t child;
+    for (child = 2 * root + 1; child < m; root = child, child = 2 * root + 1)
+    {
+        if (child + 1 < m && PA(base + child + 1, dim) > PA(base + child, dim))
+        {
+            child++;
+        }
+        if (PA(base + child, dim) <= PA(base + root, dim))
+        {
+            break;
+        }
+        PASWAP_${ITYPE}(base + root, base + child);
+    }
+}
+
+/************************************************
+Choose a cutting plane with a surface area style cost model.
+Each dimension of a sample of the points is sorted and the sampled
+values are tried as cutting values. The cost of a cut is the number of
+points on each side weighted by the half perimeter of the sampled bounding
+box of that side, so cuts through empty space between clusters are
+preferred. Only cuts leaving at least an eighth of the sample on each
+side are considered to keep the tree depth logarithmic.
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    start_idx : index of first data point to use
+    n :  number of data points
+    cut_dim : dimension used for partition (return)
+    cut_val : value of cutting point (return)
+Returns 1 if no cut could be found.
+************************************************/
+int choose_split_cost_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, int8_t *cut_dim, ${DTYPE} *cut_val)
+{
+    ${DTYPE} sample[COST_SAMPLE_SIZE];
+    ${DTYPE} ext[127];
+    ${DTYPE} total = 0, cur, rest, cost, best_cost = DIST_MAX_${DTYPE};
+    int s = (n < COST_SAMPLE_SIZE) ? (int)n : COST_SAMPLE_SIZE;
+    int r, r_min = (s / 8 > 1) ? s / 8 : 1, j, l;
+    int8_t d;
+    int found = 0;
+
+    /* Extent of the sampled points along every dimension */
+    for (d = 0; d < no_dims; d++)
+    {
+        ${DTYPE} lo = PA(start_idx, d), hi = lo;
+        for (j = 1; j < s; j++)
+        {
+            cur = PA(start_idx + (u${ITYPE})((uint64_t)j * n / s), d);
+            if (cur < lo)
+                lo = cur;
+            else if (cur > hi)
+                hi = cur;
+        }
+        ext[d] = hi - lo;
+        total += ext[d];
+    }
+
+    for (d = 0; d < no_dims; d++)
+    {
+        /* Insertion sort of the sample along this dimension */
+        for (j = 0; j < s; j++)
+        {
+            cur = PA(start_idx + (u${ITYPE})((uint64_t)j * n / s), d);
+            for (l = j; l > 0 && sample[l - 1] > cur; l--)
+            {
+                sample[l] = sample[l - 1];
+            }
+            sample[l] = cur;
+        }
+
+        rest = total - ext[d];
+        for (r = r_min; r <= s - r_min; r++)
+        {
+            /* Cutting at sample[r] puts the r smaller samples below the plane */
+            if (sample[r] == sample[r - 1])
+                continue;
+            cost = r * (rest + sample[r - 1] - sample[0]) + (s - r) * (rest + sample[s - 1] - sample[r]);
+            if (cost < best_cost)
+            {
+                best_cost = cost;
+                *cut_dim = d;
+                *cut_val = sample[r];
+                found = 1;
+            }
+        }
+    }
+    return !found;
+}
+
+/************************************************
+Partition a range of data points by manipulation the permutation index.
+The cutting plane is chosen by the split rule:
+    SPLIT_SLIDING_MIDPOINT : middle of the longest side of the bounding box
+    SPLIT_MEDIAN : median of the points along the longest side
+    SPLIT_COST : cost based choice, see choose_split_cost
+The sliding midpoint is used if a rule gives no usable plane.
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    start_idx : index of first data point to use
+    n :  number of data points
+    bbox : bounding box of data points
+    split_rule : rule for choosing the cutting plane
+    cut_dim : dimension used for partition (return)
+    cut_val : value of cutting point (return)
+    n_lo : number of point below cutting plane (return)
+************************************************/
+int partition_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *bbox, int split_rule,
+                                int8_t *cut_dim, ${DTYPE} *cut_val, u${ITYPE} *n_lo)
+{
+    int8_t dim = 0, i;
+    u${ITYPE} p, q, i2;
+    ${DTYPE} size = 0, min_val, max_val, split, side_len, cur_val;
+    u${ITYPE} end_idx = start_idx + n - 1;
+
+    /* Find largest bounding box side */
+    for (i = 0; i < no_dims; i++)
+    {
+        side_len = bbox[2 * i + 1] - bbox[2 * i];
+        if (side_len > size)
+        {
+            dim = i;
+            size = side_len;
+        }
+    }
+
+    min_val = bbox[2 * dim];
+    max_val = bbox[2 * dim + 1];
+
+    /* Check for zero length or inconsistent */
+    if (min_val >= max_val)
+        return 1;
+
+    if (split_rule == SPLIT_MEDIAN)
+    {
+        /* The lower half gets n / 2 points, at least one as n > 1 */
+        *n_lo = n / 2;
+        select_${DTYPE}_${ITYPE}(pa, pidx, no_dims, dim, start_idx, end_idx, start_idx + *n_lo);
+        *cut_dim = dim;
+        *cut_val = PA(start_idx + *n_lo, dim);
+        return 0;
+    }
+
+    /* Use middle for splitting */
+    split = (min_val + max_val) / 2;
+    if (split_rule == SPLIT_COST)
+    {
+        choose_split_cost_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n, &dim, &split);
+    }
+
+    /* Partition all data points around middle */
+    p = start_idx;
+    q = end_idx;
+    while (p <= q)
+    {
+        if (PA(p, dim) < split)
+        {
+            p++;
+        }
+        else if (PA(q, dim) >= split)
+        {
+            /* Guard for underflow */
+            if (q > 0)
+            {
+                q--;
+            }
+            else
+            {
+                break;
+            }
+        }
+        else
+        {
+            PASWAP_${ITYPE}(p, q);
             p++;
+            q--;
+        }
+    }
+
+    /* Check for empty splits */
+    if (p == start_idx)
+    {
+        /* No points less than split.
+           Split at lowest point instead.
+           Minimum 1 point will be in lower box.
+        */
+
+        u${ITYPE} j = start_idx;
+        split = PA(j, dim);
+        for (i2 = start_idx + 1; i2 <= end_idx; i2++)
+        {
+            /* Find lowest point */
+            cur_val = PA(i2, dim);
+            if (cur_val < split)
+            {
+                j = i2;
+                split = cur_val;
+            }
+        }
+        PASWAP_${ITYPE}(j, start_idx);
+        p = start_idx + 1;
+    }
+    else if (p == end_idx + 1)
+    {
+        /* No points greater than split.
+           Split at highest point instead.
+           Minimum 1 point will be in higher box.
+        */
+
+        u${ITYPE} j = end_idx;
+        split = PA(j, dim);
+        for (i2 = start_idx; i2 < end_idx; i2++)
+        {
+            /* Find highest point */
+            cur_val = PA(i2, dim);
+            if (cur_val > split)
+            {
+                j = i2;
+                split = cur_val;
+            }
+        }
+        PASWAP_${ITYPE}(j, end_idx);
+        p = end_idx;
+    }
+
+    /* Set return values */
+    *cut_dim = dim;
+    *cut_val = split;
+    *n_lo = p - start_idx;
+    return 0;
+}
+
+/************************************************
+Construct a sub tree over a range of data points.
+The nodes are appended to the node array in depth-first order.
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    start_idx : index of first data point to use
+    n :  number of data points
+    bsp : number of points per leaf
+    split_rule : rule for choosing the cutting planes
+    bbox : bounding box of set of data points
+    node_array : array receiving the nodes of the subtree
+************************************************/
+void construct_subtree_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, u${ITYPE} bsp, int split_rule, ${DTYPE} *bbox,
+                                NodeArray_${DTYPE}_${ITYPE} *node_array)
+{
+    /* Create new node */
+    int is_leaf = (n <= bsp);
+    u${ITYPE} root_idx = create_node_${DTYPE}_${ITYPE}(node_array, start_idx, n);
+    Node_${DTYPE}_${ITYPE} *root = &node_array->nodes[root_idx];
+    int rval;
+    int8_t cut_dim;
+    u${ITYPE} n_lo;
+    ${DTYPE} cut_val, lv, hv;
+    if (is_leaf)
+    {
+        /* Make leaf node */
+        root->cut_dim = -1;
+    }
+    else
+    {
+        /* Make split node */
+        /* Partition data set and set node info */
+        rval = partition_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n, bbox, split_rule, &cut_dim, &cut_val, &n_lo);
+        if (rval == 1)
+        {
+            root->cut_dim = -1;
+            return;
+        }
+        root->cut_val = cut_val;
+        root->cut_dim = cut_dim;
+
+        /* Recurse on both subsets */
+        lv = bbox[2 * cut_dim];
+        hv = bbox[2 * cut_dim + 1];
+
+        /* Set bounds for cut dimension */
+        root->cut_bounds_lv = lv;
+        root->cut_bounds_hv = hv;
+
+        /* Update bounding box before call to lower subset and restore after.
+           The lower subset starts right after this node. */
+        bbox[2 * cut_dim + 1] = cut_val;
+        construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n_lo, bsp, split_rule, bbox, node_array);
+        bbox[2 * cut_dim + 1] = hv;
+
+        /* Update bounding box before call to higher subset and restore after.
+           The node array may have been reallocated so index it again. */
+        node_array->nodes[root_idx].right_child = node_array->num_nodes - root_idx;
+        bbox[2 * cut_dim] = cut_val;
+        construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx + n_lo, n - n_lo, bsp, split_rule, bbox, node_array);
+        bbox[2 * cut_dim] = lv;
+    }
+}
+
+#ifdef KDTREE_OMP_TASKS
+/************************************************
+Construct a sub tree over a range of data points using OpenMP tasks.
+Subtrees below PARALLEL_BUILD_MIN_N points are built serially into a block of
+nodes of their own. Must be called from within an OpenMP parallel region to run
+in parallel.
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims: number of dimensions
+    start_idx : index of first data point to use
+    n :  number of data points
+    bsp : number of points per leaf
+    split_rule : rule for choosing the cutting planes
+    bbox : bounding box of set of data points
+************************************************/
+TaskSubtree_${DTYPE}_${ITYPE}* construct_subtree_task_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, u${ITYPE} bsp, int split_rule, ${DTYPE} *bbox)
+{
+    TaskSubtree_${DTYPE}_${ITYPE} *subtree = (TaskSubtree_${DTYPE}_${ITYPE} *)malloc(sizeof(TaskSubtree_${DTYPE}_${ITYPE}));
+    ${DTYPE} *bbox_lo;
+    int8_t cut_dim;
+    u${ITYPE} n_lo;
+    ${DTYPE} cut_val, lv;
+
+    subtree->left_child = NULL;
+    subtree->right_child = NULL;
+    subtree->block.nodes = NULL;
+
+    if (n < PARALLEL_BUILD_MIN_N || n <= bsp ||
+        partition_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n, bbox, split_rule, &cut_dim, &cut_val, &n_lo) == 1)
+    {
+        /* Build serially. A failed partition leaves pidx untouched so the
+           serial build reaches the same leaf. */
+        init_node_array_${DTYPE}_${ITYPE}(&subtree->block, n, bsp);
+        construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n, bsp, split_rule, bbox, &subtree->block);
+        subtree->num_nodes = subtree->block.num_nodes;
+        return subtree;
+    }
+
+    memset(&subtree->node, 0, sizeof(Node_${DTYPE}_${ITYPE}));
+    subtree->node.start_idx = start_idx;
+    subtree->node.n = n;
+    subtree->node.cut_val = cut_val;
+    subtree->node.cut_dim = cut_dim;
+    subtree->node.cut_bounds_lv = lv = bbox[2 * cut_dim];
+    subtree->node.cut_bounds_hv = bbox[2 * cut_dim + 1];
+
+    /* Build lower subset as a task on its own copy of the bounding box
+       while this thread continues with the higher subset.
+       The subsets are disjoint ranges of pidx so the result is
+       identical to the serial build.
+    */
+    bbox_lo = (${DTYPE} *)malloc(2 * sizeof(${DTYPE}) * no_dims);
+    memcpy(bbox_lo, bbox, 2 * sizeof(${DTYPE}) * no_dims);
+    bbox_lo[2 * cut_dim + 1] = cut_val;
+    #pragma omp task firstprivate(bbox_lo)
+    {
+        subtree->left_child = construct_subtree_task_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n_lo, bsp, split_rule, bbox_lo);
+        free(bbox_lo);
+    }
+
+    bbox[2 * cut_dim] = cut_val;
+    subtree->right_child = construct_subtree_task_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx + n_lo, n - n_lo, bsp, split_rule, bbox);
+    bbox[2 * cut_dim] = lv;
+
+    #pragma omp taskwait
+    subtree->node.right_child = 1 + subtree->left_child->num_nodes;
+    subtree->num_nodes = subtree->node.right_child + subtree->right_child->num_nodes;
+    return subtree;
+}
+
+/************************************************
+Copy a subtree built by tasks into its final position in the node array
+and release it.
+Params:
+    subtree : subtree built by construct_subtree_task
+    nodes : destination of the first node of the subtree
+************************************************/
+void flatten_subtree_task_${DTYPE}_${ITYPE}(TaskSubtree_${DTYPE}_${ITYPE} *subtree, Node_${DTYPE}_${ITYPE} *nodes)
+{
+    if (subtree->block.nodes != NULL)
+    {
+        memcpy(nodes, subtree->block.nodes, sizeof(Node_${DTYPE}_${ITYPE}) * subtree->num_nodes);
+        free(subtree->block.nodes);
+    }
+    else
+    {
+        memcpy(nodes, &subtree->node, sizeof(Node_${DTYPE}_${ITYPE}));
+        #pragma omp task
+        flatten_subtree_task_${DTYPE}_${ITYPE}(subtree->left_child, nodes + 1);
+        flatten_subtree_task_${DTYPE}_${ITYPE}(subtree->right_child, nodes + subtree->node.right_child);
+        #pragma omp taskwait
+    }
+    free(subtree);
+}
+#endif
+
+/************************************************
+Construct a tree over data points.
+Params:
+    pa : data points
+    no_dims: number of dimensions
+    n :  number of data points
+    bsp : number of points per leaf
+    split_rule : rule for choosing the cutting planes
+************************************************/
+Tree_${DTYPE}_${ITYPE}* construct_tree_${DTYPE}_${ITYPE}(${DTYPE} *pa, int8_t no_dims, u${ITYPE} n, u${ITYPE} bsp, int split_rule)
+{
+    Tree_${DTYPE}_${ITYPE} *tree = (Tree_${DTYPE}_${ITYPE} *)malloc(sizeof(Tree_${DTYPE}_${ITYPE}));
+    /* use signed ints to support all Openmp implementations */
+    int64_t i;
+    int64_t local_n = (int64_t) n;
+    u${ITYPE} *pidx;
+    ${DTYPE} *bbox;
+    NodeArray_${DTYPE}_${ITYPE} node_array;
+
+    tree->no_dims = no_dims;
+
+    /* Initialize permutation array */
+    pidx = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * n);
+    #pragma omp parallel for schedule(static) if (local_n >= PARALLEL_BUILD_MIN_N)
+    for (i = 0; i < local_n; i++)
+    {
+        pidx[i] = (u${ITYPE})i;
+    }
+
+    bbox = (${DTYPE} *)malloc(2 * sizeof(${DTYPE}) * no_dims);
+    get_bounding_box_${DTYPE}_${ITYPE}(pa, pidx, no_dims, n, bbox);
+    tree->bbox = bbox;
+
+    /* Construct subtree on full dataset */
+#ifdef KDTREE_OMP_TASKS
+    if (n >= PARALLEL_BUILD_MIN_N)
+    {
+        /* Subtrees of PARALLEL_BUILD_MIN_N points or more are split into
+           OpenMP tasks executed by the threads of this parallel region
+           and copied into a single node array afterwards.
+        */
+        TaskSubtree_${DTYPE}_${ITYPE} *subtree;
+        #pragma omp parallel
+        {
+            #pragma omp single
+            {
+                subtree = construct_subtree_task_${DTYPE}_${ITYPE}(pa, pidx, no_dims, 0, n, bsp, split_rule, bbox);
+                node_array.num_nodes = node_array.capacity = subtree->num_nodes;
+                node_array.nodes = (Node_${DTYPE}_${ITYPE} *)malloc(sizeof(Node_${DTYPE}_${ITYPE}) * node_array.num_nodes);
+                flatten_subtree_task_${DTYPE}_${ITYPE}(subtree, node_array.nodes);
+            }
+        }
+    }
+    else
+#endif
+    {
+        init_node_array_${DTYPE}_${ITYPE}(&node_array, n, bsp);
+        construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, 0, n, bsp, split_rule, bbox, &node_array);
+        /* Release unused capacity */
+        node_array.nodes = (Node_${DTYPE}_${ITYPE} *)realloc(node_array.nodes, sizeof(Node_${DTYPE}_${ITYPE}) * node_array.num_nodes);
+    }
+    tree->nodes = node_array.nodes;
+    tree->num_nodes = node_array.num_nodes;
+    tree->owns_arrays = 1;
+    tree->leaf_data = NULL;
+    tree->boxsize = NULL;
+    tree->leaf_mask = NULL;
+    tree->node_masked = NULL;
+    tree->sphere_radius = 0;
+
+    tree->pidx = pidx;
+    return tree;
+}
+
+/************************************************
+Initialize an empty node array.
+The initial capacity is a guess based on half full leaves.
+Params:
+    node_array : node array to initialize
+    n :  number of data points in the tree
+    bsp : number of points per leaf
+************************************************/
+void init_node_array_${DTYPE}_${ITYPE}(NodeArray_${DTYPE}_${ITYPE} *node_array, u${ITYPE} n, u${ITYPE} bsp)
+{
+    node_array->num_nodes = 0;
+    node_array->capacity = 4 * (n / bsp) + 1;
+    node_array->nodes = (Node_${DTYPE}_${ITYPE} *)malloc(sizeof(Node_${DTYPE}_${ITYPE}) * node_array->capacity);
+}
+
+/************************************************
+Create a tree node at the end of a node array.
+Params:
+    node_array : node array to append the node to
+    start_idx : index of first data point to use
+    n :  number of data points
+Returns the index of the new node in the node array.
+************************************************/
+u${ITYPE} create_node_${DTYPE}_${ITYPE}(NodeArray_${DTYPE}_${ITYPE} *node_array, u${ITYPE} start_idx, u${ITYPE} n)
+{
+    Node_${DTYPE}_${ITYPE} *new_node;
+    if (node_array->num_nodes == node_array->capacity)
+    {
+        node_array->capacity *= 2;
+        node_array->nodes = (Node_${DTYPE}_${ITYPE} *)realloc(node_array->nodes, sizeof(Node_${DTYPE}_${ITYPE}) * node_array->capacity);
+    }
+    new_node = &node_array->nodes[node_array->num_nodes];
+    /* Zero the padding too, the node array is saved and pickled as raw bytes */
+    memset(new_node, 0, sizeof(Node_${DTYPE}_${ITYPE}));
+    new_node->n = n;
+    new_node->start_idx = start_idx;
+    return node_array->num_nodes++;
+}
+
+/************************************************
+Create a tree from the arrays of an existing tree,
+e.g. a tree loaded from disk. The arrays are owned by the caller
+and are not released by delete_tree.
+Params:
+    no_dims: number of dimensions
+    bbox : bounding box of data points
+    pidx : permutation index of data points
+    nodes : node array
+    num_nodes : number of nodes
+************************************************/
+Tree_${DTYPE}_${ITYPE}* create_tree_view_${DTYPE}_${ITYPE}(int8_t no_dims, ${DTYPE} *bbox, u${ITYPE} *pidx, Node_${DTYPE}_${ITYPE} *nodes, u${ITYPE} num_nodes)
+{
+    Tree_${DTYPE}_${ITYPE} *tree = (Tree_${DTYPE}_${ITYPE} *)malloc(sizeof(Tree_${DTYPE}_${ITYPE}));
+    tree->no_dims = no_dims;
+    tree->bbox = bbox;
+    tree->pidx = pidx;
+    tree->nodes = nodes;
+    tree->num_nodes = num_nodes;
+    tree->owns_arrays = 0;
+    tree->leaf_data = NULL;
+    tree->boxsize = NULL;
+    tree->leaf_mask = NULL;
+    tree->node_masked = NULL;
+    tree->sphere_radius = 0;
+    return tree;
+}
+
+/************************************************
+Build a copy of the data points in leaf order. The points of
+each leaf are stored dimension by dimension: coordinate d of
+the i'th point of a leaf starting at start_idx with n points is
+leaf_data[start_idx * no_dims + d * n + i].
+The copy is released by delete_tree.
+Params:
+    tree : Tree struct of kd tree
+    pa : data points
+************************************************/
+void build_leaf_data_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa)
+{
+    int8_t no_dims = tree->no_dims;
+    u${ITYPE} *pidx = tree->pidx;
+    /* use signed ints to support all Openmp implementations */
+    int64_t j;
+    int64_t num_nodes = (int64_t)tree->num_nodes;
+    ${DTYPE} *leaf_data = (${DTYPE} *)malloc(sizeof(${DTYPE}) * (uint64_t)tree->nodes[0].n * no_dims);
+
+    #pragma omp parallel for schedule(static) if (tree->nodes[0].n >= PARALLEL_BUILD_MIN_N)
+    for (j = 0; j < num_nodes; j++)
+    {
+        Node_${DTYPE}_${ITYPE} *node = &tree->nodes[j];
+        ${DTYPE} *block = leaf_data + (uint64_t)node->start_idx * no_dims;
+        u${ITYPE} i;
+        int8_t d;
+        if (node->cut_dim != -1)
+        {
+            continue;
+        }
+        for (i = 0; i < node->n; i++)
+        {
+            for (d = 0; d < no_dims; d++)
+            {
+                block[d * node->n + i] = PA(node->start_idx + i, d);
+            }
+        }
+    }
+    free(tree->leaf_data);
+    tree->leaf_data = leaf_data;
+}
+
+/************************************************
+Set the mask used by searches without a mask of their own.
+The mask is stored bit-packed in leaf order: the point at
+pidx[i] is masked if bit i & 7 of leaf_mask[i >> 3] is set.
+node_masked[j] flags nodes all of whose points are masked,
+these subtrees are skipped by the searches.
+The arrays are released by delete_tree.
+Params:
+    tree : Tree struct of kd tree
+    mask : boolean array of invalid (True) and valid (False) data points,
+           NULL removes the mask
+************************************************/
+void build_mask_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, uint8_t *mask)
+{
+    u${ITYPE} *pidx = tree->pidx;
+    u${ITYPE} n = tree->nodes[0].n;
+    /* use signed ints to support all Openmp implementations */
+    int64_t b, j;
+    int64_t num_bytes = ((int64_t)n + 7) / 8;
+    int64_t num_nodes = (int64_t)tree->num_nodes;
+    uint8_t *leaf_mask = NULL;
+    uint8_t *node_masked = NULL;
+
+    if (mask)
+    {
+        leaf_mask = (uint8_t *)malloc(num_bytes);
+        node_masked = (uint8_t *)malloc(num_nodes);
+
+        #pragma omp parallel for schedule(static) if (n >= PARALLEL_BUILD_MIN_N)
+        for (b = 0; b < num_bytes; b++)
+        {
+            uint8_t bits = 0;
+            int bit;
+            for (bit = 0; bit < 8 && b * 8 + bit < (int64_t)n; bit++)
+            {
+                bits |= (mask[pidx[b * 8 + bit]] != 0) << bit;
+            }
+            leaf_mask[b] = bits;
+        }
+
+        /* Children follow their parent in the node array */
+        for (j = num_nodes - 1; j >= 0; j--)
+        {
+            Node_${DTYPE}_${ITYPE} *node = &tree->nodes[j];
+            u${ITYPE} i;
+            if (node->cut_dim != -1)
+            {
+                node_masked[j] = node_masked[j + 1] && node_masked[j + node->right_child];
+                continue;
+            }
+            node_masked[j] = 1;
+            for (i = node->start_idx; i < node->start_idx + node->n; i++)
+            {
+                if (!LEAF_MASKED(leaf_mask, i))
+                {
+                    node_masked[j] = 0;
+                    break;
+                }
+            }
+        }
+    }
+    free(tree->leaf_mask);
+    free(tree->node_masked);
+    tree->leaf_mask = leaf_mask;
+    tree->node_masked = node_masked;
+}
+
+/************************************************
+Delete tree
+Params:
+    tree : Tree struct of kd tree
+************************************************/
+void delete_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree)
+{
+    if (tree->owns_arrays)
+    {
+        free(tree->nodes);
+        free(tree->bbox);
+        free(tree->pidx);
+    }
+    free(tree->leaf_data);
+    free(tree->leaf_mask);
+    free(tree->node_masked);
+    free(tree);
+}
+
+/************************************************
+Print
+************************************************/
+void print_tree_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, int level)
+{
+    int i;
+    for (i = 0; i < level; i++)
+    {
+        printf(" ");
+    }
+    printf("(cut_val: %f, cut_dim: %i)\n", root->cut_val, root->cut_dim);
+    if (root->cut_dim != -1)
+        print_tree_${DTYPE}_${ITYPE}(root + 1, level + 1);
+    if (root->cut_dim != -1)
+        print_tree_${DTYPE}_${ITYPE}(root + root->right_child, level + 1);
+}
+
+/************************************************
+Get the depth and number of points of every leaf of a tree
+in depth-first order. The root is at depth 0.
+Params:
+    tree : Tree struct of kd tree
+    leaf_depths : depth of every leaf (return)
+    leaf_sizes : number of points in every leaf (return)
+Returns the number of leaves.
+************************************************/
+uint64_t get_leaf_stats_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, uint32_t *leaf_depths, uint64_t *leaf_sizes)
+{
+    uint64_t num_leaves = 0;
+    collect_leaf_stats_${DTYPE}_${ITYPE}(tree->nodes, 0, leaf_depths, leaf_sizes, &num_leaves);
+    return num_leaves;
+}
+
+void collect_leaf_stats_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, uint32_t depth, uint32_t *leaf_depths, uint64_t *leaf_sizes, uint64_t *num_leaves)
+{
+    if (root->cut_dim == -1)
+    {
+        leaf_depths[*num_leaves] = depth;
+        leaf_sizes[*num_leaves] = root->n;
+        (*num_leaves)++;
+        return;
+    }
+    collect_leaf_stats_${DTYPE}_${ITYPE}(root + 1, depth + 1, leaf_depths, leaf_sizes, num_leaves);
+    collect_leaf_stats_${DTYPE}_${ITYPE}(root + root->right_child, depth + 1, leaf_depths, leaf_sizes, num_leaves);
+}
+
+/************************************************
+Search a leaf node for closest point
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_leaf_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                 u${ITYPE} k, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+{
+    ${DTYPE} cur_dist;
+    u${ITYPE} i;
+    /* Loop through all points in leaf */
+    for (i = 0; i < n; i++)
+    {
+        /* Get distance to query point */
+        cur_dist = calc_dist_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims);
+        /* Update closest info if new point is closest so far*/
+        if (cur_dist < closest_dist[KNN_WORST(k)])
+        {
+            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[start_idx + i], cur_dist, k);
+        }
+    }
+}
+
+
+/************************************************
+Search a leaf node for closest point with data point mask
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    mask : boolean array of invalid (True) and valid (False) data points
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_leaf_${DTYPE}_${ITYPE}_mask(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                               u${ITYPE} k, uint8_t *mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+{
+    ${DTYPE} cur_dist;
+    u${ITYPE} i;
+    /* Loop through all points in leaf */
+    for (i = 0; i < n; i++)
+    {
+        /* Is this point masked out? */
+        if (mask[pidx[start_idx + i]])
+        {
+            continue;
+        }
+        /* Get distance to query point */
+        cur_dist = calc_dist_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims);
+        /* Update closest info if new point is closest so far*/
+        if (cur_dist < closest_dist[KNN_WORST(k)])
+        {
+            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[start_idx + i], cur_dist, k);
+        }
+    }
+}
+
+/************************************************
+Search a leaf node for closest point with a bit-packed mask in leaf order
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    leaf_mask : bit-packed mask of the data points in leaf order, see build_mask
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_leaf_${DTYPE}_${ITYPE}_leaf_mask(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                                    u${ITYPE} k, uint8_t *restrict leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+{
+    ${DTYPE} cur_dist;
+    u${ITYPE} i;
+    for (i = start_idx; i < start_idx + n; i++)
+    {
+        if (LEAF_MASKED(leaf_mask, i))
+        {
+            continue;
+        }
+        cur_dist = calc_dist_${DTYPE}(&PA(i, 0), point_coord, no_dims);
+        if (cur_dist < closest_dist[KNN_WORST(k)])
+        {
+            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[i], cur_dist, k);
+        }
+    }
+}
+
+/************************************************
+Search a leaf node of the leaf ordered copy of the data points
+for closest point. Distances are calculated for blocks of points
+at a time without indirection through the permutation index.
+Params:
+    leaf_data : leaf ordered copy of data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    k : number of neighbours
+    mask : boolean array of invalid (True) and valid (False) data points, not used if NULL
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_leaf_block_${DTYPE}_${ITYPE}(${DTYPE} *restrict leaf_data, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                       u${ITYPE} k, uint8_t *mask, uint8_t *leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+{
+    ${DTYPE} dists[LEAF_BLOCK_SIZE];
+    u${ITYPE} i, offset;
+    int j, m;
+    for (offset = 0; offset < n; offset += LEAF_BLOCK_SIZE)
+    {
+        m = (n - offset < LEAF_BLOCK_SIZE) ? (int)(n - offset) : LEAF_BLOCK_SIZE;
+        calc_block_dists_${DTYPE}(leaf_data + (uint64_t)start_idx * no_dims + offset, n, m, no_dims, point_coord, dists);
+        for (j = 0; j < m; j++)
+        {
+            i = start_idx + offset + j;
+            /* Update closest info if new point is closest so far and not masked out */
+            if (dists[j] < closest_dist[KNN_WORST(k)] && !(mask && mask[pidx[i]]) && !(leaf_mask && LEAF_MASKED(leaf_mask, i)))
+            {
+                insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[i], dists[j], k);
+            }
+        }
+    }
+}
+
+/************************************************
+Search subtree for nearest to query point
+Params:
+    root : root node of subtree
+    pa : data points
+    pidx : permutation index of data points
+    leaf_data : leaf ordered copy of data points, not used if NULL
+    no_dims : number of dimensions
+    point_coord : query point
+    min_dist : minumum distance to nearest neighbour
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    node_masked : fully masked flags of root and its subtree, not used if NULL
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+    stats : STAT_* counters of the query, only in the stats variant (return)
+************************************************/
+% for STATS in [False, True]:
+<% S = '_stats' if STATS else '' %>\
+void search_splitnode${S}_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord, 
+                      ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask,
+                      uint8_t *leaf_mask, uint8_t *node_masked, u${ITYPE} *closest_idx, ${DTYPE} *closest_dist${', uint64_t *stats' if STATS else ''})
+{
+    int8_t dim;
+    ${DTYPE} dist_left, dist_right;
+    ${DTYPE} new_offset;
+    ${DTYPE} box_diff;
+
+    /* Skip if distance bound exeeded or all points of the subtree are masked */
+    if (min_dist > distance_upper_bound || (node_masked && node_masked[0]))
+    {
+% if STATS:
+        stats[STAT_PRUNED]++;
+% endif
+        return;
+    }
+
+    dim = root->cut_dim;
+% if STATS:
+    stats[STAT_NODES]++;
+% endif
+
+    /* Handle leaf node */
+    if (dim == -1)
+    {
+% if STATS:
+        stats[STAT_LEAVES]++;
+        stats[STAT_DISTS] += root->n;
+% endif
+        if (leaf_data)
+        {
+            search_leaf_block_${DTYPE}_${ITYPE}(leaf_data, pidx, no_dims, root->start_idx, root->n, point_coord, k, mask, leaf_mask, closest_idx, closest_dist);
+        }
+        else if (mask)
+        {
+            search_leaf_${DTYPE}_${ITYPE}_mask(pa, pidx, no_dims, root->start_idx, root->n, point_coord, k, mask, closest_idx, closest_dist);
+        }
+        else if (leaf_mask)
+        {
+            search_leaf_${DTYPE}_${ITYPE}_leaf_mask(pa, pidx, no_dims, root->start_idx, root->n, point_coord, k, leaf_mask, closest_idx, closest_dist);
+        }
+        else
+        {
+            search_leaf_${DTYPE}_${ITYPE}(pa, pidx, no_dims, root->start_idx, root->n, point_coord, k, closest_idx, closest_dist);
+        }
+        return;
+    }
+
+    /* Get distance to cutting plane */
+    new_offset = point_coord[dim] - root->cut_val;
+
+    if (new_offset < 0)
+    {
+        /* Left of cutting plane */
+        dist_left = min_dist;
+        if (dist_left < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            /* Search left subtree if minimum distance is below limit */
+            search_splitnode${S}_${DTYPE}_${ITYPE}(root + 1, pa, pidx, leaf_data, no_dims, point_coord, dist_left, k, distance_upper_bound, eps_fac, mask, leaf_mask, node_masked ? node_masked + 1 : NULL, closest_idx, closest_dist${', stats' if STATS else ''});
+        }
+% if STATS:
+        else
+        {
+            stats[STAT_PRUNED]++;
+        }
+% endif
+
+        /* Right of cutting plane. Update minimum distance.
+           See Algorithms for Fast Vector Quantization
+           Sunil Arya and David M. Mount. */
+        box_diff = root->cut_bounds_lv - point_coord[dim];
+        if (box_diff < 0)
+        {
+		box_diff = 0;
+        }
+        dist_right = min_dist - box_diff * box_diff + new_offset * new_offset;
+        if (dist_right < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            /* Search right subtree if minimum distance is below limit*/
+            search_splitnode${S}_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, leaf_data, no_dims, point_coord, dist_right, k, distance_upper_bound, eps_fac, mask, leaf_mask,
+                                   node_masked ? node_masked + root->right_child : NULL, closest_idx, closest_dist${', stats' if STATS else ''});
+        }
+% if STATS:
+        else
+        {
+            stats[STAT_PRUNED]++;
+        }
+% endif
+    }
+    else
+    {
+        /* Right of cutting plane */
+        dist_right = min_dist;
+        if (dist_right < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            /* Search right subtree if minimum distance is below limit*/
+            search_splitnode${S}_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, leaf_data, no_dims, point_coord, dist_right, k, distance_upper_bound, eps_fac, mask, leaf_mask,
+                                   node_masked ? node_masked + root->right_child : NULL, closest_idx, closest_dist${', stats' if STATS else ''});
+        }
+% if STATS:
+        else
+        {
+            stats[STAT_PRUNED]++;
+        }
+% endif
+
+        /* Left of cutting plane. Update minimum distance.
+           See Algorithms for Fast Vector Quantization
+           Sunil Arya and David M. Mount. */
+        box_diff = point_coord[dim] - root->cut_bounds_hv;
+        if (box_diff < 0)
+        {
+        	box_diff = 0;
+        }
+        dist_left = min_dist - box_diff * box_diff + new_offset * new_offset;
+	  if (dist_left < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            /* Search left subtree if minimum distance is below limit*/
+            search_splitnode${S}_${DTYPE}_${ITYPE}(root + 1, pa, pidx, leaf_data, no_dims, point_coord, dist_left, k, distance_upper_bound, eps_fac, mask, leaf_mask, node_masked ? node_masked + 1 : NULL, closest_idx, closest_dist${', stats' if STATS else ''});
+        }
+% if STATS:
+        else
+        {
+            stats[STAT_PRUNED]++;
+        }
+% endif
+    }
+}
+
+% endfor
+
+/************************************************
+Add a subtree to the queue of a best-bin-first search
+Params:
+    queue : min-heap of pending subtrees
+    node : offset of the subtree root from the tree root
+    min_dist : minimum distance of the query point to the subtree
+************************************************/
+void push_node_queue_${DTYPE}_${ITYPE}(NodeQueue_${DTYPE}_${ITYPE} *queue, u${ITYPE} node, ${DTYPE} min_dist)
+{
+    QueueEntry_${DTYPE}_${ITYPE} *entries;
+    uint64_t i, parent;
+    if (queue->size == queue->capacity)
+    {
+        queue->capacity = queue->capacity ? 2 * queue->capacity : 64;
+        queue->entries = (QueueEntry_${DTYPE}_${ITYPE} *)realloc(queue->entries, sizeof(QueueEntry_${DTYPE}_${ITYPE}) * queue->capacity);
+    }
+    entries = queue->entries;
+
+    /* Sift up from the end of the heap */
+    i = queue->size++;
+    while (i > 0)
+    {
+        parent = (i - 1) / 2;
+        if (entries[parent].min_dist <= min_dist)
+        {
+            break;
+        }
+        entries[i] = entries[parent];
+        i = parent;
+    }
+    entries[i].min_dist = min_dist;
+    entries[i].node = node;
+}
+
+/************************************************
+Remove the closest subtree from the queue of a best-bin-first search
+Params:
+    queue : non-empty min-heap of pending subtrees
+************************************************/
+void pop_node_queue_${DTYPE}_${ITYPE}(NodeQueue_${DTYPE}_${ITYPE} *queue)
+{
+    QueueEntry_${DTYPE}_${ITYPE} *entries = queue->entries;
+    QueueEntry_${DTYPE}_${ITYPE} last = entries[--queue->size];
+    uint64_t i = 0, child;
+
+    /* Sift the last entry down from the root */
+    while ((child = 2 * i + 1) < queue->size)
+    {
+        if (child + 1 < queue->size && entries[child + 1].min_dist < entries[child].min_dist)
+        {
+            child++;
+        }
+        if (last.min_dist <= entries[child].min_dist)
+        {
+            break;
+        }
+        entries[i] = entries[child];
+        i = child;
+    }
+    entries[i] = last;
+}
+
+/************************************************
+Search tree for nearest to query point in best-bin-first order.
+The subtrees are searched in the order of their minimum distance to the
+query point rather than depth first. After the leaf closest to the query
+point the leaves most likely to hold closer points are searched next,
+so stopping after a budget of leaves or distance computations returns
+the best neighbours found within a fixed cost.
+Params:
+    root : root node of tree
+    pa : data points
+    pidx : permutation index of data points
+    leaf_data : leaf ordered copy of data points, not used if NULL
+    no_dims : number of dimensions
+    point_coord : query point
+    min_dist : minumum distance to nearest neighbour
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    node_masked : fully masked flags of the nodes, not used if NULL
+    max_leaves : stop after searching this many leaves, no limit if 0
+    max_checks : stop after computing at least this many distances, no limit if 0.
+                 The leaf reaching the limit is searched completely.
+    queue : heap of pending subtrees, emptied before the search
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+    stats : STAT_* counters of the query, not collected if NULL (return)
+Without limits the search is exact.
+************************************************/
+void search_bbf_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord,
+                ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, uint8_t *node_masked,
+                uint64_t max_leaves, uint64_t max_checks, NodeQueue_${DTYPE}_${ITYPE} *queue,
+                u${ITYPE} *closest_idx, ${DTYPE} *closest_dist, uint64_t *stats)
+{
+    Node_${DTYPE}_${ITYPE} *node, *near_child, *far_child;
+    ${DTYPE} node_dist, far_dist;
+    ${DTYPE} new_offset;
+    ${DTYPE} box_diff;
+    uint64_t num_leaves = 0;
+    uint64_t num_checks = 0;
+    int8_t dim;
+
+    queue->size = 0;
+    if (min_dist > distance_upper_bound || (node_masked && node_masked[0]))
+    {
+        if (stats)
+        {
+            stats[STAT_PRUNED]++;
+        }
+        return;
+    }
+    push_node_queue_${DTYPE}_${ITYPE}(queue, 0, min_dist);
+
+    while (queue->size > 0)
+    {
+        node = root + queue->entries[0].node;
+        node_dist = queue->entries[0].min_dist;
+        pop_node_queue_${DTYPE}_${ITYPE}(queue);
+        if (!(node_dist < closest_dist[KNN_WORST(k)] * eps_fac))
+        {
+            /* The remaining subtrees are even further away */
+            if (stats)
+            {
+                stats[STAT_PRUNED] += queue->size + 1;
+            }
+            break;
         }
-        else if (PA(q, dim) >= split)
+
+        /* Descend to the leaf closest to the query point and queue the far
+           children on the way. The near child keeps the distance of its parent,
+           the distance of the far child is updated as in search_splitnode. */
+        while ((dim = node->cut_dim) != -1)
         {
-            /* Guard for underflow */
-            if (q > 0)
+            if (stats)
             {
-                q--;
+                stats[STAT_NODES]++;
+            }
+            new_offset = point_coord[dim] - node->cut_val;
+            if (new_offset < 0)
+            {
+                near_child = node + 1;
+                far_child = node + node->right_child;
+                box_diff = node->cut_bounds_lv - point_coord[dim];
             }
             else
+            {
+                near_child = node + node->right_child;
+                far_child = node + 1;
+                box_diff = point_coord[dim] - node->cut_bounds_hv;
+            }
+            if (box_diff < 0)
+            {
+                box_diff = 0;
+            }
+            far_dist = node_dist - box_diff * box_diff + new_offset * new_offset;
+            if (far_dist < closest_dist[KNN_WORST(k)] * eps_fac && far_dist <= distance_upper_bound &&
+                !(node_masked && node_masked[far_child - root]))
+            {
+                push_node_queue_${DTYPE}_${ITYPE}(queue, (u${ITYPE})(far_child - root), far_dist);
+            }
+            else if (stats)
+            {
+                stats[STAT_PRUNED]++;
+            }
+            node = near_child;
+            if (node_masked && node_masked[node - root])
             {
                 break;
             }
         }
+        if (dim != -1)
+        {
+            /* All points of the near child are masked */
+            if (stats)
+            {
+                stats[STAT_PRUNED]++;
+            }
+            continue;
+        }
+
+        if (stats)
+        {
+            stats[STAT_NODES]++;
+            stats[STAT_LEAVES]++;
+            stats[STAT_DISTS] += node->n;
+        }
+        if (leaf_data)
+        {
+            search_leaf_block_${DTYPE}_${ITYPE}(leaf_data, pidx, no_dims, node->start_idx, node->n, point_coord, k, mask, leaf_mask, closest_idx, closest_dist);
+        }
+        else if (mask)
+        {
+            search_leaf_${DTYPE}_${ITYPE}_mask(pa, pidx, no_dims, node->start_idx, node->n, point_coord, k, mask, closest_idx, closest_dist);
+        }
+        else if (leaf_mask)
+        {
+            search_leaf_${DTYPE}_${ITYPE}_leaf_mask(pa, pidx, no_dims, node->start_idx, node->n, point_coord, k, leaf_mask, closest_idx, closest_dist);
+        }
         else
         {
-            PASWAP_${ITYPE}(p, q);
-            p++;
-            q--;
+            search_leaf_${DTYPE}_${ITYPE}(pa, pidx, no_dims, node->start_idx, node->n, point_coord, k, closest_idx, closest_dist);
+        }
+        num_leaves++;
+        num_checks += node->n;
+        if ((max_leaves && num_leaves >= max_leaves) || (max_checks && num_checks >= max_checks))
+        {
+            break;
         }
     }
+}
 
-    /* Check for empty splits */
-    if (p == start_idx)
+/************************************************
+Search a leaf node for closest point in a periodic box
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    boxsize : side lengths of the box
+    k : number of neighbours
+    mask : boolean array of invalid (True) and valid (False) data points, not used if NULL
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_leaf_periodic_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                          ${DTYPE} *boxsize, u${ITYPE} k, uint8_t *mask, uint8_t *leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+{
+    ${DTYPE} cur_dist;
+    u${ITYPE} i;
+    for (i = 0; i < n; i++)
     {
-        /* No points less than split.
-           Split at lowest point instead.
-           Minimum 1 point will be in lower box.
-        */
+        if ((mask && mask[pidx[start_idx + i]]) || (leaf_mask && LEAF_MASKED(leaf_mask, start_idx + i)))
+        {
+            continue;
+        }
+        cur_dist = calc_dist_periodic_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims, boxsize);
+        if (cur_dist < closest_dist[KNN_WORST(k)])
+        {
+            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[start_idx + i], cur_dist, k);
+        }
+    }
+}
 
-        u${ITYPE} j = start_idx;
-        split = PA(j, dim);
-        for (i2 = start_idx + 1; i2 <= end_idx; i2++)
+/************************************************
+Search subtree for nearest to query point in a periodic box.
+The distances of the query point to both children along the cut
+dimension are computed with wrapping, the child closest to the
+query point is searched first.
+Params:
+    root : root node of subtree
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    point_coord : query point, inside the box
+    boxsize : side lengths of the box
+    min_dist : minumum distance to nearest neighbour
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_splitnode_periodic_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                               ${DTYPE} *boxsize, ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask,
+                               u${ITYPE} *closest_idx, ${DTYPE} *closest_dist)
+{
+    int8_t dim;
+    ${DTYPE} coord, box_diff, left_diff, right_diff, dist_left, dist_right;
+
+    /* Skip if distance bound exeeded */
+    if (min_dist > distance_upper_bound)
+    {
+        return;
+    }
+
+    dim = root->cut_dim;
+
+    /* Handle leaf node */
+    if (dim == -1)
+    {
+        search_leaf_periodic_${DTYPE}_${ITYPE}(pa, pidx, no_dims, root->start_idx, root->n, point_coord, boxsize, k, mask, leaf_mask, closest_idx, closest_dist);
+        return;
+    }
+
+    /* Replace the distance to this node along the cut dimension
+       with the distances to the children */
+    coord = point_coord[dim];
+    box_diff = get_interval_dist_periodic_${DTYPE}(coord, root->cut_bounds_lv, root->cut_bounds_hv, boxsize[dim]);
+    left_diff = get_interval_dist_periodic_${DTYPE}(coord, root->cut_bounds_lv, root->cut_val, boxsize[dim]);
+    right_diff = get_interval_dist_periodic_${DTYPE}(coord, root->cut_val, root->cut_bounds_hv, boxsize[dim]);
+    dist_left = min_dist - box_diff * box_diff + left_diff * left_diff;
+    dist_right = min_dist - box_diff * box_diff + right_diff * right_diff;
+
+    if (dist_left <= dist_right)
+    {
+        if (dist_left < closest_dist[KNN_WORST(k)] * eps_fac)
         {
-            /* Find lowest point */
-            cur_val = PA(i2, dim);
-            if (cur_val < split)
+            search_splitnode_periodic_${DTYPE}_${ITYPE}(root + 1, pa, pidx, no_dims, point_coord, boxsize, dist_left, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+        }
+        if (dist_right < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            search_splitnode_periodic_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, no_dims, point_coord, boxsize, dist_right, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+        }
+    }
+    else
+    {
+        if (dist_right < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            search_splitnode_periodic_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, no_dims, point_coord, boxsize, dist_right, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+        }
+        if (dist_left < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            search_splitnode_periodic_${DTYPE}_${ITYPE}(root + 1, pa, pidx, no_dims, point_coord, boxsize, dist_left, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+        }
+    }
+}
+
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
+/************************************************
+Search a leaf node for closest point in the ${NORM.upper()} norm${' with weighted dimensions' if WEIGHTED else ''}
+Params:
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    p : order of the norm
+    weights : factors of the coordinate differences
+    k : number of neighbours
+    mask : boolean array of invalid (True) and valid (False) data points, not used if NULL
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_leaf_${M}_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                    ${DTYPE} p, ${DTYPE} *weights, u${ITYPE} k, uint8_t *mask, uint8_t *leaf_mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+{
+    ${DTYPE} cur_dist;
+    u${ITYPE} i;
+    for (i = 0; i < n; i++)
+    {
+        if ((mask && mask[pidx[start_idx + i]]) || (leaf_mask && LEAF_MASKED(leaf_mask, start_idx + i)))
+        {
+            continue;
+        }
+        cur_dist = calc_dist_${M}_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims, p, weights);
+        if (cur_dist < closest_dist[KNN_WORST(k)])
+        {
+            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[start_idx + i], cur_dist, k);
+        }
+    }
+}
+
+/************************************************
+Search subtree for nearest to query point in the ${NORM.upper()} norm${' with weighted dimensions' if WEIGHTED else ''}
+Params:
+    root : root node of subtree
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    point_coord : query point
+    p : order of the norm
+    weights : factors of the coordinate differences
+    min_dist : minumum distance to nearest neighbour
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    closest_idx : index of closest data point found (return)
+    closest_dist : distance to closest point (return)
+************************************************/
+void search_splitnode_${M}_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                         ${DTYPE} p, ${DTYPE} *weights, ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask,
+                         u${ITYPE} *closest_idx, ${DTYPE} *closest_dist)
+{
+    int8_t dim;
+    ${DTYPE} new_offset;
+    ${DTYPE} box_diff;
+    Node_${DTYPE}_${ITYPE} *far_child;
+
+    /* Skip if distance bound exeeded */
+    if (min_dist > distance_upper_bound)
+    {
+        return;
+    }
+
+    dim = root->cut_dim;
+
+    /* Handle leaf node */
+    if (dim == -1)
+    {
+        search_leaf_${M}_${DTYPE}_${ITYPE}(pa, pidx, no_dims, root->start_idx, root->n, point_coord, p, weights, k, mask, leaf_mask, closest_idx, closest_dist);
+        return;
+    }
+
+    /* Get distance to cutting plane */
+    new_offset = point_coord[dim] - root->cut_val;
+
+    if (new_offset < 0)
+    {
+        /* Left of cutting plane */
+        if (min_dist < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            search_splitnode_${M}_${DTYPE}_${ITYPE}(root + 1, pa, pidx, no_dims, point_coord, p, weights, min_dist, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+        }
+        box_diff = root->cut_bounds_lv - point_coord[dim];
+        far_child = root + root->right_child;
+    }
+    else
+    {
+        /* Right of cutting plane */
+        if (min_dist < closest_dist[KNN_WORST(k)] * eps_fac)
+        {
+            search_splitnode_${M}_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, no_dims, point_coord, p, weights, min_dist, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+        }
+        box_diff = point_coord[dim] - root->cut_bounds_hv;
+        far_child = root + 1;
+    }
+
+    /* Other side of cutting plane. Update minimum distance. */
+    if (box_diff < 0)
+    {
+        box_diff = 0;
+    }
+% if WEIGHTED:
+    box_diff *= weights[dim];
+    new_offset *= weights[dim];
+% endif
+    min_dist = ${replace_term(NORM, DTYPE, 'min_dist', 'box_diff', 'new_offset')};
+    if (min_dist < closest_dist[KNN_WORST(k)] * eps_fac)
+    {
+        /* Search other subtree if minimum distance is below limit */
+        search_splitnode_${M}_${DTYPE}_${ITYPE}(far_child, pa, pidx, no_dims, point_coord, p, weights, min_dist, k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+    }
+}
+
+% endfor
+/************************************************
+Search for nearest neighbour for a set of query points
+Params:
+    tree : Tree struct of kd tree
+    pa : data points
+    pidx : permutation index of data points
+    point_coords : query points
+    point_type : POINT_TYPE_* of the query points
+    point_stride : distance in bytes between query points
+    dim_stride : distance in bytes between coordinates of a query point
+    num_points : number of query points
+    k : number of neighbours
+    offsets : number of neighbours per query point in compressed sparse row layout,
+              not used if NULL. The neighbours of query point i are written to
+              offsets[i]:offsets[i + 1] of closest_idx and closest_dist.
+    distance_upper_bound : squared distance upper bound
+    distance_upper_bounds : squared distance upper bound per query point,
+                            not used if NULL
+    eps : approximation factor
+    norm : NORM_* of the distances, or'ed with NORM_WEIGHTED if weights are used.
+           The distance upper bounds are the p-th power of the distance,
+           or the distance for NORM_L1 and NORM_LINF.
+    p : order of the norm for NORM_LP
+    weights : factors of the coordinate differences for NORM_WEIGHTED
+    mask : boolean array of invalid (True) and valid (False) data points.
+           If NULL the mask of the tree set by build_mask is used.
+    closest_idxs : index of closest data point found (return)
+    idx_size : size in bytes of the elements of closest_idxs, 4 or 8. Indices of
+               another size than u${ITYPE} are searched in a buffer and converted.
+    idxs_stride : distance in elements between the rows of closest_idxs, not used with offsets
+    closest_dists : distance to closest point (return), not returned if NULL
+    dists_stride : distance in elements between the rows of closest_dists, not used with offsets
+    mark_out_of_bounds, out_of_bounds_idx : see finish_points
+    sqr_dists : return the distances in the form used internally
+    stats : NUM_STATS counters per query point, not collected if NULL (return).
+            Only collected for NORM_L2 without boxsize.
+    thread_times : seconds spent searching by each thread, not measured if NULL (return)
+    reorder_queries : search the query points in the order of morton_order.
+                      The results are still written in the order of the query points.
+    max_leaves, max_checks : search in best-bin-first order and stop after this
+                             many leaves or distance computations, see search_bbf.
+                             No limit if 0. Only used for NORM_L2 without boxsize.
+For trees with a sphere_radius the query points are longitude and latitude
+and the distances returned are great-circle distances on the sphere.
+************************************************/
+void search_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, const char *point_coords,
+                 int point_type, int64_t point_stride, int64_t dim_stride,
+                 u${ITYPE} num_points, u${ITYPE} k, int64_t *offsets,
+                 ${DTYPE} distance_upper_bound, ${DTYPE} *distance_upper_bounds,
+                 ${DTYPE} eps, int norm, ${DTYPE} p, ${DTYPE} *weights, uint8_t *mask, void *closest_idxs, int idx_size, uint64_t idxs_stride,
+                 ${DTYPE} *closest_dists, uint64_t dists_stride,
+                 int mark_out_of_bounds, u${ITYPE} out_of_bounds_idx, int sqr_dists,
+                 uint64_t *stats, double *thread_times, int reorder_queries,
+                 uint64_t max_leaves, uint64_t max_checks)
+{
+    ${DTYPE} min_dist;
+    ${DTYPE} eps_fac = get_eps_fac_${DTYPE}(eps, norm, p);
+    int8_t no_dims = tree->no_dims;
+    ${DTYPE} *bbox = tree->bbox;
+    u${ITYPE} *pidx = tree->pidx;
+    /* use 64-bit ints for indexing to avoid overflow, use signed ints to support all Openmp implementations */
+    int64_t i = 0;
+    int64_t j = 0;
+    int64_t local_num_points = (int64_t) num_points;
+    Node_${DTYPE}_${ITYPE} *root = tree->nodes;
+    int convert_idxs = idx_size != sizeof(u${ITYPE});
+    u${ITYPE} max_k = k;
+    /* A mask of the query replaces the mask of the tree */
+    uint8_t *leaf_mask = mask ? NULL : tree->leaf_mask;
+    uint8_t *node_masked = mask ? NULL : tree->node_masked;
+    int64_t *order = NULL;
+    ${DTYPE} sphere_radius = tree->sphere_radius;
+
+    if (sphere_radius > 0)
+    {
+        point_type |= POINT_LONLAT;
+    }
+    if (offsets && (convert_idxs || !closest_dists))
+    {
+        max_k = 0;
+        for (i = 0; i < local_num_points; i++)
+        {
+            if (offsets[i + 1] - offsets[i] > (int64_t)max_k)
+            {
+                max_k = (u${ITYPE})(offsets[i + 1] - offsets[i]);
+            }
+        }
+    }
+
+    if (reorder_queries)
+    {
+        order = morton_order_${DTYPE}(bbox, no_dims, point_coords, point_type, point_stride, dim_stride, local_num_points);
+    }
+
+    /* Queries are OpenMP enabled */
+    #pragma omp parallel
+    {
+        ${DTYPE} point_buf[127];
+        ${DTYPE} *point_coord;
+        double start_time = thread_times ? OMP_WTIME() : 0;
+        /* Neighbours that are not returned as they are searched are collected here */
+        u${ITYPE} *idx_buf = convert_idxs ? (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * max_k) : NULL;
+        ${DTYPE} *dist_buf = closest_dists ? NULL : (${DTYPE} *)malloc(sizeof(${DTYPE}) * max_k);
+        NodeQueue_${DTYPE}_${ITYPE} queue = {NULL, 0, 0};
+
+        /* The low chunk size is important to avoid L2 cache trashing
+           for spatial coherent query datasets.
+           The schedule is set per call by set_parallel_options.
+        */
+#ifdef KDTREE_OMP_SCHEDULE
+        #pragma omp for private(i, j, min_dist) schedule(runtime) nowait
+#else
+        #pragma omp for private(i, j, min_dist) schedule(static, 100) nowait
+#endif
+        for (i = 0; i < local_num_points; i++)
+        {
+            /* Position of the query point and its results */
+            int64_t q = order ? order[i] : i;
+            int64_t idx_offset = q * idxs_stride;
+            int64_t dist_offset = q * dists_stride;
+            u${ITYPE} *closest_idx;
+            ${DTYPE} *closest_dist;
+            u${ITYPE} point_k = k;
+            ${DTYPE} point_upper_bound = distance_upper_bound;
+            if (offsets)
+            {
+                idx_offset = offsets[q];
+                dist_offset = offsets[q];
+                point_k = (u${ITYPE})(offsets[q + 1] - offsets[q]);
+                if (point_k == 0)
+                {
+                    continue;
+                }
+            }
+            closest_idx = idx_buf ? idx_buf : (u${ITYPE} *)closest_idxs + idx_offset;
+            closest_dist = dist_buf ? dist_buf : closest_dists + dist_offset;
+            if (distance_upper_bounds)
+            {
+                point_upper_bound = distance_upper_bounds[q];
+            }
+            /* Start from the upper bound so it prunes the search from the start.
+               Neighbours not found keep it and are marked by finish_points. */
+            for (j = 0; j < point_k; j++)
+            {
+                closest_idx[j] = IDX_MAX_${ITYPE};
+                closest_dist[j] = point_upper_bound;
+            }
+            point_coord = load_point_${DTYPE}(point_coords + q * point_stride, point_type, dim_stride, no_dims, point_buf);
+            if (tree->boxsize)
+            {
+                point_coord = wrap_point_${DTYPE}(point_coord, no_dims, tree->boxsize, point_buf);
+                min_dist = get_min_dist_periodic_${DTYPE}(point_coord, no_dims, bbox, tree->boxsize);
+                search_splitnode_periodic_${DTYPE}_${ITYPE}(root, pa, pidx, no_dims, point_coord, tree->boxsize, min_dist,
+                                          point_k, point_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+            }
+            else if (norm == NORM_L2 && (max_leaves || max_checks))
+            {
+                min_dist = get_min_dist_${DTYPE}(point_coord, no_dims, bbox);
+                search_bbf_${DTYPE}_${ITYPE}(root, pa, pidx, tree->leaf_data, no_dims, point_coord, min_dist,
+                           point_k, point_upper_bound, eps_fac, mask, leaf_mask, node_masked,
+                           max_leaves, max_checks, &queue, closest_idx, closest_dist,
+                           stats ? stats + q * NUM_STATS : NULL);
+            }
+            else if (norm == NORM_L2 && stats)
+            {
+                min_dist = get_min_dist_${DTYPE}(point_coord, no_dims, bbox);
+                search_splitnode_stats_${DTYPE}_${ITYPE}(root, pa, pidx, tree->leaf_data, no_dims, point_coord, min_dist,
+                                       point_k, point_upper_bound, eps_fac, mask, leaf_mask, node_masked,
+                                       closest_idx, closest_dist, stats + q * NUM_STATS);
+            }
+            else if (norm == NORM_L2)
+            {
+                min_dist = get_min_dist_${DTYPE}(point_coord, no_dims, bbox);
+                search_splitnode_${DTYPE}_${ITYPE}(root, pa, pidx, tree->leaf_data, no_dims, point_coord, min_dist,
+                                 point_k, point_upper_bound, eps_fac, mask, leaf_mask, node_masked,
+                                 closest_idx, closest_dist);
+            }
+            else
             {
-                j = i2;
-                split = cur_val;
+                switch (norm)
+                {
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
+                case ${metric_case(NORM, WEIGHTED)}:
+                    min_dist = get_min_dist_${M}_${DTYPE}(point_coord, no_dims, bbox, p, weights);
+                    search_splitnode_${M}_${DTYPE}_${ITYPE}(root, pa, pidx, no_dims, point_coord, p, weights, min_dist,
+                                             point_k, point_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+                    break;
+% endfor
+                }
             }
-        }
-        PASWAP_${ITYPE}(j, start_idx);
-        p = start_idx + 1;
-    }
-    else if (p == end_idx + 1)
-    {
-        /* No points greater than split.
-           Split at highest point instead.
-           Minimum 1 point will be in higher box.
-        */
-
-        u${ITYPE} j = end_idx;
-        split = PA(j, dim);
-        for (i2 = start_idx; i2 < end_idx; i2++)
-        {
-            /* Find highest point */
-            cur_val = PA(i2, dim);
-            if (cur_val > split)
+            finish_points_${DTYPE}_${ITYPE}(closest_idx, closest_dist, point_k, point_upper_bound,
+                          mark_out_of_bounds, out_of_bounds_idx,
+                          sqr_dists || dist_buf || (norm & ~NORM_WEIGHTED) != NORM_L2 || sphere_radius > 0);
+            if (!sqr_dists && !dist_buf && (norm & ~NORM_WEIGHTED) == NORM_LP)
             {
-                j = i2;
-                split = cur_val;
+                for (j = 0; j < (int64_t)point_k; j++)
+                {
+                    closest_dist[j] = POW_${DTYPE}(closest_dist[j], 1 / p);
+                }
+            }
+            if (!sqr_dists && !dist_buf && sphere_radius > 0)
+            {
+                for (j = 0; j < (int64_t)point_k; j++)
+                {
+                    /* Neighbours out of bounds keep their infinite distance */
+                    if (closest_dist[j] < DIST_MAX_${DTYPE})
+                    {
+                        closest_dist[j] = chord_to_arc_${DTYPE}(closest_dist[j], sphere_radius);
+                    }
+                }
+            }
+            if (idx_buf)
+            {
+                for (j = 0; j < (int64_t)point_k; j++)
+                {
+                    if (idx_size == 4)
+                    {
+                        ((uint32_t *)closest_idxs)[idx_offset + j] = (uint32_t)idx_buf[j];
+                    }
+                    else
+                    {
+                        ((uint64_t *)closest_idxs)[idx_offset + j] = (uint64_t)idx_buf[j];
+                    }
+                }
             }
         }
-        PASWAP_${ITYPE}(j, end_idx);
-        p = end_idx;
+        free(idx_buf);
+        free(dist_buf);
+        free(queue.entries);
+        if (thread_times)
+        {
+            thread_times[OMP_THREAD_NUM()] = OMP_WTIME() - start_time;
+        }
     }
-
-    /* Set return values */
-    *cut_dim = dim;
-    *cut_val = split;
-    *n_lo = p - start_idx;
-    return 0;
+    free(order);
 }
 
 /************************************************
-Construct a sub tree over a range of data points.
+Find the k nearest neighbours of every data point of the tree.
+The leaves are processed one at a time. The distances between the points
+of a leaf are computed once and the neighbours of each point among them
+bound its search from the start, so the search only visits the nodes
+that can hold closer points.
 Params:
+    tree : Tree struct of kd tree
     pa : data points
-    pidx : permutation index of data points
-    no_dims: number of dimensions
-    start_idx : index of first data point to use
-    n :  number of data points
-    bsp : number of points per leaf
-    bbox : bounding box of set of data points
+    k : number of neighbours per data point
+    include_self : count each point as its own neighbour. Without it
+                   k + 1 neighbours are searched and the point is left out.
+                   Requires k < n, or k <= n with include_self.
+    sqr_dists : return the distances in the form used internally
+    idxs : neighbours of data point i in idxs[i * k:(i + 1) * k] (return)
+    idx_size : size in bytes of the signed integer elements of idxs, 4 or 8
+    dists : distances to the neighbours, laid out like idxs (return)
+For trees with a sphere_radius the distances are great-circle distances.
 ************************************************/
-Node_${DTYPE}_${ITYPE}* construct_subtree_${DTYPE}_${ITYPE}(${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, u${ITYPE} bsp, ${DTYPE} *bbox)
+void search_knn_graph_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, u${ITYPE} k, int include_self,
+                      int sqr_dists, void *idxs, int idx_size, ${DTYPE} *dists)
 {
-    /* Create new node */
-    int is_leaf = (n <= bsp);
-    Node_${DTYPE}_${ITYPE} *root = create_node_${DTYPE}_${ITYPE}(start_idx, n, is_leaf);
-    int rval;
-    int8_t cut_dim;
-    u${ITYPE} n_lo;
-    ${DTYPE} cut_val, lv, hv;
-    if (is_leaf)
-    {
-        /* Make leaf node */
-        root->cut_dim = -1;
-    }
-    else
+    int8_t no_dims = tree->no_dims;
+    u${ITYPE} *pidx = tree->pidx;
+    Node_${DTYPE}_${ITYPE} *root = tree->nodes;
+    u${ITYPE} search_k = include_self ? k : k + 1;
+    ${DTYPE} eps_fac = get_eps_fac_${DTYPE}(0, NORM_L2, 2);
+    /* Distances within a leaf and in the search may be rounded differently */
+    ${DTYPE} bound_fac = 1 + 64 * DIST_EPSILON_${DTYPE};
+    /* use 64-bit ints for indexing to avoid overflow, use signed ints to support all Openmp implementations */
+    int64_t node_num;
+    int64_t num_nodes = (int64_t)tree->num_nodes;
+
+    #pragma omp parallel
     {
-        /* Make split node */
-        /* Partition data set and set node info */
-        rval = partition_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n, bbox, &cut_dim, &cut_val, &n_lo);
-        if (rval == 1)
+        u${ITYPE} *closest_idx = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * search_k);
+        ${DTYPE} *closest_dist = (${DTYPE} *)malloc(sizeof(${DTYPE}) * search_k);
+        ${DTYPE} *leaf_dists = NULL;
+        uint64_t leaf_dists_size = 0;
+
+        /* Consecutive leaves hold nearby points, keep them on one thread */
+        #pragma omp for schedule(static, 64)
+        for (node_num = 0; node_num < num_nodes; node_num++)
         {
-            root->cut_dim = -1;
-            return root;
-        }
-        root->cut_val = cut_val;
-        root->cut_dim = cut_dim;
+            Node_${DTYPE}_${ITYPE} *node = root + node_num;
+            u${ITYPE} n = node->n;
+            u${ITYPE} start_idx = node->start_idx;
+            u${ITYPE} a, b, j, m;
+            if (node->cut_dim != -1)
+            {
+                continue;
+            }
 
-        /* Recurse on both subsets */
-        lv = bbox[2 * cut_dim];
-        hv = bbox[2 * cut_dim + 1];
+            /* Distances between all points of the leaf, each computed once */
+            if ((uint64_t)n * n > leaf_dists_size)
+            {
+                leaf_dists_size = (uint64_t)n * n;
+                free(leaf_dists);
+                leaf_dists = (${DTYPE} *)malloc(sizeof(${DTYPE}) * leaf_dists_size);
+            }
+            for (a = 0; a < n; a++)
+            {
+                leaf_dists[(uint64_t)a * n + a] = 0;
+                for (b = a + 1; b < n; b++)
+                {
+                    ${DTYPE} cur_dist = calc_dist_${DTYPE}(&PA(start_idx + a, 0), &PA(start_idx + b, 0), no_dims);
+                    leaf_dists[(uint64_t)a * n + b] = cur_dist;
+                    leaf_dists[(uint64_t)b * n + a] = cur_dist;
+                }
+            }
 
-        /* Set bounds for cut dimension */
-        root->cut_bounds_lv = lv;
-        root->cut_bounds_hv = hv;
+            for (a = 0; a < n; a++)
+            {
+                u${ITYPE} point_idx = pidx[start_idx + a];
+                ${DTYPE} *point_coord = pa + (uint64_t)point_idx * no_dims;
+                ${DTYPE} bound = DIST_MAX_${DTYPE};
+                int64_t out_offset = (int64_t)point_idx * k;
+                int skip_self = !include_self;
 
-        /* Update bounding box before call to lower subset and restore after */
-        bbox[2 * cut_dim + 1] = cut_val;
-        root->left_child = (struct Node_${DTYPE}_${ITYPE} *)construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx, n_lo, bsp, bbox);
-        bbox[2 * cut_dim + 1] = hv;
+                /* The search_k-th nearest point of the leaf bounds the search */
+                if (n >= search_k)
+                {
+                    for (j = 0; j < search_k; j++)
+                    {
+                        closest_idx[j] = IDX_MAX_${ITYPE};
+                        closest_dist[j] = DIST_MAX_${DTYPE};
+                    }
+                    for (b = 0; b < n; b++)
+                    {
+                        if (leaf_dists[(uint64_t)a * n + b] < closest_dist[KNN_WORST(search_k)])
+                        {
+                            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, b, leaf_dists[(uint64_t)a * n + b], search_k);
+                        }
+                    }
+                    bound = closest_dist[KNN_WORST(search_k)] * bound_fac + DIST_MIN_${DTYPE};
+                }
 
-        /* Update bounding box before call to higher subset and restore after */
-        bbox[2 * cut_dim] = cut_val;
-        root->right_child = (struct Node_${DTYPE}_${ITYPE} *)construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, start_idx + n_lo, n - n_lo, bsp, bbox);
-        bbox[2 * cut_dim] = lv;
+                for (j = 0; j < search_k; j++)
+                {
+                    closest_idx[j] = IDX_MAX_${ITYPE};
+                    closest_dist[j] = bound;
+                }
+                search_splitnode_${DTYPE}_${ITYPE}(root, pa, pidx, tree->leaf_data, no_dims, point_coord,
+                                 get_min_dist_${DTYPE}(point_coord, no_dims, tree->bbox), search_k, bound, eps_fac,
+                                 NULL, NULL, NULL, closest_idx, closest_dist);
+                sort_points_${DTYPE}_${ITYPE}(closest_idx, closest_dist, search_k);
+
+                /* Leave out the point itself, or the last neighbour if
+                   the point is hidden among neighbours at distance 0 */
+                for (j = 0, m = 0; j < search_k && m < k; j++)
+                {
+                    ${DTYPE} cur_dist = closest_dist[j];
+                    if (skip_self && closest_idx[j] == point_idx)
+                    {
+                        skip_self = 0;
+                        continue;
+                    }
+                    if (!sqr_dists && tree->sphere_radius > 0)
+                    {
+                        cur_dist = chord_to_arc_${DTYPE}(cur_dist, tree->sphere_radius);
+                    }
+                    else if (!sqr_dists)
+                    {
+                        cur_dist = SQRT_${DTYPE}(cur_dist);
+                    }
+                    if (idx_size == 4)
+                    {
+                        ((int32_t *)idxs)[out_offset + m] = (int32_t)closest_idx[j];
+                    }
+                    else
+                    {
+                        ((int64_t *)idxs)[out_offset + m] = (int64_t)closest_idx[j];
+                    }
+                    dists[out_offset + m] = cur_dist;
+                    m++;
+                }
+            }
+        }
+        free(closest_idx);
+        free(closest_dist);
+        free(leaf_dists);
     }
-    return root;
 }
 
 /************************************************
-Construct a tree over data points.
+Interpolate values of the data points at the query points as the weighted
+average of the values of their k nearest neighbours. The weights are
+computed from the queue of each search, so neither the neighbours nor their
+distances are stored.
 Params:
+    tree : Tree struct of kd tree
     pa : data points
-    no_dims: number of dimensions
-    n :  number of data points
-    bsp : number of points per leaf
+    point_coords : query points
+    point_type : POINT_TYPE_* of the query points
+    point_stride : distance in bytes between query points
+    dim_stride : distance in bytes between coordinates of a query point
+    num_points : number of query points
+    k : number of neighbours
+    distance_upper_bound : squared distance upper bound, neighbours at or beyond it are not used
+    eps : approximation factor
+    mask : boolean array of invalid (True) and valid (False) data points.
+           If NULL the mask of the tree set by build_mask is used.
+    values : num_channels values per data point, in the order of the data points
+    num_channels : number of values per data point
+    weighting : WEIGHT_IDW, weight 1 / dist^weight_param. Query points at
+                distance 0 of data points get the average of their values.
+                WEIGHT_GAUSSIAN, weight exp(-dist^2 / (2 weight_param^2)).
+    weight_param : power of WEIGHT_IDW or sigma of WEIGHT_GAUSSIAN
+    fill_value : value of query points without neighbours or weights
+    out : num_channels values per query point (return)
+    reorder_queries : search the query points in the order of morton_order
+For trees with a sphere_radius the distances of the weights are great-circle distances.
 ************************************************/
-Tree_${DTYPE}_${ITYPE}* construct_tree_${DTYPE}_${ITYPE}(${DTYPE} *pa, int8_t no_dims, u${ITYPE} n, u${ITYPE} bsp)
+void interpolate_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, const char *point_coords,
+                      int point_type, int64_t point_stride, int64_t dim_stride,
+                      u${ITYPE} num_points, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps, uint8_t *mask,
+                      ${DTYPE} *values, int64_t num_channels, int weighting, double weight_param, ${DTYPE} fill_value,
+                      ${DTYPE} *out, int reorder_queries)
 {
-    Tree_${DTYPE}_${ITYPE} *tree = (Tree_${DTYPE}_${ITYPE} *)malloc(sizeof(Tree_${DTYPE}_${ITYPE}));
-    u${ITYPE} i;
-    u${ITYPE} *pidx;
-    ${DTYPE} *bbox;
-
-    tree->no_dims = no_dims;
+    ${DTYPE} eps_fac = get_eps_fac_${DTYPE}(eps, NORM_L2, 2);
+    int8_t no_dims = tree->no_dims;
+    ${DTYPE} *bbox = tree->bbox;
+    u${ITYPE} *pidx = tree->pidx;
+    Node_${DTYPE}_${ITYPE} *root = tree->nodes;
+    uint8_t *leaf_mask = mask ? NULL : tree->leaf_mask;
+    uint8_t *node_masked = mask ? NULL : tree->node_masked;
+    ${DTYPE} sphere_radius = tree->sphere_radius;
+    int64_t *order = NULL;
+    /* use 64-bit ints for indexing to avoid overflow, use signed ints to support all Openmp implementations */
+    int64_t i;
+    int64_t local_num_points = (int64_t)num_points;
 
-    /* Initialize permutation array */
-    pidx = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * n);
-    for (i = 0; i < n; i++)
+    if (sphere_radius > 0)
+    {
+        point_type |= POINT_LONLAT;
+    }
+    if (reorder_queries)
     {
-        pidx[i] = i;
+        order = morton_order_${DTYPE}(bbox, no_dims, point_coords, point_type, point_stride, dim_stride, local_num_points);
     }
 
-    bbox = (${DTYPE} *)malloc(2 * sizeof(${DTYPE}) * no_dims);
-    get_bounding_box_${DTYPE}_${ITYPE}(pa, pidx, no_dims, n, bbox);
-    tree->bbox = bbox;
+    #pragma omp parallel
+    {
+        ${DTYPE} point_buf[127];
+        ${DTYPE} *point_coord;
+        u${ITYPE} *closest_idx = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * k);
+        ${DTYPE} *closest_dist = (${DTYPE} *)malloc(sizeof(${DTYPE}) * k);
+        double *weights = (double *)malloc(sizeof(double) * k);
+        double *sums = (double *)malloc(sizeof(double) * num_channels);
 
-    /* Construct subtree on full dataset */
-    tree->root = (struct Node_${DTYPE}_${ITYPE} *)construct_subtree_${DTYPE}_${ITYPE}(pa, pidx, no_dims, 0, n, bsp, bbox);
+#ifdef KDTREE_OMP_SCHEDULE
+        #pragma omp for schedule(runtime)
+#else
+        #pragma omp for schedule(static, 100)
+#endif
+        for (i = 0; i < local_num_points; i++)
+        {
+            int64_t q = order ? order[i] : i;
+            int64_t c;
+            u${ITYPE} j;
+            int has_zero = 0;
+            double weight_sum = 0;
+            ${DTYPE} *point_out = out + q * num_channels;
 
-    tree->pidx = pidx;
-    return tree;
+            for (j = 0; j < k; j++)
+            {
+                closest_idx[j] = IDX_MAX_${ITYPE};
+                closest_dist[j] = distance_upper_bound;
+            }
+            point_coord = load_point_${DTYPE}(point_coords + q * point_stride, point_type, dim_stride, no_dims, point_buf);
+            if (tree->boxsize)
+            {
+                point_coord = wrap_point_${DTYPE}(point_coord, no_dims, tree->boxsize, point_buf);
+                search_splitnode_periodic_${DTYPE}_${ITYPE}(root, pa, pidx, no_dims, point_coord, tree->boxsize,
+                                          get_min_dist_periodic_${DTYPE}(point_coord, no_dims, bbox, tree->boxsize),
+                                          k, distance_upper_bound, eps_fac, mask, leaf_mask, closest_idx, closest_dist);
+            }
+            else
+            {
+                search_splitnode_${DTYPE}_${ITYPE}(root, pa, pidx, tree->leaf_data, no_dims, point_coord,
+                                 get_min_dist_${DTYPE}(point_coord, no_dims, bbox), k, distance_upper_bound, eps_fac,
+                                 mask, leaf_mask, node_masked, closest_idx, closest_dist);
+            }
+
+            /* The order of the neighbours in the queue does not matter for the average.
+               Entries never filled keep IDX_MAX and get no weight. */
+            for (j = 0; j < k; j++)
+            {
+                double sqr_dist = closest_dist[j];
+                if (closest_idx[j] == IDX_MAX_${ITYPE})
+                {
+                    weights[j] = 0;
+                    continue;
+                }
+                if (sphere_radius > 0)
+                {
+                    double arc = chord_to_arc_${DTYPE}(closest_dist[j], sphere_radius);
+                    sqr_dist = arc * arc;
+                }
+                if (weighting == WEIGHT_GAUSSIAN)
+                {
+                    weights[j] = exp(-sqr_dist / (2 * weight_param * weight_param));
+                }
+                else if (sqr_dist == 0)
+                {
+                    weights[j] = 1;
+                    has_zero = 1;
+                }
+                else if (weight_param == 2)
+                {
+                    weights[j] = 1 / sqr_dist;
+                }
+                else
+                {
+                    weights[j] = pow(sqr_dist, -0.5 * weight_param);
+                }
+            }
+            if (has_zero)
+            {
+                /* Data points at the query point take all the weight */
+                for (j = 0; j < k; j++)
+                {
+                    if (closest_dist[j] != 0)
+                    {
+                        weights[j] = 0;
+                    }
+                }
+            }
+
+            for (c = 0; c < num_channels; c++)
+            {
+                sums[c] = 0;
+            }
+            for (j = 0; j < k; j++)
+            {
+                ${DTYPE} *point_values;
+                if (weights[j] == 0)
+                {
+                    continue;
+                }
+                weight_sum += weights[j];
+                point_values = values + (int64_t)closest_idx[j] * num_channels;
+                for (c = 0; c < num_channels; c++)
+                {
+                    sums[c] += weights[j] * point_values[c];
+                }
+            }
+            for (c = 0; c < num_channels; c++)
+            {
+                point_out[c] = weight_sum > 0 ? (${DTYPE})(sums[c] / weight_sum) : fill_value;
+            }
+        }
+        free(closest_idx);
+        free(closest_dist);
+        free(weights);
+        free(sums);
+    }
+    free(order);
 }
 
 /************************************************
-Create a tree node.
+Append a neighbour to a result array
 Params:
-    start_idx : index of first data point to use
-    n :  number of data points
+    results : result array
+    idx : index of data point
+    dist : distance to data point
 ************************************************/
-Node_${DTYPE}_${ITYPE}* create_node_${DTYPE}_${ITYPE}(u${ITYPE} start_idx, u${ITYPE} n, int is_leaf)
+void append_result_${DTYPE}_${ITYPE}(ResultArray_${DTYPE}_${ITYPE} *results, u${ITYPE} idx, ${DTYPE} dist)
 {
-    Node_${DTYPE}_${ITYPE} *new_node;
-    if (is_leaf)
+    if (results->size == results->capacity)
     {
-        /*
-            Allocate only the part of the struct that will be used in a leaf node.
-            This relies on the C99 specification of struct layout conservation and padding and
-            that dereferencing is never attempted for the node pointers in a leaf.
-        */
-        new_node = (Node_${DTYPE}_${ITYPE} *)malloc(sizeof(Node_${DTYPE}_${ITYPE}) - 2 * sizeof(Node_${DTYPE}_${ITYPE} *));
+        results->capacity *= 2;
+        results->idxs = (u${ITYPE} *)realloc(results->idxs, sizeof(u${ITYPE}) * results->capacity);
+        if (results->dists != NULL)
+        {
+            results->dists = (${DTYPE} *)realloc(results->dists, sizeof(${DTYPE}) * results->capacity);
+        }
     }
-    else
+    results->idxs[results->size] = idx;
+    if (results->dists != NULL)
     {
-        new_node = (Node_${DTYPE}_${ITYPE} *)malloc(sizeof(Node_${DTYPE}_${ITYPE}));
+        results->dists[results->size] = dist;
     }
-    new_node->n = n;
-    new_node->start_idx = start_idx;
-    return new_node;
+    results->size++;
 }
 
 /************************************************
-Delete subtree
+Search a leaf node for all points within radius
 Params:
-    root : root node of subtree to delete
+    pa : data points
+    pidx : permutation index of data points
+    leaf_data : leaf ordered copy of data points, not used if NULL
+    no_dims : number of dimensions
+    start_idx : index of first data point to use
+    size :  number of data points
+    point_coord : query point
+    radius : squared search radius
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    results : neighbours found (return)
 ************************************************/
-void delete_subtree_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root)
+void search_leaf_ball_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, ${DTYPE} *restrict leaf_data, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                      ${DTYPE} radius, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results)
 {
-    if (root->cut_dim != -1)
+    ${DTYPE} cur_dist;
+    u${ITYPE} i, offset;
+    int j, m;
+    ${DTYPE} dists[LEAF_BLOCK_SIZE];
+
+    if (leaf_data)
+    {
+        /* Score blocks of points of the leaf ordered copy of the data points */
+        for (offset = 0; offset < n; offset += LEAF_BLOCK_SIZE)
+        {
+            m = (n - offset < LEAF_BLOCK_SIZE) ? (int)(n - offset) : LEAF_BLOCK_SIZE;
+            calc_block_dists_${DTYPE}(leaf_data + (uint64_t)start_idx * no_dims + offset, n, m, no_dims, point_coord, dists);
+            for (j = 0; j < m; j++)
+            {
+                i = start_idx + offset + j;
+                if (dists[j] <= radius && !(mask && mask[pidx[i]]) && !(leaf_mask && LEAF_MASKED(leaf_mask, i)))
+                {
+                    append_result_${DTYPE}_${ITYPE}(results, pidx[i], dists[j]);
+                }
+            }
+        }
+        return;
+    }
+
+    /* Loop through all points in leaf */
+    for (i = 0; i < n; i++)
     {
-        delete_subtree_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->left_child);
-        delete_subtree_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->right_child);
+        /* Is this point masked out? */
+        if ((mask && mask[pidx[start_idx + i]]) || (leaf_mask && LEAF_MASKED(leaf_mask, start_idx + i)))
+        {
+            continue;
+        }
+        /* Get distance to query point */
+        cur_dist = calc_dist_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims);
+        if (cur_dist <= radius)
+        {
+            append_result_${DTYPE}_${ITYPE}(results, pidx[start_idx + i], cur_dist);
+        }
     }
-    free(root);
 }
 
 /************************************************
-Delete tree
+Search subtree for all points within radius of query point
 Params:
-    tree : Tree struct of kd tree
+    root : root node of subtree
+    pa : data points
+    pidx : permutation index of data points
+    leaf_data : leaf ordered copy of data points, not used if NULL
+    no_dims : number of dimensions
+    point_coord : query point
+    min_dist : minumum distance to nearest neighbour
+    radius : squared search radius
+    eps_fac : subtrees further away than radius * eps_fac are skipped
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    node_masked : fully masked flags of root and its subtree, not used if NULL
+    results : neighbours found (return)
 ************************************************/
-void delete_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree)
+void search_splitnode_ball_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, ${DTYPE} *leaf_data, int8_t no_dims, ${DTYPE} *point_coord,
+                           ${DTYPE} min_dist, ${DTYPE} radius, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, uint8_t *node_masked,
+                           ResultArray_${DTYPE}_${ITYPE} *results)
 {
-    delete_subtree_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)tree->root);
-    free(tree->bbox);
-    free(tree->pidx);
-    free(tree);
-}
+    int8_t dim;
+    ${DTYPE} new_offset;
+    ${DTYPE} box_diff;
 
-/************************************************
-Print
-************************************************/
-void print_tree_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, int level)
-{
-    int i;
-    for (i = 0; i < level; i++)
+    /* Skip if subtree is outside search radius or all its points are masked */
+    if (min_dist > radius * eps_fac || (node_masked && node_masked[0]))
     {
-        printf(" ");
+        return;
+    }
+
+    dim = root->cut_dim;
+
+    /* Handle leaf node */
+    if (dim == -1)
+    {
+        search_leaf_ball_${DTYPE}_${ITYPE}(pa, pidx, leaf_data, no_dims, root->start_idx, root->n, point_coord, radius, mask, leaf_mask, results);
+        return;
+    }
+
+    /* Get distance to cutting plane */
+    new_offset = point_coord[dim] - root->cut_val;
+
+    if (new_offset < 0)
+    {
+        /* Left of cutting plane */
+        search_splitnode_ball_${DTYPE}_${ITYPE}(root + 1, pa, pidx, leaf_data, no_dims, point_coord, min_dist, radius, eps_fac, mask, leaf_mask,
+                              node_masked ? node_masked + 1 : NULL, results);
+
+        /* Right of cutting plane. Update minimum distance. */
+        box_diff = root->cut_bounds_lv - point_coord[dim];
+        if (box_diff < 0)
+        {
+            box_diff = 0;
+        }
+        search_splitnode_ball_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, leaf_data, no_dims, point_coord,
+                              min_dist - box_diff * box_diff + new_offset * new_offset, radius, eps_fac, mask, leaf_mask,
+                              node_masked ? node_masked + root->right_child : NULL, results);
+    }
+    else
+    {
+        /* Right of cutting plane */
+        search_splitnode_ball_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, leaf_data, no_dims, point_coord, min_dist, radius, eps_fac, mask, leaf_mask,
+                              node_masked ? node_masked + root->right_child : NULL, results);
+
+        /* Left of cutting plane. Update minimum distance. */
+        box_diff = point_coord[dim] - root->cut_bounds_hv;
+        if (box_diff < 0)
+        {
+            box_diff = 0;
+        }
+        search_splitnode_ball_${DTYPE}_${ITYPE}(root + 1, pa, pidx, leaf_data, no_dims, point_coord,
+                              min_dist - box_diff * box_diff + new_offset * new_offset, radius, eps_fac, mask, leaf_mask,
+                              node_masked ? node_masked + 1 : NULL, results);
     }
-    printf("(cut_val: %f, cut_dim: %i)\n", root->cut_val, root->cut_dim);
-    if (root->cut_dim != -1)
-        print_tree_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->left_child, level + 1);
-    if (root->cut_dim != -1)
-        print_tree_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->right_child, level + 1);
 }
 
 /************************************************
-Search a leaf node for closest point
+Search a leaf node for all points within radius in a periodic box
 Params:
     pa : data points
     pidx : permutation index of data points
@@ -538,30 +3534,82 @@ Params:
     start_idx : index of first data point to use
     size :  number of data points
     point_coord : query point
-    closest_idx : index of closest data point found (return)
-    closest_dist : distance to closest point (return)
+    boxsize : side lengths of the box
+    radius : squared search radius
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    results : neighbours found (return)
 ************************************************/
-void search_leaf_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
-                 u${ITYPE} k, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+void search_leaf_ball_periodic_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                               ${DTYPE} *boxsize, ${DTYPE} radius, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results)
 {
     ${DTYPE} cur_dist;
     u${ITYPE} i;
-    /* Loop through all points in leaf */
     for (i = 0; i < n; i++)
-    {
-        /* Get distance to query point */
-        cur_dist = calc_dist_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims);
-        /* Update closest info if new point is closest so far*/
-        if (cur_dist < closest_dist[k - 1])
+    {
+        if ((mask && mask[pidx[start_idx + i]]) || (leaf_mask && LEAF_MASKED(leaf_mask, start_idx + i)))
         {
-            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[start_idx + i], cur_dist, k);
+            continue;
+        }
+        cur_dist = calc_dist_periodic_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims, boxsize);
+        if (cur_dist <= radius)
+        {
+            append_result_${DTYPE}_${ITYPE}(results, pidx[start_idx + i], cur_dist);
         }
     }
 }
 
+/************************************************
+Search subtree for all points within radius of query point in a periodic box
+Params:
+    root : root node of subtree
+    pa : data points
+    pidx : permutation index of data points
+    no_dims : number of dimensions
+    point_coord : query point, inside the box
+    boxsize : side lengths of the box
+    min_dist : minumum distance to nearest neighbour
+    radius : squared search radius
+    eps_fac : subtrees further away than radius * eps_fac are skipped
+    mask : boolean array of invalid (True) and valid (False) data points
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    results : neighbours found (return)
+************************************************/
+void search_splitnode_ball_periodic_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                                    ${DTYPE} *boxsize, ${DTYPE} min_dist, ${DTYPE} radius, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results)
+{
+    int8_t dim;
+    ${DTYPE} coord, box_diff, left_diff, right_diff;
+
+    /* Skip if subtree is outside search radius */
+    if (min_dist > radius * eps_fac)
+    {
+        return;
+    }
+
+    dim = root->cut_dim;
+
+    /* Handle leaf node */
+    if (dim == -1)
+    {
+        search_leaf_ball_periodic_${DTYPE}_${ITYPE}(pa, pidx, no_dims, root->start_idx, root->n, point_coord, boxsize, radius, mask, leaf_mask, results);
+        return;
+    }
+
+    coord = point_coord[dim];
+    box_diff = get_interval_dist_periodic_${DTYPE}(coord, root->cut_bounds_lv, root->cut_bounds_hv, boxsize[dim]);
+    left_diff = get_interval_dist_periodic_${DTYPE}(coord, root->cut_bounds_lv, root->cut_val, boxsize[dim]);
+    right_diff = get_interval_dist_periodic_${DTYPE}(coord, root->cut_val, root->cut_bounds_hv, boxsize[dim]);
+    search_splitnode_ball_periodic_${DTYPE}_${ITYPE}(root + 1, pa, pidx, no_dims, point_coord, boxsize,
+                                   min_dist - box_diff * box_diff + left_diff * left_diff, radius, eps_fac, mask, leaf_mask, results);
+    search_splitnode_ball_periodic_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, no_dims, point_coord, boxsize,
+                                   min_dist - box_diff * box_diff + right_diff * right_diff, radius, eps_fac, mask, leaf_mask, results);
+}
 
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
 /************************************************
-Search a leaf node for closest point with data point mask
+Search a leaf node for all points within radius in the ${NORM.upper()} norm${' with weighted dimensions' if WEIGHTED else ''}
 Params:
     pa : data points
     pidx : permutation index of data points
@@ -569,57 +3617,60 @@ Params:
     start_idx : index of first data point to use
     size :  number of data points
     point_coord : query point
+    p : order of the norm
+    weights : factors of the coordinate differences
+    radius : search radius in the form returned by calc_dist_${M}_${DTYPE}
     mask : boolean array of invalid (True) and valid (False) data points
-    closest_idx : index of closest data point found (return)
-    closest_dist : distance to closest point (return)
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    results : neighbours found (return)
 ************************************************/
-void search_leaf_${DTYPE}_${ITYPE}_mask(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
-                               u${ITYPE} k, uint8_t *mask, u${ITYPE} *restrict closest_idx, ${DTYPE} *restrict closest_dist)
+void search_leaf_ball_${M}_${DTYPE}_${ITYPE}(${DTYPE} *restrict pa, u${ITYPE} *restrict pidx, int8_t no_dims, u${ITYPE} start_idx, u${ITYPE} n, ${DTYPE} *restrict point_coord,
+                         ${DTYPE} p, ${DTYPE} *weights, ${DTYPE} radius, uint8_t *mask, uint8_t *leaf_mask, ResultArray_${DTYPE}_${ITYPE} *results)
 {
     ${DTYPE} cur_dist;
     u${ITYPE} i;
-    /* Loop through all points in leaf */
     for (i = 0; i < n; i++)
     {
-        /* Is this point masked out? */
-        if (mask[pidx[start_idx + i]])
+        if ((mask && mask[pidx[start_idx + i]]) || (leaf_mask && LEAF_MASKED(leaf_mask, start_idx + i)))
         {
             continue;
         }
-        /* Get distance to query point */
-        cur_dist = calc_dist_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims);
-        /* Update closest info if new point is closest so far*/
-        if (cur_dist < closest_dist[k - 1])
+        cur_dist = calc_dist_${M}_${DTYPE}(&PA(start_idx + i, 0), point_coord, no_dims, p, weights);
+        if (cur_dist <= radius)
         {
-            insert_point_${DTYPE}_${ITYPE}(closest_idx, closest_dist, pidx[start_idx + i], cur_dist, k);
+            append_result_${DTYPE}_${ITYPE}(results, pidx[start_idx + i], cur_dist);
         }
     }
 }
 
 /************************************************
-Search subtree for nearest to query point
+Search subtree for all points within radius of query point in the ${NORM.upper()} norm${' with weighted dimensions' if WEIGHTED else ''}
 Params:
     root : root node of subtree
     pa : data points
     pidx : permutation index of data points
     no_dims : number of dimensions
     point_coord : query point
+    p : order of the norm
+    weights : factors of the coordinate differences
     min_dist : minumum distance to nearest neighbour
+    radius : search radius in the form returned by calc_dist_${M}_${DTYPE}
+    eps_fac : subtrees further away than radius * eps_fac are skipped
     mask : boolean array of invalid (True) and valid (False) data points
-    closest_idx : index of closest data point found (return)
-    closest_dist : distance to closest point (return)
+    leaf_mask : bit-packed mask of the data points in leaf order, not used if NULL
+    results : neighbours found (return)
 ************************************************/
-void search_splitnode_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord, 
-                      ${DTYPE} min_dist, u${ITYPE} k, ${DTYPE} distance_upper_bound, ${DTYPE} eps_fac, uint8_t *mask,
-                      u${ITYPE} *closest_idx, ${DTYPE} *closest_dist)
+void search_splitnode_ball_${M}_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *pa, u${ITYPE} *pidx, int8_t no_dims, ${DTYPE} *point_coord,
+                              ${DTYPE} p, ${DTYPE} *weights, ${DTYPE} min_dist, ${DTYPE} radius, ${DTYPE} eps_fac, uint8_t *mask, uint8_t *leaf_mask,
+                              ResultArray_${DTYPE}_${ITYPE} *results)
 {
     int8_t dim;
-    ${DTYPE} dist_left, dist_right;
     ${DTYPE} new_offset;
     ${DTYPE} box_diff;
+    Node_${DTYPE}_${ITYPE} *far_child;
 
-    /* Skip if distance bound exeeded */
-    if (min_dist > distance_upper_bound)
+    /* Skip if subtree is outside search radius */
+    if (min_dist > radius * eps_fac)
     {
         return;
     }
@@ -629,14 +3680,7 @@ void search_splitnode_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *
     /* Handle leaf node */
     if (dim == -1)
     {
-        if (mask)
-        {
-            search_leaf_${DTYPE}_${ITYPE}_mask(pa, pidx, no_dims, root->start_idx, root->n, point_coord, k, mask, closest_idx, closest_dist);
-        }
-        else
-        {
-            search_leaf_${DTYPE}_${ITYPE}(pa, pidx, no_dims, root->start_idx, root->n, point_coord, k, closest_idx, closest_dist);
-        }
+        search_leaf_ball_${M}_${DTYPE}_${ITYPE}(pa, pidx, no_dims, root->start_idx, root->n, point_coord, p, weights, radius, mask, leaf_mask, results);
         return;
     }
 
@@ -646,101 +3690,535 @@ void search_splitnode_${DTYPE}_${ITYPE}(Node_${DTYPE}_${ITYPE} *root, ${DTYPE} *
     if (new_offset < 0)
     {
         /* Left of cutting plane */
-        dist_left = min_dist;
-        if (dist_left < closest_dist[k - 1] * eps_fac)
-        {
-            /* Search left subtree if minimum distance is below limit */
-            search_splitnode_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->left_child, pa, pidx, no_dims, point_coord, dist_left, k, distance_upper_bound, eps_fac, mask, closest_idx, closest_dist);
-        }
-
-        /* Right of cutting plane. Update minimum distance.
-           See Algorithms for Fast Vector Quantization
-           Sunil Arya and David M. Mount. */
+        search_splitnode_ball_${M}_${DTYPE}_${ITYPE}(root + 1, pa, pidx, no_dims, point_coord, p, weights, min_dist, radius, eps_fac, mask, leaf_mask, results);
         box_diff = root->cut_bounds_lv - point_coord[dim];
-        if (box_diff < 0)
-        {
-		box_diff = 0;
-        }
-        dist_right = min_dist - box_diff * box_diff + new_offset * new_offset;
-        if (dist_right < closest_dist[k - 1] * eps_fac)
-        {
-            /* Search right subtree if minimum distance is below limit*/
-            search_splitnode_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->right_child, pa, pidx, no_dims, point_coord, dist_right, k, distance_upper_bound, eps_fac, mask, closest_idx, closest_dist);
-        }
+        far_child = root + root->right_child;
     }
     else
     {
         /* Right of cutting plane */
-        dist_right = min_dist;
-        if (dist_right < closest_dist[k - 1] * eps_fac)
-        {
-            /* Search right subtree if minimum distance is below limit*/
-            search_splitnode_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->right_child, pa, pidx, no_dims, point_coord, dist_right, k, distance_upper_bound, eps_fac, mask, closest_idx, closest_dist);
-        }
-
-        /* Left of cutting plane. Update minimum distance.
-           See Algorithms for Fast Vector Quantization
-           Sunil Arya and David M. Mount. */
+        search_splitnode_ball_${M}_${DTYPE}_${ITYPE}(root + root->right_child, pa, pidx, no_dims, point_coord, p, weights, min_dist, radius, eps_fac, mask, leaf_mask, results);
         box_diff = point_coord[dim] - root->cut_bounds_hv;
-        if (box_diff < 0)
-        {
-        	box_diff = 0;
-        }
-        dist_left = min_dist - box_diff * box_diff + new_offset * new_offset;
-	  if (dist_left < closest_dist[k - 1] * eps_fac)
-        {
-            /* Search left subtree if minimum distance is below limit*/
-            search_splitnode_${DTYPE}_${ITYPE}((Node_${DTYPE}_${ITYPE} *)root->left_child, pa, pidx, no_dims, point_coord, dist_left, k, distance_upper_bound, eps_fac, mask, closest_idx, closest_dist);
-        }
+        far_child = root + 1;
     }
+
+    /* Other side of cutting plane. Update minimum distance. */
+    if (box_diff < 0)
+    {
+        box_diff = 0;
+    }
+% if WEIGHTED:
+    box_diff *= weights[dim];
+    new_offset *= weights[dim];
+% endif
+    search_splitnode_ball_${M}_${DTYPE}_${ITYPE}(far_child, pa, pidx, no_dims, point_coord, p, weights,
+                                  ${replace_term(NORM, DTYPE, 'min_dist', 'box_diff', 'new_offset')}, radius, eps_fac, mask, leaf_mask, results);
 }
 
+% endfor
 /************************************************
-Search for nearest neighbour for a set of query points
+Search for all neighbours within radius for a set of query points.
+The neighbours are returned in compressed sparse row layout:
+the neighbours of query point i are idxs[offsets[i]:offsets[i + 1]].
 Params:
     tree : Tree struct of kd tree
     pa : data points
-    pidx : permutation index of data points
     point_coords : query points
+    point_type : POINT_TYPE_* of the query points
+    point_stride : distance in bytes between query points
+    dim_stride : distance in bytes between coordinates of a query point
     num_points : number of query points
-    mask : boolean array of invalid (True) and valid (False) data points
-    closest_idx : index of closest data point found (return)
-    closest_dist : distance to closest point (return)
+    radius : squared search radius, or the search radius in the form used by norm
+    radii : search radius per query point in the form of radius, not used if NULL
+    eps : approximation factor
+    norm, p, weights : see search_tree
+    mask : boolean array of invalid (True) and valid (False) data points,
+           see search_tree for the mask of the tree
+    offsets : start of the neighbours of each query point, num_points + 1 elements (return)
+    idxs : malloc'ed array of neighbour indices (return)
+    dists : malloc'ed array of neighbour distances, not computed if NULL (return)
+    reorder_queries : see search_tree
+For trees with a sphere_radius the query points are longitude and latitude,
+the distances are squared chord lengths on the unit sphere.
 ************************************************/
-void search_tree_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, ${DTYPE} *point_coords,
-                 u${ITYPE} num_points, u${ITYPE} k, ${DTYPE} distance_upper_bound,
-                 ${DTYPE} eps, uint8_t *mask, u${ITYPE} *closest_idxs, ${DTYPE} *closest_dists)
+void search_tree_ball_${DTYPE}_${ITYPE}(Tree_${DTYPE}_${ITYPE} *tree, ${DTYPE} *pa, const char *point_coords,
+                      int point_type, int64_t point_stride, int64_t dim_stride,
+                      u${ITYPE} num_points, ${DTYPE} radius, ${DTYPE} *radii, ${DTYPE} eps, int norm, ${DTYPE} p, ${DTYPE} *weights, uint8_t *mask,
+                      int64_t *offsets, u${ITYPE} **idxs, ${DTYPE} **dists, int reorder_queries)
 {
-    ${DTYPE} min_dist;
-    ${DTYPE} eps_fac = 1 / ((1 + eps) * (1 + eps));
+    ${DTYPE} eps_fac = get_eps_fac_${DTYPE}(eps, norm, p);
     int8_t no_dims = tree->no_dims;
     ${DTYPE} *bbox = tree->bbox;
     u${ITYPE} *pidx = tree->pidx;
+    Node_${DTYPE}_${ITYPE} *root = tree->nodes;
+    int with_dists = (dists != NULL);
+    int num_threads = OMP_MAX_THREADS();
+    uint8_t *leaf_mask = mask ? NULL : tree->leaf_mask;
+    uint8_t *node_masked = mask ? NULL : tree->node_masked;
     /* use 64-bit ints for indexing to avoid overflow, use signed ints to support all Openmp implementations */
     int64_t i = 0;
-    int64_t j = 0;
     int64_t local_num_points = (int64_t) num_points;
-    Node_${DTYPE}_${ITYPE} *root = (Node_${DTYPE}_${ITYPE} *)tree->root;
+    /* Neighbours are first collected per thread, the position of
+       the neighbours of each query point is recorded to gather them afterwards */
+    ResultArray_${DTYPE}_${ITYPE} *thread_results = (ResultArray_${DTYPE}_${ITYPE} *)malloc(sizeof(ResultArray_${DTYPE}_${ITYPE}) * num_threads);
+    uint64_t *result_start = (uint64_t *)malloc(sizeof(uint64_t) * local_num_points);
+    int *result_thread = (int *)malloc(sizeof(int) * local_num_points);
+    u${ITYPE} *out_idxs;
+    ${DTYPE} *out_dists = NULL;
+    int64_t *order = NULL;
+
+    if (tree->sphere_radius > 0)
+    {
+        point_type |= POINT_LONLAT;
+    }
+    /* The parallel region may use less than the maximum number of threads */
+    for (i = 0; i < num_threads; i++)
+    {
+        thread_results[i].idxs = NULL;
+        thread_results[i].dists = NULL;
+    }
+
+    if (reorder_queries)
+    {
+        order = morton_order_${DTYPE}(bbox, no_dims, point_coords, point_type, point_stride, dim_stride, local_num_points);
+    }
 
-    /* Queries are OpenMP enabled */
     #pragma omp parallel
     {
-        /* The low chunk size is important to avoid L2 cache trashing
-           for spatial coherent query datasets
-        */
-        #pragma omp for private(i, j) schedule(static, 100) nowait
+        int thread_num = OMP_THREAD_NUM();
+        ResultArray_${DTYPE}_${ITYPE} *results = &thread_results[thread_num];
+        ${DTYPE} min_dist;
+        ${DTYPE} point_buf[127];
+        ${DTYPE} *point_coord;
+
+        results->size = 0;
+        results->capacity = 1024;
+        results->idxs = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * results->capacity);
+        results->dists = with_dists ? (${DTYPE} *)malloc(sizeof(${DTYPE}) * results->capacity) : NULL;
+
+#ifdef KDTREE_OMP_SCHEDULE
+        #pragma omp for private(i, min_dist) schedule(runtime)
+#else
+        #pragma omp for private(i, min_dist) schedule(static, 100)
+#endif
         for (i = 0; i < local_num_points; i++)
         {
-            for (j = 0; j < k; j++)
+            int64_t q = order ? order[i] : i;
+            ${DTYPE} point_radius = radii ? radii[q] : radius;
+            result_start[q] = results->size;
+            result_thread[q] = thread_num;
+            point_coord = load_point_${DTYPE}(point_coords + q * point_stride, point_type, dim_stride, no_dims, point_buf);
+            if (tree->boxsize)
+            {
+                point_coord = wrap_point_${DTYPE}(point_coord, no_dims, tree->boxsize, point_buf);
+                min_dist = get_min_dist_periodic_${DTYPE}(point_coord, no_dims, bbox, tree->boxsize);
+                search_splitnode_ball_periodic_${DTYPE}_${ITYPE}(root, pa, pidx, no_dims, point_coord, tree->boxsize, min_dist,
+                                               point_radius, eps_fac, mask, leaf_mask, results);
+            }
+            else if (norm == NORM_L2)
+            {
+                min_dist = get_min_dist_${DTYPE}(point_coord, no_dims, bbox);
+                search_splitnode_ball_${DTYPE}_${ITYPE}(root, pa, pidx, tree->leaf_data, no_dims, point_coord, min_dist,
+                                      point_radius, eps_fac, mask, leaf_mask, node_masked, results);
+            }
+            else
+            {
+                switch (norm)
+                {
+% for NORM, WEIGHTED in METRICS:
+<% M = metric_name(NORM, WEIGHTED) %>\
+                case ${metric_case(NORM, WEIGHTED)}:
+                    min_dist = get_min_dist_${M}_${DTYPE}(point_coord, no_dims, bbox, p, weights);
+                    search_splitnode_ball_${M}_${DTYPE}_${ITYPE}(root, pa, pidx, no_dims, point_coord, p, weights, min_dist,
+                                                  point_radius, eps_fac, mask, leaf_mask, results);
+                    break;
+% endfor
+                }
+            }
+            offsets[q + 1] = (int64_t)(results->size - result_start[q]);
+        }
+    }
+    free(order);
+
+    /* Turn counts into offsets */
+    offsets[0] = 0;
+    for (i = 0; i < local_num_points; i++)
+    {
+        offsets[i + 1] += offsets[i];
+    }
+
+    /* Gather neighbours in query point order. Allocate at least one element to get a valid pointer. */
+    out_idxs = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * (offsets[local_num_points] + 1));
+    if (with_dists)
+    {
+        out_dists = (${DTYPE} *)malloc(sizeof(${DTYPE}) * (offsets[local_num_points] + 1));
+    }
+    #pragma omp parallel for schedule(static)
+    for (i = 0; i < local_num_points; i++)
+    {
+        ResultArray_${DTYPE}_${ITYPE} *results = &thread_results[result_thread[i]];
+        uint64_t count = (uint64_t)(offsets[i + 1] - offsets[i]);
+        memcpy(out_idxs + offsets[i], results->idxs + result_start[i], sizeof(u${ITYPE}) * count);
+        if (with_dists)
+        {
+            memcpy(out_dists + offsets[i], results->dists + result_start[i], sizeof(${DTYPE}) * count);
+        }
+    }
+
+    for (i = 0; i < num_threads; i++)
+    {
+        free(thread_results[i].idxs);
+        free(thread_results[i].dists);
+    }
+    free(thread_results);
+    free(result_start);
+    free(result_thread);
+    *idxs = out_idxs;
+    if (with_dists)
+    {
+        *dists = out_dists;
+    }
+}
+% endfor
+% endfor
+
+% for DTYPE in ['float', 'double']:
+% for ITYPE in ['int32_t', 'int64_t']:
+% for ITYPE2 in ['int32_t', 'int64_t']:
+
+/************************************************
+Append a pair of neighbours to a pair array
+Params:
+    pairs : pair array
+    idx1 : index of data point in first tree
+    idx2 : index of data point in second tree
+    dist : distance between data points
+************************************************/
+void append_pair_${DTYPE}_${ITYPE}_${ITYPE2}(PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *pairs, u${ITYPE} idx1, u${ITYPE2} idx2, ${DTYPE} dist)
+{
+    if (pairs->size == pairs->capacity)
+    {
+        pairs->capacity *= 2;
+        pairs->idxs1 = (u${ITYPE} *)realloc(pairs->idxs1, sizeof(u${ITYPE}) * pairs->capacity);
+        pairs->idxs2 = (u${ITYPE2} *)realloc(pairs->idxs2, sizeof(u${ITYPE2}) * pairs->capacity);
+        pairs->dists = (${DTYPE} *)realloc(pairs->dists, sizeof(${DTYPE}) * pairs->capacity);
+    }
+    pairs->idxs1[pairs->size] = idx1;
+    pairs->idxs2[pairs->size] = idx2;
+    pairs->dists[pairs->size] = dist;
+    pairs->size++;
+}
+
+/************************************************
+Find all pairs of points within radius in two leaf nodes
+Params:
+    search : dual tree search
+    node1 : leaf node of first tree
+    node2 : leaf node of second tree
+************************************************/
+void search_leaf_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} *search, Node_${DTYPE}_${ITYPE} *node1, Node_${DTYPE}_${ITYPE2} *node2)
+{
+    int8_t no_dims = search->no_dims;
+    int same_node = search->self_join && (void *)node1 == (void *)node2;
+    ${DTYPE} cur_dist;
+    u${ITYPE} i, idx1;
+    u${ITYPE2} j, idx2;
+    uint64_t count = 0;
+    PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *pairs = &search->thread_pairs[OMP_THREAD_NUM()];
+
+    for (i = 0; i < node1->n; i++)
+    {
+        idx1 = search->pidx1[node1->start_idx + i];
+        /* Only visit each pair once when joining a leaf with itself */
+        for (j = same_node ? i + 1 : 0; j < node2->n; j++)
+        {
+            idx2 = search->pidx2[node2->start_idx + j];
+            if (search->boxsize)
+            {
+                cur_dist = calc_dist_periodic_${DTYPE}(search->pa1 + no_dims * idx1, search->pa2 + no_dims * idx2, no_dims, search->boxsize);
+            }
+            else
+            {
+                cur_dist = calc_dist_${DTYPE}(search->pa1 + no_dims * idx1, search->pa2 + no_dims * idx2, no_dims);
+            }
+            if (cur_dist <= search->radius)
+            {
+                if (search->count_only)
+                {
+                    count++;
+                }
+                else if (search->self_join && idx2 < idx1)
+                {
+                    append_pair_${DTYPE}_${ITYPE}_${ITYPE2}(pairs, (u${ITYPE})idx2, (u${ITYPE2})idx1, cur_dist);
+                }
+                else
+                {
+                    append_pair_${DTYPE}_${ITYPE}_${ITYPE2}(pairs, idx1, idx2, cur_dist);
+                }
+            }
+        }
+    }
+    search->thread_counts[OMP_THREAD_NUM()] += count;
+}
+
+/************************************************
+Search a pair of child nodes, as a separate OpenMP task
+if the nodes are large enough
+Params:
+    search : dual tree search
+    node1 : node of first tree
+    bbox1 : bounding box of node1
+    node2 : node of second tree
+    bbox2 : bounding box of node2
+************************************************/
+void search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} *search, Node_${DTYPE}_${ITYPE} *node1, ${DTYPE} *bbox1,
+                           Node_${DTYPE}_${ITYPE2} *node2, ${DTYPE} *bbox2)
+{
+#ifdef KDTREE_OMP_TASKS
+    if ((uint64_t)node1->n + (uint64_t)node2->n >= PARALLEL_PAIRS_MIN_N)
+    {
+        /* The task needs its own copy of the bounding boxes
+           as the caller continues to modify them */
+        int8_t no_dims = search->no_dims;
+        ${DTYPE} *bbox_copy = (${DTYPE} *)malloc(4 * sizeof(${DTYPE}) * no_dims);
+        memcpy(bbox_copy, bbox1, 2 * sizeof(${DTYPE}) * no_dims);
+        memcpy(bbox_copy + 2 * no_dims, bbox2, 2 * sizeof(${DTYPE}) * no_dims);
+        #pragma omp task firstprivate(bbox_copy)
+        {
+            search_splitnode_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1, bbox_copy, node2, bbox_copy + 2 * no_dims);
+            free(bbox_copy);
+        }
+        return;
+    }
+#endif
+    search_splitnode_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1, bbox1, node2, bbox2);
+}
+
+/************************************************
+Find all pairs of points within radius in two subtrees.
+Pairs of nodes further apart than the radius are pruned.
+Params:
+    search : dual tree search
+    node1 : root of subtree of first tree
+    bbox1 : bounding box of node1
+    node2 : root of subtree of second tree
+    bbox2 : bounding box of node2
+************************************************/
+void search_splitnode_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} *search, Node_${DTYPE}_${ITYPE} *node1, ${DTYPE} *bbox1,
+                               Node_${DTYPE}_${ITYPE2} *node2, ${DTYPE} *bbox2)
+{
+    int8_t no_dims = search->no_dims;
+    int8_t i, dim;
+    int same_node = search->self_join && (void *)node1 == (void *)node2;
+    ${DTYPE} min_dist = 0, max_dist = 0, gap, span, lv, hv, cut_val;
+
+    /* Get minimum and maximum squared distance between the bounding boxes */
+    for (i = 0; i < no_dims; i++)
+    {
+        gap = bbox2[2 * i] - bbox1[2 * i + 1];
+        if (bbox1[2 * i] - bbox2[2 * i + 1] > gap)
+        {
+            gap = bbox1[2 * i] - bbox2[2 * i + 1];
+        }
+        span = bbox2[2 * i + 1] - bbox1[2 * i];
+        if (bbox1[2 * i + 1] - bbox2[2 * i] > span)
+        {
+            span = bbox1[2 * i + 1] - bbox2[2 * i];
+        }
+        if (search->boxsize)
+        {
+            /* The gap across the box boundary is the box size minus the extent
+               of both boxes, no distance is larger than half the box size */
+            if (gap > 0 && search->boxsize[i] - span < gap)
+            {
+                gap = search->boxsize[i] - span;
+            }
+            if (2 * span > search->boxsize[i])
+            {
+                span = search->boxsize[i] / 2;
+            }
+        }
+        if (gap > 0)
+        {
+            min_dist += gap * gap;
+        }
+        max_dist += span * span;
+    }
+
+    /* Skip if nodes are too far apart */
+    if (min_dist > search->radius)
+    {
+        return;
+    }
+
+    /* Count all pairs at once if nodes are completely within radius */
+    if (search->count_only && max_dist <= search->radius)
+    {
+        if (same_node)
+        {
+            search->thread_counts[OMP_THREAD_NUM()] += (uint64_t)node1->n * ((uint64_t)node1->n - 1) / 2;
+        }
+        else
+        {
+            search->thread_counts[OMP_THREAD_NUM()] += (uint64_t)node1->n * (uint64_t)node2->n;
+        }
+        return;
+    }
+
+    if (node1->cut_dim == -1 && node2->cut_dim == -1)
+    {
+        search_leaf_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1, node2);
+    }
+    else if (same_node)
+    {
+        /* Split both nodes and skip the mirrored (right, left) pair */
+        dim = node1->cut_dim;
+        cut_val = node1->cut_val;
+        lv = bbox1[2 * dim];
+        hv = bbox1[2 * dim + 1];
+        bbox1[2 * dim + 1] = bbox2[2 * dim + 1] = cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1 + 1, bbox1, node2 + 1, bbox2);
+        bbox2[2 * dim + 1] = hv;
+        bbox2[2 * dim] = cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1 + 1, bbox1, node2 + node2->right_child, bbox2);
+        bbox1[2 * dim + 1] = hv;
+        bbox1[2 * dim] = cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1 + node1->right_child, bbox1, node2 + node2->right_child, bbox2);
+        bbox1[2 * dim] = bbox2[2 * dim] = lv;
+    }
+    else if (node2->cut_dim == -1 || (node1->cut_dim != -1 && node1->n >= node2->n))
+    {
+        /* Split the larger node of the first tree */
+        dim = node1->cut_dim;
+        lv = bbox1[2 * dim];
+        hv = bbox1[2 * dim + 1];
+        bbox1[2 * dim + 1] = node1->cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1 + 1, bbox1, node2, bbox2);
+        bbox1[2 * dim + 1] = hv;
+        bbox1[2 * dim] = node1->cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1 + node1->right_child, bbox1, node2, bbox2);
+        bbox1[2 * dim] = lv;
+    }
+    else
+    {
+        /* Split the larger node of the second tree */
+        dim = node2->cut_dim;
+        lv = bbox2[2 * dim];
+        hv = bbox2[2 * dim + 1];
+        bbox2[2 * dim + 1] = node2->cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1, bbox1, node2 + 1, bbox2);
+        bbox2[2 * dim + 1] = hv;
+        bbox2[2 * dim] = node2->cut_val;
+        search_child_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(search, node1, bbox1, node2 + node2->right_child, bbox2);
+        bbox2[2 * dim] = lv;
+    }
+}
+
+/************************************************
+Find all pairs of points within radius of each other in two trees.
+The pairs are returned as coordinate lists.
+Params:
+    tree1 : Tree struct of first kd tree
+    pa1 : data points of first tree
+    tree2 : Tree struct of second kd tree
+    pa2 : data points of second tree
+    radius : squared search radius
+    self_join : tree1 and tree2 are the same tree, only return pairs with idx1 < idx2
+    The trees must have the same periodic box, the box of tree1 is used.
+    count : number of pairs found (return)
+    idxs1 : malloc'ed array of indices into first tree, pairs are only counted if NULL (return)
+    idxs2 : malloc'ed array of indices into second tree (return)
+    dists : malloc'ed array of distances between pairs (return)
+************************************************/
+void search_tree_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(Tree_${DTYPE}_${ITYPE} *tree1, ${DTYPE} *pa1, Tree_${DTYPE}_${ITYPE2} *tree2, ${DTYPE} *pa2,
+                          ${DTYPE} radius, int self_join, uint64_t *count,
+                          u${ITYPE} **idxs1, u${ITYPE2} **idxs2, ${DTYPE} **dists)
+{
+    PairSearch_${DTYPE}_${ITYPE}_${ITYPE2} search;
+    int8_t no_dims = tree1->no_dims;
+    int num_threads = OMP_MAX_THREADS();
+    int i;
+    uint64_t offset;
+    ${DTYPE} *bbox1 = (${DTYPE} *)malloc(2 * sizeof(${DTYPE}) * no_dims);
+    ${DTYPE} *bbox2 = (${DTYPE} *)malloc(2 * sizeof(${DTYPE}) * no_dims);
+
+    memcpy(bbox1, tree1->bbox, 2 * sizeof(${DTYPE}) * no_dims);
+    memcpy(bbox2, tree2->bbox, 2 * sizeof(${DTYPE}) * no_dims);
+
+    search.pa1 = pa1;
+    search.pidx1 = tree1->pidx;
+    search.pa2 = pa2;
+    search.pidx2 = tree2->pidx;
+    search.no_dims = no_dims;
+    search.radius = radius;
+    search.self_join = self_join;
+    search.count_only = (idxs1 == NULL);
+    search.boxsize = tree1->boxsize;
+    search.thread_pairs = (PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *)malloc(sizeof(PairArray_${DTYPE}_${ITYPE}_${ITYPE2}) * num_threads);
+    search.thread_counts = (uint64_t *)malloc(sizeof(uint64_t) * num_threads);
+
+    /* The parallel region may use less than the maximum number of threads */
+    for (i = 0; i < num_threads; i++)
+    {
+        search.thread_pairs[i].size = 0;
+        search.thread_pairs[i].capacity = 0;
+        search.thread_pairs[i].idxs1 = NULL;
+        search.thread_pairs[i].idxs2 = NULL;
+        search.thread_pairs[i].dists = NULL;
+        search.thread_counts[i] = 0;
+    }
+
+    /* Node pairs are searched as OpenMP tasks executed by the threads of this parallel region */
+    #pragma omp parallel
+    {
+        PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *pairs = &search.thread_pairs[OMP_THREAD_NUM()];
+        if (!search.count_only)
+        {
+            pairs->capacity = 1024;
+            pairs->idxs1 = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * pairs->capacity);
+            pairs->idxs2 = (u${ITYPE2} *)malloc(sizeof(u${ITYPE2}) * pairs->capacity);
+            pairs->dists = (${DTYPE} *)malloc(sizeof(${DTYPE}) * pairs->capacity);
+        }
+
+        #pragma omp single
+        search_splitnode_pairs_${DTYPE}_${ITYPE}_${ITYPE2}(&search, tree1->nodes, bbox1, tree2->nodes, bbox2);
+    }
+
+    *count = 0;
+    for (i = 0; i < num_threads; i++)
+    {
+        *count += search.thread_counts[i] + search.thread_pairs[i].size;
+    }
+
+    if (!search.count_only)
+    {
+        /* Concatenate the pairs found by each thread. Allocate at least one element to get a valid pointer. */
+        *idxs1 = (u${ITYPE} *)malloc(sizeof(u${ITYPE}) * (*count + 1));
+        *idxs2 = (u${ITYPE2} *)malloc(sizeof(u${ITYPE2}) * (*count + 1));
+        *dists = (${DTYPE} *)malloc(sizeof(${DTYPE}) * (*count + 1));
+        offset = 0;
+        for (i = 0; i < num_threads; i++)
+        {
+            PairArray_${DTYPE}_${ITYPE}_${ITYPE2} *pairs = &search.thread_pairs[i];
+            if (pairs->size > 0)
             {
-                closest_idxs[i * k + j] = IDX_MAX_${ITYPE};
-                closest_dists[i * k + j] = DIST_MAX_${DTYPE};
+                memcpy(*idxs1 + offset, pairs->idxs1, sizeof(u${ITYPE}) * pairs->size);
+                memcpy(*idxs2 + offset, pairs->idxs2, sizeof(u${ITYPE2}) * pairs->size);
+                memcpy(*dists + offset, pairs->dists, sizeof(${DTYPE}) * pairs->size);
+                offset += pairs->size;
             }
-            min_dist = get_min_dist_${DTYPE}(point_coords + no_dims * i, no_dims, bbox);
-            search_splitnode_${DTYPE}_${ITYPE}(root, pa, pidx, no_dims, point_coords + no_dims * i, min_dist,
-                             k, distance_upper_bound, eps_fac, mask, &closest_idxs[i * k], &closest_dists[i * k]);
+            free(pairs->idxs1);
+            free(pairs->idxs2);
+            free(pairs->dists);
         }
     }
+
+    free(search.thread_pairs);
+    free(search.thread_counts);
+    free(bbox1);
+    free(bbox2);
 }
+
+% endfor
 % endfor
 % endfor
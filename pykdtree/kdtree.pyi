@@ -15,21 +15,54 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from os import PathLike
 from typing_extensions import disjoint_base
-from typing import Any
+from typing import Any, Iterator, Literal
 import numpy as np
+from numpy.typing import DTypeLike
 
 @disjoint_base
 class KDTree:
     """kd-tree for fast nearest-neighbour lookup.
-    The interface is made to resemble the scipy.spatial kd-tree except
-    only Euclidean distance measure is supported.
+    The interface is made to resemble the scipy.spatial kd-tree.
+    query and query_ball_point support Minkowski p-norms and weighted
+    dimensions, the other searches use the Euclidean distance.
 
     :Parameters:
     data_pts : numpy array
         Data points with shape (n , dims)
     leafsize : int, optional
         Maximum number of data points in tree leaf
+    workers : int, optional
+        Number of threads used to construct the tree. -1 uses all
+        processors. By default the OpenMP setting (OMP_NUM_THREADS)
+        is used.
+    reorder_data : bool, optional
+        Keep a copy of the data points in the order of the tree leaves.
+        Queries then read the points of a leaf from consecutive memory,
+        which is faster but doubles the memory used by the data points.
+    split_rule : {'sliding_midpoint', 'median', 'cost'}, optional
+        Rule for choosing the cutting plane of a node.
+        'sliding_midpoint' (default) cuts the longest side of the node
+        in the middle, moving the cut to the nearest point if one side
+        would be empty. 'median' cuts the longest side at the median of
+        the points giving a balanced tree. 'cost' chooses the dimension
+        and cut from a sample of the points, preferring cuts through
+        empty space between clusters of points.
+    boxsize : float or array_like, optional
+        Side lengths of a periodic box. Distances are measured the
+        shorter way around the box in every dimension, so points close
+        to opposite sides of the box are neighbours. The data points
+        must be inside [0, boxsize), query points are wrapped into the box.
+    spherical : bool, optional
+        The data points are longitude and latitude in degrees with shape
+        (n, 2) and distances are great-circle distances. The tree is
+        built on unit vectors, which data_pts holds. Query points are
+        longitude and latitude as well and are converted while searching.
+    sphere_radius : float, optional
+        Radius of the sphere for spherical trees. Distances, bounds and
+        radii are in the unit of the radius, e.g. metres for the radius
+        of the Earth in metres. The default of 1 gives radians.
     """
 
     @property
@@ -52,44 +85,655 @@ class KDTree:
     def leafsize(self) -> int:
         """Maximum number of data points in tree leaf."""
 
-    def __init__(self, data_pts: np.ndarray, leafsize: int = 16): ...
+    @property
+    def reorder_data(self) -> bool:
+        """Whether a leaf ordered copy of the data points is kept."""
+
+    @property
+    def split_rule(self) -> str:
+        """Rule used for choosing the cutting planes."""
+
+    @property
+    def boxsize(self) -> np.ndarray | None:
+        """Side lengths of the periodic box or None"""
+
+    @property
+    def spherical(self) -> bool:
+        """True if the tree searches longitude and latitude by great-circle distance"""
+
+    @property
+    def sphere_radius(self) -> float | None:
+        """Radius of the sphere of a spherical tree or None"""
+
+    def __init__(
+        self,
+        data_pts: np.ndarray,
+        leafsize: int = 16,
+        workers: int | None = None,
+        reorder_data: bool = False,
+        split_rule: Literal["sliding_midpoint", "median", "cost"] = "sliding_midpoint",
+        boxsize: float | np.ndarray | None = None,
+        spherical: bool = False,
+        sphere_radius: float = 1.0,
+    ): ...
     def query(
         self,
         query_pts: np.ndarray,
-        k: int = 1,
+        k: int | np.ndarray = 1,
         eps: float = 0,
-        distance_upper_bound: float | None = None,
+        distance_upper_bound: float | np.ndarray | None = None,
         sqr_dists: bool = False,
         mask: np.ndarray | None = None,
-    ):
+        workers: int | None = None,
+        schedule: Literal["static", "dynamic", "guided"] = "static",
+        chunk_size: int = 100,
+        out_dists: np.ndarray | None = None,
+        out_idxs: np.ndarray | None = None,
+        p: float = 2,
+        weights: float | np.ndarray | None = None,
+        return_stats: bool = False,
+        index_dtype: DTypeLike | None = None,
+        return_distance: bool = True,
+        reorder_queries: bool = False,
+        max_leaves: int | None = None,
+        max_checks: int | None = None,
+    ) -> Any:
         """Query the kd-tree for nearest neighbors
 
         :Parameters:
         query_pts : numpy array
             Query points with shape (m, dims)
-        k : int
-            The number of nearest neighbours to return
+        k : int or numpy array of ints
+            The number of nearest neighbours to return, or the number of
+            neighbours of each query point with shape (m,). Per query point
+            numbers of neighbours are returned in compressed sparse row layout.
         eps : non-negative float
             Return approximate nearest neighbours; the k-th returned value
             is guaranteed to be no further than (1 + eps) times the distance
             to the real k-th nearest neighbour
-        distance_upper_bound : non-negative float
-            Return only neighbors within this distance.
+        distance_upper_bound : non-negative float or numpy array
+            Return only neighbors within this distance, or within a
+            distance per query point with shape (m,).
             This is used to prune tree searches.
         sqr_dists : bool, optional
-            Internally pykdtree works with squared distances.
-            Determines if the squared or Euclidean distances are returned.
+            Internally pykdtree works with squared distances, or the p-th
+            power of the distances for other norms.
+            Determines if these or the actual distances are returned.
         mask : numpy array, optional
             Array of booleans where neighbors are considered invalid and
             should not be returned. A mask value of True represents an
             invalid pixel. Mask should have shape (n,) to match data points.
-            By default all points are considered valid.
+            By default the mask set with set_mask is used, if any,
+            otherwise all points are considered valid.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+        schedule : str, optional
+            How the query points are distributed over the threads,
+            one of 'static', 'dynamic' or 'guided'
+        chunk_size : int, optional
+            Number of consecutive query points handed to a thread at a
+            time. Small chunks of spatially coherent query points avoid
+            cache thrashing, larger dynamic chunks balance the load when
+            query times vary.
+        out_dists : numpy array, optional
+            Array the distances are written to instead of allocating
+            a new one. It must have the shape and dtype of the returned
+            distances but may be a view into a larger buffer.
+        out_idxs : numpy array, optional
+            Array the indices are written to, like out_dists
+        p : float, optional
+            Which Minkowski p-norm to use, 1 <= p <= infinity.
+            1 is the sum of absolute values, 2 the Euclidean distance
+            and infinity the maximum coordinate difference.
+        weights : float or numpy array, optional
+            Factors the coordinate differences are multiplied with,
+            one per dimension. The distances are those between the data
+            and query points scaled by the weights.
+        return_stats : bool, optional
+            Also return counters of the work done by the search, for
+            finding out why queries are slow. Searches without stats run
+            code without the counters. Only supported for the Euclidean
+            distance without boxsize.
+        index_dtype : numpy dtype, optional
+            Integer type of the returned indices, e.g. numpy.intp for
+            indexing without a conversion. By default uint32 for trees
+            with less than 2**32 elements and uint64 otherwise.
+        return_distance : bool, optional
+            Return the distances. If False only the indices are returned
+            and the distances are neither stored nor converted.
+        reorder_queries : bool, optional
+            Search the query points in the order of a space filling
+            curve through the tree instead of the given order. This
+            speeds up shuffled or scattered query points, where each
+            thread would otherwise jump across the whole tree. The
+            results are returned in the order of the query points.
+        max_leaves : int, optional
+            Return approximate nearest neighbours found by searching at
+            most this many leaves per query point. The leaves are searched
+            in the order of their distance to the query point (best bin
+            first), so the cost of each query is bounded while most
+            neighbours found are the exact ones. Neighbours not found
+            are marked like those beyond distance_upper_bound.
+            Only supported for the Euclidean distance without boxsize.
+        max_checks : int, optional
+            Like max_leaves, but limits the number of distances computed
+            per query point. The leaf reaching the limit is searched
+            completely.
+
+        :Returns:
+        distances : numpy array, only with return_distance
+            The distances to the nearest neighbours with shape (m, k),
+            or (m,) for k=1
+        indices : numpy array
+            The indices of the nearest neighbours, shaped like distances.
+            Returned on their own if they are the only result.
+        stats : dict, only with return_stats
+            'nodes_visited' : number of tree nodes visited per query point
+            'leaves_visited' : number of leaves searched per query point
+            'dist_evals' : number of distances computed per query point
+            'pruned' : number of subtrees skipped per query point
+            'thread_times' : seconds spent searching by each thread
+            The counters are arrays with shape (m,), their sums are the
+            totals of the query.
+
+        For a per query point k, (offsets, distances, indices) is returned.
+        The neighbours of query point i are distances[offsets[i]:offsets[i + 1]]
+        and indices[offsets[i]:offsets[i + 1]], offsets has shape (m + 1,).
+
+        """
+        ...
+    def query_iter(
+        self, source: Any, chunk_size: int = 65536, **query_kwargs: Any
+    ) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Query the kd-tree for nearest neighbors one chunk of query points at a time
+
+        The next chunk is read while the current chunk is searched, so
+        reading overlaps with the search and only two chunks of query
+        points are held in memory.
+
+        :Parameters:
+        source : array-like or iterable
+            Query points with shape (m, dims). Arrays and array-like objects
+            with a shape that can be sliced, such as numpy memmaps or zarr
+            arrays, are split into chunks of chunk_size points. Any other
+            iterable is taken to yield the chunks of query points.
+        chunk_size : int, optional
+            Number of query points per chunk when slicing an array
+        **query_kwargs
+            Arguments of KDTree.query, such as k or distance_upper_bound.
+            Per query point arrays of k and distance_upper_bound are
+            split into chunks along with the query points.
+
+        :Returns:
+        Iterator of (dist, idx) tuples as returned by KDTree.query
+        for each chunk
+        """
+        ...
+    def query_ball_point(
+        self,
+        query_pts: np.ndarray,
+        r: float | np.ndarray,
+        eps: float = 0,
+        sqr_dists: bool = False,
+        mask: np.ndarray | None = None,
+        return_distance: bool = False,
+        workers: int | None = None,
+        schedule: Literal["static", "dynamic", "guided"] = "static",
+        chunk_size: int = 100,
+        p: float = 2,
+        weights: float | np.ndarray | None = None,
+        reorder_queries: bool = False,
+    ) -> tuple[np.ndarray, ...]:
+        """Find all data points within distance r of the query points
+
+        The result is returned in compressed sparse row layout so no
+        Python objects are created per query point. The neighbours of
+        query point i are idxs[offsets[i]:offsets[i + 1]], in no
+        particular order.
+
+        :Parameters:
+        query_pts : numpy array
+            Query points with shape (m, dims)
+        r : non-negative float or numpy array
+            Search radius, or the search radius of each query point
+            with shape (m,)
+        eps : non-negative float
+            Approximate search. Branches of the tree are not explored
+            if their nearest points are further than r / (1 + eps)
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances, or the p-th
+            power of the distances for other norms.
+            Determines if these or the actual distances are returned.
+        mask : numpy array, optional
+            Array of booleans where neighbors are considered invalid and
+            should not be returned. A mask value of True represents an
+            invalid pixel. Mask should have shape (n,) to match data points.
+            By default the mask set with set_mask is used, if any,
+            otherwise all points are considered valid.
+        return_distance : bool, optional
+            Also return the distances to the neighbours
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+        schedule : str, optional
+            How the query points are distributed over the threads,
+            one of 'static', 'dynamic' or 'guided'
+        chunk_size : int, optional
+            Number of consecutive query points handed to a thread at a
+            time. Small chunks of spatially coherent query points avoid
+            cache thrashing, larger dynamic chunks balance the load when
+            query times vary.
+        p : float, optional
+            Which Minkowski p-norm to use, see query
+        weights : float or numpy array, optional
+            Factors the coordinate differences are multiplied with, see query
+        reorder_queries : bool, optional
+            Search the query points in the order of a space filling
+            curve through the tree, see query
+
+        :Returns:
+        offsets : numpy array of int64
+            Start of the neighbours of each query point, shape (m + 1,)
+        idxs : numpy array
+            Indices of the neighbours
+        dists : numpy array
+            Distances to the neighbours, only if return_distance is True
+        """
+        ...
+    def knn_graph(
+        self,
+        k: int,
+        include_self: bool = False,
+        sqr_dists: bool = False,
+        workers: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find the k nearest neighbours of every data point of the tree
+
+        The data points are not queried from the root one by one. The
+        leaves are walked directly, the distances between the points of
+        a leaf are computed once and the nearest of them bound the search
+        of each point from the start.
+
+        :Parameters:
+        k : int
+            Number of neighbours per data point
+        include_self : bool, optional
+            Count each point as its own nearest neighbour. By default the
+            point itself is left out of its neighbours.
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or actual distances are returned.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        offsets : numpy array of int32 or int64
+            Start of the neighbours of each data point, shape (n + 1,)
+        idxs : numpy array of int32 or int64
+            Indices of the neighbours sorted by distance, shape (n * k,)
+        dists : numpy array
+            Distances to the neighbours, shape (n * k,)
+
+        The result is the compressed sparse row layout of the adjacency
+        matrix. offsets and idxs are int32 if n * k < 2**31, as scipy.sparse
+        uses for such matrices, so scipy.sparse.csr_matrix((dists, idxs,
+        offsets), shape=(n, n)) uses the arrays without copying them.
+        The mask set with set_mask is not applied.
+        """
+        ...
+    def interpolate(
+        self,
+        query_pts: np.ndarray,
+        values: np.ndarray,
+        k: int = 8,
+        weighting: str = "idw",
+        radius: float | None = None,
+        power: float = 2,
+        sigma: float | None = None,
+        fill_value: float = ...,
+        eps: float = 0,
+        mask: np.ndarray | None = None,
+        workers: int | None = None,
+        reorder_queries: bool = False,
+    ) -> np.ndarray:
+        """Interpolate values of the data points at the query points
+
+        Each query point gets the weighted average of the values of its k
+        nearest neighbours. The weights are computed while searching, so
+        the neighbours and their distances are never stored. This needs
+        far less memory than query followed by a weighted sum in numpy.
+
+        :Parameters:
+        query_pts : numpy array
+            Query points with shape (m, dims)
+        values : numpy array
+            Values of the data points with shape (n,) or (n, channels).
+            They are converted to the type of the data points.
+        k : int, optional
+            Number of neighbours averaged
+        weighting : str, optional
+            'idw' for inverse distance weights 1 / dist**power, or
+            'gaussian' for weights exp(-dist**2 / (2 * sigma**2)).
+            With 'idw', query points that coincide with data points
+            get the values of those points.
+        radius : non-negative float, optional
+            Only use neighbours within this distance
+        power : positive float, optional
+            Power of the inverse distance weights
+        sigma : positive float
+            Width of the Gaussian weights, required for 'gaussian'
+        fill_value : float, optional
+            Value of query points without neighbours within radius
+        eps : non-negative float
+            Use approximate nearest neighbours, see query
+        mask : numpy array, optional
+            Array of booleans where data points should not be used,
+            see query. By default the mask set with set_mask is used.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+        reorder_queries : bool, optional
+            Search the query points in the order of a space filling
+            curve through the tree, see query
+
+        :Returns:
+        interpolated : numpy array
+            Values at the query points with shape (m,) or (m, channels)
+            and the type of the data points
+
+        For spherical trees radius and sigma are great-circle distances.
+        """
+        ...
+    def query_pairs(
+        self,
+        r: float,
+        sqr_dists: bool = False,
+        return_distance: bool = False,
+        workers: int | None = None,
+    ) -> tuple[np.ndarray, ...]:
+        """Find all pairs of data points within distance r of each other
+
+        The pairs are found with a dual tree traversal and returned in
+        coordinate (COO) layout, in no particular order. Each pair is
+        returned once with i < j.
+
+        :Parameters:
+        r : non-negative float
+            Maximum distance
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or Euclidean distances are returned.
+        return_distance : bool, optional
+            Also return the distances between the pairs
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        i : numpy array
+            Index of first point of each pair
+        j : numpy array
+            Index of second point of each pair
+        dists : numpy array
+            Distances between the pairs, only if return_distance is True
+        """
+        ...
+    def sparse_distance_matrix(
+        self,
+        other: KDTree,
+        r: float,
+        sqr_dists: bool = False,
+        workers: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Distances between all pairs of points of this tree and another
+        tree that are within distance r of each other
+
+        The result is returned in coordinate (COO) layout, in no particular
+        order, and can be passed directly to scipy.sparse.coo_matrix as
+        ``coo_matrix((dists, (i, j)), shape=(self.n, other.n))``.
+
+        :Parameters:
+        other : KDTree
+            Tree of the other set of points
+        r : non-negative float
+            Maximum distance
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or Euclidean distances are returned.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        i : numpy array
+            Index into the data points of this tree
+        j : numpy array
+            Index into the data points of the other tree
+        dists : numpy array
+            Distance between the points
+        """
+        ...
+    def count_neighbors(
+        self, other: KDTree, r: float, workers: int | None = None
+    ) -> int:
+        """Count the pairs of points of this tree and another tree that
+        are within distance r of each other
+
+        Pairs of tree nodes that are completely within distance r are
+        counted without visiting their points.
+
+        :Parameters:
+        other : KDTree
+            Tree of the other set of points
+        r : non-negative float
+            Maximum distance
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        count : int
+            Number of pairs
+        """
+        ...
+    def set_mask(self, mask: np.ndarray | None) -> None:
+        """Set the mask used by queries that are not given a mask
+
+        The mask is stored once, bit-packed in the order of the leaves of
+        the tree, so the queries neither copy it nor read it scattered
+        across memory. Subtrees whose points are all masked are skipped
+        by the search. The mask is not saved or pickled with the tree.
+
+        :Parameters:
+        mask : numpy array or None
+            Array of booleans with shape (n,) where True marks data points
+            that are not returned by the queries. None removes the mask.
+        """
+        ...
+    @property
+    def mask(self) -> np.ndarray | None:
+        """Mask set with set_mask as an array of booleans, or None"""
+        ...
+    def tree_stats(self) -> dict[str, Any]:
+        """Statistics of the shape of the tree
+
+        Useful for comparing split rules on a data set.
+        Queries are fastest for shallow trees with full leaves.
+
+        :Returns:
+        stats : dict
+            'num_nodes' : number of nodes
+            'num_leaves' : number of leaves
+            'max_depth' : depth of the deepest leaf, the root is at depth 0
+            'mean_depth' : mean depth of the leaf holding a data point
+            'leaf_depths' : depth of every leaf in depth-first order
+            'leaf_sizes' : number of points in every leaf in depth-first order
+            'leaf_size_hist' : number of leaves holding 0, 1, 2, ... points
+            'nodes_nbytes' : memory used by the nodes in bytes
+            'pidx_nbytes' : memory used by the permutation index of the
+                            data points in bytes
+            'leaf_data_nbytes' : memory used by the leaf ordered copy of
+                                 the data points in bytes, see reorder_data
+        """
+        ...
+    def save(self, path: str | PathLike[str]) -> None:
+        """Save the kd-tree to a file
+
+        The tree is stored in a versioned binary format holding the
+        data points and the internal tree arrays so it can be loaded
+        without rebuilding it.
+
+        :Parameters:
+        path : str or path-like
+            File to write
+        """
+        ...
+    @classmethod
+    def load(cls, path: str | PathLike[str], mmap: bool = True) -> KDTree:
+        """Load a kd-tree saved with KDTree.save
+
+        :Parameters:
+        path : str or path-like
+            File to read
+        mmap : bool, optional
+            Memory-map the file instead of reading it. Loading is then
+            almost instant and the pages are shared between processes
+            loading the same file. The data points of the loaded tree
+            are read-only.
+        """
+        ...
+
+class DynamicKDTree:
+    """kd-tree supporting insertion and removal of points.
+
+    The points are kept in a forest of static kd-trees of decreasing size
+    (Bentley-Saxe). Inserted points form a new tree which is merged with
+    the smaller trees, so every point is part of O(log n) rebuilds and the
+    forest has O(log n) trees. Removed points are masked in their tree and
+    a tree is rebuilt from its remaining points once half of its points
+    are removed.
+
+    Every point gets an index when it is inserted. Indices are assigned
+    consecutively and are not reused after the point is removed.
+
+    :Parameters:
+    data_pts : numpy array
+        Initial data points with shape (n, dims). n may be 0.
+    leafsize : int, optional
+        Maximum number of data points in tree leaf
+    workers : int, optional
+        Number of threads used to construct the trees. -1 uses all
+        processors. By default the OpenMP setting (OMP_NUM_THREADS)
+        is used.
+    **tree_kwargs
+        Other options passed to KDTree, e.g. split_rule
+    """
+
+    def __init__(
+        self,
+        data_pts: np.ndarray,
+        leafsize: int = 16,
+        workers: int | None = None,
+        **tree_kwargs: Any,
+    ) -> None: ...
+    @property
+    def n(self) -> int:
+        """Number of data points"""
+
+    @property
+    def ndim(self) -> int:
+        """Number of dimensions"""
+
+    @property
+    def leafsize(self) -> int:
+        """Maximum number of data points in tree leaf"""
+
+    @property
+    def num_inserted(self) -> int:
+        """Number of points inserted so far, including removed points"""
+
+    @property
+    def num_trees(self) -> int:
+        """Number of static kd-trees in the forest"""
+
+    def insert(self, points: np.ndarray, workers: int | None = None) -> np.ndarray:
+        """Insert points
+
+        :Parameters:
+        points : numpy array
+            Points with shape (m, dims)
+        workers : int, optional
+            Number of threads used to construct the trees
+
+        :Returns:
+        indices : numpy array of uint64
+            Indices of the inserted points
+        """
+        ...
+    def remove(self, indices: np.ndarray, workers: int | None = None) -> None:
+        """Remove points
+
+        :Parameters:
+        indices : array_like
+            Indices of the points returned by insert
+        workers : int, optional
+            Number of threads used to rebuild trees
+        """
+        ...
+    def rebuild(self, workers: int | None = None) -> None:
+        """Rebuild the forest as a single kd-tree of the remaining points
+
+        :Parameters:
+        workers : int, optional
+            Number of threads used to construct the tree
+        """
+        ...
+    def query(
+        self,
+        query_pts: np.ndarray,
+        k: int = 1,
+        eps: float = 0,
+        distance_upper_bound: float | np.ndarray | None = None,
+        sqr_dists: bool = False,
+        workers: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Query the kd-tree for nearest neighbors
+
+        The trees of the forest are queried one after another, from the
+        largest to the smallest, and the results are merged. The distance
+        to the k-th neighbour found so far bounds the search of each
+        query point in the following trees.
+
+        :Parameters:
+        query_pts : numpy array
+            Query points with shape (m, dims)
+        k : int
+            The number of nearest neighbours to return
+        eps : non-negative float
+            Return approximate nearest neighbours; the k-th returned value
+            is guaranteed to be no further than (1 + eps) times the distance
+            to the real k-th nearest neighbour
+        distance_upper_bound : non-negative float or numpy array
+            Return only neighbors within this distance, or within a
+            distance per query point with shape (m,).
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or Euclidean distances are returned.
+        workers : int, optional
+            Number of threads used for this call
 
+        :Returns:
+        distances : array of floats
+            The distances to the nearest neighbours. Missing neighbours
+            are indicated with infinite distances.
+        indices : array of uint64
+            The indices of the neighbours. Missing neighbours are
+            indicated with num_inserted.
         """
         ...
 
 # These are generated by Cython.
 # Just in here to avoid errors in mypy tests.
-__reduce_cython__: Any
-__setstate_cython__: Any
 __test__: Any
@@ -15,9 +15,16 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 cimport numpy as np
-from libc.stdint cimport uint64_t, uint32_t, int8_t, uint8_t, UINT32_MAX
+from libc.stdint cimport uint64_t, uint32_t, int64_t, int8_t, uint8_t, UINT32_MAX
+from libc.stdlib cimport free
+from libc.float cimport FLT_MAX, DBL_MAX
+from cpython.pycapsule cimport PyCapsule_New, PyCapsule_GetPointer
 cimport cython
 
 np.import_array()
@@ -25,94 +32,441 @@ np.import_array()
 # Node structure
 cdef struct node_float_int32_t:
     float cut_val
-    int8_t cut_dim
-    uint32_t start_idx
-    uint32_t n
     float cut_bounds_lv
     float cut_bounds_hv
-    node_float_int32_t *left_child
-    node_float_int32_t *right_child
+    uint32_t start_idx
+    uint32_t n
+    uint32_t right_child
+    int8_t cut_dim
 
 cdef struct tree_float_int32_t:
     float *bbox
     int8_t no_dims
     uint32_t *pidx
-    node_float_int32_t *root
+    node_float_int32_t *nodes
+    uint32_t num_nodes
+    int owns_arrays
+    float *leaf_data
+    float *boxsize
+    uint8_t *leaf_mask
+    uint8_t *node_masked
+    float sphere_radius
 
 cdef struct node_double_int32_t:
     double cut_val
-    int8_t cut_dim
-    uint32_t start_idx
-    uint32_t n
     double cut_bounds_lv
     double cut_bounds_hv
-    node_double_int32_t *left_child
-    node_double_int32_t *right_child
+    uint32_t start_idx
+    uint32_t n
+    uint32_t right_child
+    int8_t cut_dim
 
 cdef struct tree_double_int32_t:
     double *bbox
     int8_t no_dims
     uint32_t *pidx
-    node_double_int32_t *root
+    node_double_int32_t *nodes
+    uint32_t num_nodes
+    int owns_arrays
+    double *leaf_data
+    double *boxsize
+    uint8_t *leaf_mask
+    uint8_t *node_masked
+    double sphere_radius
 
 cdef struct node_float_int64_t:
     float cut_val
-    int8_t cut_dim
-    uint64_t start_idx
-    uint64_t n
     float cut_bounds_lv
     float cut_bounds_hv
-    node_float_int64_t *left_child
-    node_float_int64_t *right_child
+    uint64_t start_idx
+    uint64_t n
+    uint64_t right_child
+    int8_t cut_dim
 
 cdef struct tree_float_int64_t:
     float *bbox
     int8_t no_dims
     uint64_t *pidx
-    node_float_int64_t *root
+    node_float_int64_t *nodes
+    uint64_t num_nodes
+    int owns_arrays
+    float *leaf_data
+    float *boxsize
+    uint8_t *leaf_mask
+    uint8_t *node_masked
+    float sphere_radius
 
 cdef struct node_double_int64_t:
     double cut_val
-    int8_t cut_dim
-    uint64_t start_idx
-    uint64_t n
     double cut_bounds_lv
     double cut_bounds_hv
-    node_double_int64_t *left_child
-    node_double_int64_t *right_child
+    uint64_t start_idx
+    uint64_t n
+    uint64_t right_child
+    int8_t cut_dim
 
 cdef struct tree_double_int64_t:
     double *bbox
     int8_t no_dims
     uint64_t *pidx
-    node_double_int64_t *root
+    node_double_int64_t *nodes
+    uint64_t num_nodes
+    int owns_arrays
+    double *leaf_data
+    double *boxsize
+    uint8_t *leaf_mask
+    uint8_t *node_masked
+    double sphere_radius
+
+# Threading options
+cdef struct parallel_options:
+    int num_threads
+    int schedule
+    int chunk_size
 
-cdef extern tree_float_int32_t* construct_tree_float_int32_t(float *pa, int8_t no_dims, uint32_t n, uint32_t bsp) nogil
-cdef extern void search_tree_float_int32_t(tree_float_int32_t *kdtree, float *pa, float *point_coords, uint32_t num_points, uint32_t k, float distance_upper_bound, float eps_fac, uint8_t *mask, uint32_t *closest_idxs, float *closest_dists) nogil
+cdef extern void set_parallel_options(int num_threads, int schedule, int chunk_size, parallel_options *saved) nogil
+cdef extern void restore_parallel_options(parallel_options *saved) nogil
+cdef extern int get_max_threads() nogil
+
+cdef extern void load_points_float(const char *points, int point_type, int64_t point_stride, int64_t dim_stride, int8_t no_dims, uint64_t n, float *out) nogil
+cdef extern void load_points_double(const char *points, int point_type, int64_t point_stride, int64_t dim_stride, int8_t no_dims, uint64_t n, double *out) nogil
+
+cdef extern tree_float_int32_t* construct_tree_float_int32_t(float *pa, int8_t no_dims, uint32_t n, uint32_t bsp, int split_rule) nogil
+cdef extern void search_tree_float_int32_t(tree_float_int32_t *kdtree, float *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint32_t num_points, uint32_t k, int64_t *offsets, float distance_upper_bound, float *distance_upper_bounds, float eps_fac, int norm, float p, float *weights, uint8_t *mask, void *closest_idxs, int idx_size, uint64_t idxs_stride, float *closest_dists, uint64_t dists_stride, int mark_out_of_bounds, uint32_t out_of_bounds_idx, int sqr_dists, uint64_t *stats, double *thread_times, int reorder_queries, uint64_t max_leaves, uint64_t max_checks) nogil
+cdef extern tree_float_int32_t* create_tree_view_float_int32_t(int8_t no_dims, float *bbox, uint32_t *pidx, node_float_int32_t *nodes, uint32_t num_nodes)
 cdef extern void delete_tree_float_int32_t(tree_float_int32_t *kdtree)
+cdef extern void build_leaf_data_float_int32_t(tree_float_int32_t *kdtree, float *pa) nogil
+cdef extern void build_mask_float_int32_t(tree_float_int32_t *kdtree, uint8_t *mask) nogil
+cdef extern void search_knn_graph_float_int32_t(tree_float_int32_t *kdtree, float *pa, uint32_t k, int include_self, int sqr_dists, void *idxs, int idx_size, float *dists) nogil
+cdef extern void interpolate_tree_float_int32_t(tree_float_int32_t *kdtree, float *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint32_t num_points, uint32_t k, float distance_upper_bound, float eps, uint8_t *mask, float *values, int64_t num_channels, int weighting, double weight_param, float fill_value, float *out, int reorder_queries) nogil
+cdef extern uint64_t get_leaf_stats_float_int32_t(tree_float_int32_t *kdtree, uint32_t *leaf_depths, uint64_t *leaf_sizes)
+cdef extern void search_tree_ball_float_int32_t(tree_float_int32_t *kdtree, float *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint32_t num_points, float radius, float *radii, float eps, int norm, float p, float *weights, uint8_t *mask, int64_t *offsets, uint32_t **idxs, float **dists, int reorder_queries) nogil
 
-cdef extern tree_double_int32_t* construct_tree_double_int32_t(double *pa, int8_t no_dims, uint32_t n, uint32_t bsp) nogil
-cdef extern void search_tree_double_int32_t(tree_double_int32_t *kdtree, double *pa, double *point_coords, uint32_t num_points, uint32_t k, double distance_upper_bound, double eps_fac, uint8_t *mask, uint32_t *closest_idxs, double *closest_dists) nogil
+cdef extern tree_double_int32_t* construct_tree_double_int32_t(double *pa, int8_t no_dims, uint32_t n, uint32_t bsp, int split_rule) nogil
+cdef extern void search_tree_double_int32_t(tree_double_int32_t *kdtree, double *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint32_t num_points, uint32_t k, int64_t *offsets, double distance_upper_bound, double *distance_upper_bounds, double eps_fac, int norm, double p, double *weights, uint8_t *mask, void *closest_idxs, int idx_size, uint64_t idxs_stride, double *closest_dists, uint64_t dists_stride, int mark_out_of_bounds, uint32_t out_of_bounds_idx, int sqr_dists, uint64_t *stats, double *thread_times, int reorder_queries, uint64_t max_leaves, uint64_t max_checks) nogil
+cdef extern tree_double_int32_t* create_tree_view_double_int32_t(int8_t no_dims, double *bbox, uint32_t *pidx, node_double_int32_t *nodes, uint32_t num_nodes)
 cdef extern void delete_tree_double_int32_t(tree_double_int32_t *kdtree)
+cdef extern void build_leaf_data_double_int32_t(tree_double_int32_t *kdtree, double *pa) nogil
+cdef extern void build_mask_double_int32_t(tree_double_int32_t *kdtree, uint8_t *mask) nogil
+cdef extern void search_knn_graph_double_int32_t(tree_double_int32_t *kdtree, double *pa, uint32_t k, int include_self, int sqr_dists, void *idxs, int idx_size, double *dists) nogil
+cdef extern void interpolate_tree_double_int32_t(tree_double_int32_t *kdtree, double *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint32_t num_points, uint32_t k, double distance_upper_bound, double eps, uint8_t *mask, double *values, int64_t num_channels, int weighting, double weight_param, double fill_value, double *out, int reorder_queries) nogil
+cdef extern uint64_t get_leaf_stats_double_int32_t(tree_double_int32_t *kdtree, uint32_t *leaf_depths, uint64_t *leaf_sizes)
+cdef extern void search_tree_ball_double_int32_t(tree_double_int32_t *kdtree, double *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint32_t num_points, double radius, double *radii, double eps, int norm, double p, double *weights, uint8_t *mask, int64_t *offsets, uint32_t **idxs, double **dists, int reorder_queries) nogil
 
-cdef extern tree_float_int64_t* construct_tree_float_int64_t(float *pa, int8_t no_dims, uint64_t n, uint64_t bsp) nogil
-cdef extern void search_tree_float_int64_t(tree_float_int64_t *kdtree, float *pa, float *point_coords, uint64_t num_points, uint64_t k, float distance_upper_bound, float eps_fac, uint8_t *mask, uint64_t *closest_idxs, float *closest_dists) nogil
+cdef extern tree_float_int64_t* construct_tree_float_int64_t(float *pa, int8_t no_dims, uint64_t n, uint64_t bsp, int split_rule) nogil
+cdef extern void search_tree_float_int64_t(tree_float_int64_t *kdtree, float *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint64_t num_points, uint64_t k, int64_t *offsets, float distance_upper_bound, float *distance_upper_bounds, float eps_fac, int norm, float p, float *weights, uint8_t *mask, void *closest_idxs, int idx_size, uint64_t idxs_stride, float *closest_dists, uint64_t dists_stride, int mark_out_of_bounds, uint64_t out_of_bounds_idx, int sqr_dists, uint64_t *stats, double *thread_times, int reorder_queries, uint64_t max_leaves, uint64_t max_checks) nogil
+cdef extern tree_float_int64_t* create_tree_view_float_int64_t(int8_t no_dims, float *bbox, uint64_t *pidx, node_float_int64_t *nodes, uint64_t num_nodes)
 cdef extern void delete_tree_float_int64_t(tree_float_int64_t *kdtree)
+cdef extern void build_leaf_data_float_int64_t(tree_float_int64_t *kdtree, float *pa) nogil
+cdef extern void build_mask_float_int64_t(tree_float_int64_t *kdtree, uint8_t *mask) nogil
+cdef extern void search_knn_graph_float_int64_t(tree_float_int64_t *kdtree, float *pa, uint64_t k, int include_self, int sqr_dists, void *idxs, int idx_size, float *dists) nogil
+cdef extern void interpolate_tree_float_int64_t(tree_float_int64_t *kdtree, float *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint64_t num_points, uint64_t k, float distance_upper_bound, float eps, uint8_t *mask, float *values, int64_t num_channels, int weighting, double weight_param, float fill_value, float *out, int reorder_queries) nogil
+cdef extern uint64_t get_leaf_stats_float_int64_t(tree_float_int64_t *kdtree, uint32_t *leaf_depths, uint64_t *leaf_sizes)
+cdef extern void search_tree_ball_float_int64_t(tree_float_int64_t *kdtree, float *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint64_t num_points, float radius, float *radii, float eps, int norm, float p, float *weights, uint8_t *mask, int64_t *offsets, uint64_t **idxs, float **dists, int reorder_queries) nogil
 
-cdef extern tree_double_int64_t* construct_tree_double_int64_t(double *pa, int8_t no_dims, uint64_t n, uint64_t bsp) nogil
-cdef extern void search_tree_double_int64_t(tree_double_int64_t *kdtree, double *pa, double *point_coords, uint64_t num_points, uint64_t k, double distance_upper_bound, double eps_fac, uint8_t *mask, uint64_t *closest_idxs, double *closest_dists) nogil
+cdef extern tree_double_int64_t* construct_tree_double_int64_t(double *pa, int8_t no_dims, uint64_t n, uint64_t bsp, int split_rule) nogil
+cdef extern void search_tree_double_int64_t(tree_double_int64_t *kdtree, double *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint64_t num_points, uint64_t k, int64_t *offsets, double distance_upper_bound, double *distance_upper_bounds, double eps_fac, int norm, double p, double *weights, uint8_t *mask, void *closest_idxs, int idx_size, uint64_t idxs_stride, double *closest_dists, uint64_t dists_stride, int mark_out_of_bounds, uint64_t out_of_bounds_idx, int sqr_dists, uint64_t *stats, double *thread_times, int reorder_queries, uint64_t max_leaves, uint64_t max_checks) nogil
+cdef extern tree_double_int64_t* create_tree_view_double_int64_t(int8_t no_dims, double *bbox, uint64_t *pidx, node_double_int64_t *nodes, uint64_t num_nodes)
 cdef extern void delete_tree_double_int64_t(tree_double_int64_t *kdtree)
+cdef extern void build_leaf_data_double_int64_t(tree_double_int64_t *kdtree, double *pa) nogil
+cdef extern void build_mask_double_int64_t(tree_double_int64_t *kdtree, uint8_t *mask) nogil
+cdef extern void search_knn_graph_double_int64_t(tree_double_int64_t *kdtree, double *pa, uint64_t k, int include_self, int sqr_dists, void *idxs, int idx_size, double *dists) nogil
+cdef extern void interpolate_tree_double_int64_t(tree_double_int64_t *kdtree, double *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint64_t num_points, uint64_t k, double distance_upper_bound, double eps, uint8_t *mask, double *values, int64_t num_channels, int weighting, double weight_param, double fill_value, double *out, int reorder_queries) nogil
+cdef extern uint64_t get_leaf_stats_double_int64_t(tree_double_int64_t *kdtree, uint32_t *leaf_depths, uint64_t *leaf_sizes)
+cdef extern void search_tree_ball_double_int64_t(tree_double_int64_t *kdtree, double *pa, const char *point_coords, int point_type, int64_t point_stride, int64_t dim_stride, uint64_t num_points, double radius, double *radii, double eps, int norm, double p, double *weights, uint8_t *mask, int64_t *offsets, uint64_t **idxs, double **dists, int reorder_queries) nogil
+
+cdef extern void search_tree_pairs_float_int32_t_int32_t(tree_float_int32_t *tree1, float *pa1, tree_float_int32_t *tree2, float *pa2, float radius, int self_join, uint64_t *count, uint32_t **idxs1, uint32_t **idxs2, float **dists) nogil
+cdef extern void search_tree_pairs_float_int32_t_int64_t(tree_float_int32_t *tree1, float *pa1, tree_float_int64_t *tree2, float *pa2, float radius, int self_join, uint64_t *count, uint32_t **idxs1, uint64_t **idxs2, float **dists) nogil
+cdef extern void search_tree_pairs_float_int64_t_int32_t(tree_float_int64_t *tree1, float *pa1, tree_float_int32_t *tree2, float *pa2, float radius, int self_join, uint64_t *count, uint64_t **idxs1, uint32_t **idxs2, float **dists) nogil
+cdef extern void search_tree_pairs_float_int64_t_int64_t(tree_float_int64_t *tree1, float *pa1, tree_float_int64_t *tree2, float *pa2, float radius, int self_join, uint64_t *count, uint64_t **idxs1, uint64_t **idxs2, float **dists) nogil
+cdef extern void search_tree_pairs_double_int32_t_int32_t(tree_double_int32_t *tree1, double *pa1, tree_double_int32_t *tree2, double *pa2, double radius, int self_join, uint64_t *count, uint32_t **idxs1, uint32_t **idxs2, double **dists) nogil
+cdef extern void search_tree_pairs_double_int32_t_int64_t(tree_double_int32_t *tree1, double *pa1, tree_double_int64_t *tree2, double *pa2, double radius, int self_join, uint64_t *count, uint32_t **idxs1, uint64_t **idxs2, double **dists) nogil
+cdef extern void search_tree_pairs_double_int64_t_int32_t(tree_double_int64_t *tree1, double *pa1, tree_double_int32_t *tree2, double *pa2, double radius, int self_join, uint64_t *count, uint64_t **idxs1, uint32_t **idxs2, double **dists) nogil
+cdef extern void search_tree_pairs_double_int64_t_int64_t(tree_double_int64_t *tree1, double *pa1, tree_double_int64_t *tree2, double *pa2, double radius, int self_join, uint64_t *count, uint64_t **idxs1, uint64_t **idxs2, double **dists) nogil
+
+# On-disk format written by KDTree.save
+_FILE_MAGIC = b'PYKDTREE'
+_FILE_VERSION = 1
+_FILE_ALIGNMENT = 64
+
+# Trees of at least this many elements use 64-bit indices. Lowered by the
+# tests and benchmarks to run the 64-bit code paths on small trees.
+_INT32_INDEX_LIMIT = UINT32_MAX
+
+# Loop schedules of the queries, see SCHEDULE_* in _kdtree_core.c.mako
+_SCHEDULES = {'static': 1, 'dynamic': 2, 'guided': 3}
+
+# Rules for choosing the cutting planes, see SPLIT_* in _kdtree_core.c.mako
+_SPLIT_RULES = {'sliding_midpoint': 0, 'median': 1, 'cost': 2}
+
+# Minkowski norms of the distance kernels, see NORM_* in _kdtree_core.c.mako
+_NORMS = {2: 0, 1: 1, np.inf: 2}
+_NORM_LP = 3
+_NORM_WEIGHTED = 4
+
+def _num_threads(workers):
+    """Number of threads passed to set_parallel_options for a workers argument"""
+    if workers is None:
+        return 0
+    if workers == -1 or workers >= 1:
+        return workers
+    raise ValueError('workers must be a positive integer, -1 or None')
+
+def _check_out(out, shape, dtype, name):
+    """Check an output array passed to a query and return its row stride in elements"""
+    if not isinstance(out, np.ndarray):
+        raise TypeError('%s must be a numpy array' % name)
+    if out.shape != shape:
+        raise ValueError('%s must have shape %s' % (name, shape))
+    if out.dtype != dtype:
+        raise TypeError('%s must have dtype %s' % (name, np.dtype(dtype).name))
+    if not out.flags.writeable or not out.flags.aligned:
+        raise ValueError('%s must be writeable and aligned' % name)
+    row_len = shape[1] if len(shape) == 2 else 1
+    if row_len > 1 and out.strides[1] != out.itemsize:
+        raise ValueError('%s must be contiguous along the neighbours' % name)
+    if shape[0] < 2:
+        return row_len
+    if out.strides[0] < 0 or out.strides[0] % out.itemsize != 0:
+        raise ValueError('%s must have positive row strides' % name)
+    return out.strides[0] // out.itemsize
+
+# Element types of query points converted by the C code, see POINT_TYPE_* in _kdtree_core.c.mako
+_POINT_TYPES = {np.dtype(t): i for i, t in enumerate([np.float32, np.float64, np.int8, np.int16, np.int32,
+                                                        np.int64, np.uint8, np.uint16, np.uint32, np.uint64])}
+
+# Flag of the point types of longitude and latitude, see POINT_LONLAT in _kdtree_core.c.mako
+_POINT_LONLAT = 256
+
+def _query_points(query_pts, dtype):
+    """Query points in a layout read by the C code, with their element type and byte strides.
+    Points of other types are converted to dtype.
+    """
+    if query_pts.dtype not in _POINT_TYPES:
+        query_pts = np.require(query_pts, dtype=dtype, requirements='A')
+    elif not query_pts.flags.aligned:
+        query_pts = np.require(query_pts, requirements='A')
+    if query_pts.ndim == 1:
+        return query_pts, _POINT_TYPES[query_pts.dtype], query_pts.strides[0], query_pts.itemsize
+    return query_pts, _POINT_TYPES[query_pts.dtype], query_pts.strides[0], query_pts.strides[1]
+
+def _mask_array(mask):
+    """Mask as a contiguous array of bytes, boolean masks are used without a copy"""
+    if mask.dtype == np.bool_ and mask.flags.c_contiguous:
+        return mask.reshape(-1).view(np.uint8)
+    return np.ascontiguousarray(mask.ravel(), dtype=np.uint8)
+
+cdef object _node_dtype(object dtype, bint use_int32_t):
+    """Structured dtype of the index fields of the C nodes, for checking stored nodes"""
+    cdef node_float_int32_t node_float_int32
+    cdef node_float_int64_t node_float_int64
+    cdef node_double_int32_t node_double_int32
+    cdef node_double_int64_t node_double_int64
+    cdef char *base
+    if dtype == np.float32 and use_int32_t:
+        base = <char *>&node_float_int32
+        offsets = [<char *>&node_float_int32.start_idx - base, <char *>&node_float_int32.n - base,
+                   <char *>&node_float_int32.right_child - base, <char *>&node_float_int32.cut_dim - base]
+        itemsize = sizeof(node_float_int32_t)
+    elif dtype == np.float32:
+        base = <char *>&node_float_int64
+        offsets = [<char *>&node_float_int64.start_idx - base, <char *>&node_float_int64.n - base,
+                   <char *>&node_float_int64.right_child - base, <char *>&node_float_int64.cut_dim - base]
+        itemsize = sizeof(node_float_int64_t)
+    elif use_int32_t:
+        base = <char *>&node_double_int32
+        offsets = [<char *>&node_double_int32.start_idx - base, <char *>&node_double_int32.n - base,
+                   <char *>&node_double_int32.right_child - base, <char *>&node_double_int32.cut_dim - base]
+        itemsize = sizeof(node_double_int32_t)
+    else:
+        base = <char *>&node_double_int64
+        offsets = [<char *>&node_double_int64.start_idx - base, <char *>&node_double_int64.n - base,
+                   <char *>&node_double_int64.right_child - base, <char *>&node_double_int64.cut_dim - base]
+        itemsize = sizeof(node_double_int64_t)
+    index_dtype = np.uint32 if use_int32_t else np.uint64
+    return np.dtype({'names': ['start_idx', 'n', 'right_child', 'cut_dim'],
+                     'formats': [index_dtype, index_dtype, index_dtype, np.int8],
+                     'offsets': offsets, 'itemsize': itemsize})
+
+def _check_nodes(np.ndarray nodes, object dtype, bint use_int32_t, uint64_t n, int8_t ndim):
+    """Check that the children and points of stored nodes are inside the tree"""
+    node_array = nodes.view(_node_dtype(dtype, use_int32_t))
+    num_nodes = node_array.shape[0]
+    start_idx = node_array['start_idx'].astype(np.uint64)
+    num_points = node_array['n'].astype(np.uint64)
+    right_child = node_array['right_child'].astype(np.uint64)
+    cut_dim = node_array['cut_dim']
+    is_split = cut_dim != -1
+    # Children follow their parent, the left child directly
+    max_right_child = np.uint64(num_nodes) - np.arange(num_nodes, dtype=np.uint64)
+    if (np.any((cut_dim < -1) | (cut_dim >= ndim)) or np.any(start_idx > n)
+            or np.any(num_points > np.uint64(n) - np.minimum(start_idx, np.uint64(n)))
+            or np.any(is_split & ((right_child < 2) | (right_child >= max_right_child)))):
+        raise ValueError('kd-tree nodes are out of range')
+
+def _periodic_box(boxsize, data_pts):
+    """Side lengths of a periodic box as an array of the type of the data points"""
+    try:
+        box = np.array(np.broadcast_to(np.asarray(boxsize, dtype=data_pts.dtype), (data_pts.shape[1],)))
+    except ValueError:
+        raise ValueError('boxsize must be a scalar or have one value per dimension')
+    if not np.all(np.isfinite(box) & (box > 0)):
+        raise ValueError('boxsize must be positive and finite')
+    if np.any(data_pts < 0) or np.any(data_pts >= box):
+        raise ValueError('Data points must be inside the periodic box [0, boxsize)')
+    return box
+
+def _norm_kind(p, weights):
+    """Norm constant passed to the searches for a Minkowski p"""
+    if p in _NORMS:
+        norm = _NORMS[p]
+    elif p >= 1:
+        norm = _NORM_LP
+    else:
+        raise ValueError('p must be at least 1')
+    if weights is not None:
+        norm |= _NORM_WEIGHTED
+    return norm
+
+def _norm_weights(weights, ndim, dtype):
+    """Per dimension weights as a contiguous array of the given type"""
+    try:
+        weights = np.array(np.broadcast_to(np.asarray(weights, dtype=dtype), (ndim,)))
+    except ValueError:
+        raise ValueError('weights must be a scalar or have one value per dimension')
+    if not np.all(np.isfinite(weights) & (weights >= 0)):
+        raise ValueError('weights must be non-negative and finite')
+    return weights
+
+def _norm_dist(dist, p):
+    """Distance in the form used by the searches, the p-th power of the distance
+    or the distance itself for p=1 and p=inf
+    """
+    if p == 1 or p == np.inf:
+        return dist
+    return dist ** p
+
+def _chord_dist(dist, sphere_radius):
+    """Great-circle distance in the form used by the searches of spherical trees,
+    the squared length of the chord on the unit sphere
+    """
+    angle = np.asarray(dist, dtype=np.float64) / sphere_radius
+    return np.where(angle < np.pi, (2 * np.sin(angle / 2)) ** 2, np.inf)
+
+def _arc_dist(sqr_chord, sphere_radius):
+    """Convert squared chord lengths on the unit sphere to great-circle distances in place"""
+    np.sqrt(sqr_chord, out=sqr_chord)
+    sqr_chord *= 0.5
+    np.minimum(sqr_chord, 1, out=sqr_chord)
+    np.arcsin(sqr_chord, out=sqr_chord)
+    sqr_chord *= 2 * sphere_radius
+    return sqr_chord
+
+def _index_dtype(index_dtype, use_int32_t, n):
+    """dtype of the indices returned by a query for an index_dtype argument"""
+    if index_dtype is None:
+        return np.dtype(np.uint32 if use_int32_t else np.uint64)
+    dtype = np.dtype(index_dtype)
+    if dtype.kind not in 'iu' or dtype.itemsize not in (4, 8):
+        raise TypeError('index_dtype must be a 32 or 64-bit integer type')
+    # Missing neighbours are marked with the index n
+    if n > np.iinfo(dtype).max:
+        raise ValueError('index_dtype %s cannot hold the indices of the tree' % dtype)
+    return dtype
+
+def _schedule_kind(schedule, chunk_size):
+    """Schedule constant passed to set_parallel_options"""
+    if schedule not in _SCHEDULES:
+        raise ValueError('schedule must be one of %s' % ', '.join(_SCHEDULES))
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be greater than zero')
+    return _SCHEDULES[schedule]
+
+cdef void _free_capsule(object capsule) noexcept:
+    free(PyCapsule_GetPointer(capsule, NULL))
+
+cdef np.ndarray _owned_array(void *data, np.npy_intp size, int typenum):
+    """Wrap memory allocated with malloc by the C code in an array that frees it"""
+    cdef np.ndarray arr = np.PyArray_SimpleNewFromData(1, &size, typenum, data)
+    np.set_array_base(arr, PyCapsule_New(data, NULL, _free_capsule))
+    return arr
+
+def _load_chunk(chunks):
+    """Read the next chunk of query points into memory. Returns None when there are no more chunks."""
+    chunk = next(chunks, None)
+    if chunk is None:
+        return None
+    if isinstance(chunk, np.ndarray) and not isinstance(chunk, np.memmap):
+        return chunk
+    # Memory-mapped and array-like chunks are read here rather than in the search
+    return np.array(chunk)
+
+def _iter_query(KDTree tree, chunks, query_kwargs):
+    """Query the chunks one by one while the next chunk is read in a background thread.
+    Per query point k and distance_upper_bound arrays are split along with the query points.
+    """
+    per_point = {name: query_kwargs[name] for name in ('k', 'distance_upper_bound')
+                 if np.ndim(query_kwargs.get(name)) > 0}
+    cdef uint64_t start = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_chunk = executor.submit(_load_chunk, chunks)
+        while True:
+            query_pts = next_chunk.result()
+            if query_pts is None:
+                return
+            next_chunk = executor.submit(_load_chunk, chunks)
+            for name, values in per_point.items():
+                query_kwargs[name] = values[start:start + query_pts.shape[0]]
+            start += query_pts.shape[0]
+            yield tree.query(query_pts, **query_kwargs)
+
+def _kdtree_from_state(state):
+    """Recreate a KDTree from the state returned by KDTree._get_state"""
+    cdef KDTree tree = KDTree.__new__(KDTree)
+    tree._set_state(state)
+    return tree
 
 cdef class KDTree:
     """kd-tree for fast nearest-neighbour lookup.
-    The interface is made to resemble the scipy.spatial kd-tree except
-    only Euclidean distance measure is supported.
+    The interface is made to resemble the scipy.spatial kd-tree.
+    query and query_ball_point support Minkowski p-norms and weighted
+    dimensions, the other searches use the Euclidean distance.
 
     :Parameters:
     data_pts : numpy array
         Data points with shape (n , dims)
     leafsize : int, optional
         Maximum number of data points in tree leaf
+    workers : int, optional
+        Number of threads used to construct the tree. -1 uses all
+        processors. By default the OpenMP setting (OMP_NUM_THREADS)
+        is used.
+    reorder_data : bool, optional
+        Keep a copy of the data points in the order of the tree leaves.
+        Queries then read the points of a leaf from consecutive memory,
+        which is faster but doubles the memory used by the data points.
+    split_rule : {'sliding_midpoint', 'median', 'cost'}, optional
+        Rule for choosing the cutting plane of a node.
+        'sliding_midpoint' (default) cuts the longest side of the node
+        in the middle, moving the cut to the nearest point if one side
+        would be empty. 'median' cuts the longest side at the median of
+        the points giving a balanced tree. 'cost' chooses the dimension
+        and cut from a sample of the points, preferring cuts through
+        empty space between clusters of points.
+    boxsize : float or array_like, optional
+        Side lengths of a periodic box. Distances are measured the
+        shorter way around the box in every dimension, so points close
+        to opposite sides of the box are neighbours. The data points
+        must be inside [0, boxsize), query points are wrapped into the box.
+    spherical : bool, optional
+        The data points are longitude and latitude in degrees with shape
+        (n, 2) and distances are great-circle distances. The tree is
+        built on unit vectors, which data_pts holds. Query points are
+        longitude and latitude as well and are converted while searching.
+    sphere_radius : float, optional
+        Radius of the sphere for spherical trees. Distances, bounds and
+        radii are in the unit of the radius, e.g. metres for the radius
+        of the Earth in metres. The default of 1 gives radians.
     """
 
     cdef tree_float_int32_t *_kdtree_float_int32_t
@@ -127,6 +481,12 @@ cdef class KDTree:
     cdef readonly uint64_t n
     cdef readonly int8_t ndim
     cdef readonly uint32_t leafsize
+    cdef readonly bint reorder_data
+    cdef readonly str split_rule
+    cdef np.ndarray _boxsize
+    cdef tuple _tree_arrays
+    cdef bint _has_mask
+    cdef double _sphere_radius
 
     def __cinit__(KDTree self):
         self._kdtree_float_int32_t = NULL
@@ -134,15 +494,31 @@ cdef class KDTree:
         self._kdtree_float_int64_t = NULL
         self._kdtree_double_int64_t = NULL
 
-    def __init__(KDTree self, np.ndarray data_pts not None, int leafsize=16):
+    def __init__(KDTree self, np.ndarray data_pts not None, int leafsize=16, workers=None, bint reorder_data=False,
+                 split_rule='sliding_midpoint', boxsize=None, spherical=False, sphere_radius=1.0):
 
         # Check arguments
         if leafsize < 1:
             raise ValueError('leafsize must be greater than zero')
+        if split_rule not in _SPLIT_RULES:
+            raise ValueError('split_rule must be one of %s' % ', '.join(_SPLIT_RULES))
+        cdef int split_kind = _SPLIT_RULES[split_rule]
+        self.split_rule = split_rule
+        cdef int num_threads = _num_threads(workers)
+        cdef parallel_options saved_options
         if data_pts.ndim != 2:
             raise ValueError('data_pts array should have exactly 2 dimensions')
         if data_pts.size == 0:
             raise ValueError('data_pts should be non-empty')
+        if spherical:
+            if data_pts.shape[1] != 2:
+                raise ValueError('data_pts of a spherical tree must have shape (n, 2)')
+            if not (np.isfinite(sphere_radius) and sphere_radius > 0):
+                raise ValueError('sphere_radius must be positive and finite')
+            if boxsize is not None:
+                raise ValueError('boxsize is not supported for spherical trees')
+            data_pts = self._lonlat_to_xyz(data_pts, num_threads)
+            self._sphere_radius = sphere_radius
 
         # Get data content
         cdef np.ndarray[float, ndim=1] data_array_float
@@ -162,7 +538,8 @@ cdef class KDTree:
 
         # Get tree info
         self.n = <uint64_t>data_pts.shape[0]
-        self._use_int32_t = self.n * data_pts.shape[1] < UINT32_MAX
+        # The number of nodes is bounded by 2 * n so 1D trees also need room for that
+        self._use_int32_t = self.n * max(data_pts.shape[1], 2) < _INT32_INDEX_LIMIT
         self.leafsize = <uint32_t>leafsize
         if data_pts.ndim == 1:
             self.ndim = 1
@@ -170,191 +547,1393 @@ cdef class KDTree:
             raise ValueError('Max 127 dimensions allowed')
         else:
             self.ndim = <int8_t>data_pts.shape[1]
+        if boxsize is not None:
+            self._boxsize = _periodic_box(boxsize, self.data_pts.reshape(self.n, self.ndim))
 
         # Release GIL and construct tree
-        if data_pts.dtype == np.float32:
-            if self._use_int32_t:
-                with nogil:
-                    self._kdtree_float_int32_t = construct_tree_float_int32_t(self._data_pts_data_float, self.ndim,
-                                                              <uint32_t>self.n, self.leafsize)
+        set_parallel_options(num_threads, 0, 0, &saved_options)
+        try:
+            if data_pts.dtype == np.float32:
+                if self._use_int32_t:
+                    with nogil:
+                        self._kdtree_float_int32_t = construct_tree_float_int32_t(self._data_pts_data_float, self.ndim,
+                                                                  <uint32_t>self.n, self.leafsize, split_kind)
+                else:
+                    with nogil:
+                        self._kdtree_float_int64_t = construct_tree_float_int64_t(self._data_pts_data_float, self.ndim,
+                                                                  self.n, self.leafsize, split_kind)
             else:
+                if self._use_int32_t:
+                    with nogil:
+                        self._kdtree_double_int32_t = construct_tree_double_int32_t(self._data_pts_data_double, self.ndim,
+                                                                    <uint32_t>self.n, self.leafsize, split_kind)
+                else:
+                    with nogil:
+                        self._kdtree_double_int64_t = construct_tree_double_int64_t(self._data_pts_data_double, self.ndim,
+                                                                    self.n, self.leafsize, split_kind)
+            if reorder_data:
+                self._build_leaf_data()
+        finally:
+            restore_parallel_options(&saved_options)
+        self._attach_boxsize()
+        self._attach_sphere_radius()
+
+    @property
+    def boxsize(KDTree self):
+        """Side lengths of the periodic box or None"""
+        return None if self._boxsize is None else self._boxsize.copy()
+
+    @property
+    def spherical(KDTree self):
+        """True if the tree searches longitude and latitude by great-circle distance"""
+        return self._sphere_radius > 0
+
+    @property
+    def sphere_radius(KDTree self):
+        """Radius of the sphere of a spherical tree or None"""
+        return self._sphere_radius if self._sphere_radius > 0 else None
+
+    def _lonlat_to_xyz(KDTree self, np.ndarray lonlat, int num_threads):
+        """Unit vectors of longitude and latitude in degrees, in the precision of the tree"""
+        cdef int point_type
+        cdef int64_t point_stride, dim_stride
+        cdef parallel_options saved_options
+        dtype = np.float32 if lonlat.dtype == np.float32 else np.float64
+        lonlat, point_type, point_stride, dim_stride = _query_points(lonlat, dtype)
+        cdef const char *lonlat_data = <const char *>np.PyArray_DATA(lonlat)
+        cdef uint64_t n = lonlat.shape[0]
+        cdef np.ndarray xyz = np.empty((n, 3), dtype=dtype)
+        point_type |= _POINT_LONLAT
+        set_parallel_options(num_threads, 0, 0, &saved_options)
+        try:
+            if dtype == np.float32:
                 with nogil:
-                    self._kdtree_float_int64_t = construct_tree_float_int64_t(self._data_pts_data_float, self.ndim,
-                                                              self.n, self.leafsize)
-        else:
-            if self._use_int32_t:
-                with nogil:
-                    self._kdtree_double_int32_t = construct_tree_double_int32_t(self._data_pts_data_double, self.ndim,
-                                                                <uint32_t>self.n, self.leafsize)
+                    load_points_float(lonlat_data, point_type, point_stride, dim_stride, 3, n, <float *>np.PyArray_DATA(xyz))
             else:
                 with nogil:
-                    self._kdtree_double_int64_t = construct_tree_double_int64_t(self._data_pts_data_double, self.ndim,
-                                                                self.n, self.leafsize)
+                    load_points_double(lonlat_data, point_type, point_stride, dim_stride, 3, n, <double *>np.PyArray_DATA(xyz))
+        finally:
+            restore_parallel_options(&saved_options)
+        return xyz
+
+    cdef void _attach_sphere_radius(KDTree self) noexcept:
+        """Make the C tree search longitude and latitude by great-circle distance"""
+        if self._kdtree_float_int32_t != NULL:
+            self._kdtree_float_int32_t.sphere_radius = <float>self._sphere_radius
+        elif self._kdtree_float_int64_t != NULL:
+            self._kdtree_float_int64_t.sphere_radius = <float>self._sphere_radius
+        elif self._kdtree_double_int32_t != NULL:
+            self._kdtree_double_int32_t.sphere_radius = self._sphere_radius
+        else:
+            self._kdtree_double_int64_t.sphere_radius = self._sphere_radius
+
+    def _search_dist(KDTree self, dist, p):
+        """Distance in the form used by the searches of this tree"""
+        if self._sphere_radius > 0:
+            return _chord_dist(dist, self._sphere_radius)
+        return _norm_dist(dist, p)
+
+    def _check_query_dims(KDTree self, np.ndarray query_pts, p, weights):
+        """Check the dimensions of query points and the norm against the tree"""
+        q_ndim = 1 if query_pts.ndim == 1 else query_pts.shape[1]
+        if self._sphere_radius > 0:
+            if q_ndim != 2:
+                raise ValueError('Query points of a spherical tree must be longitude and latitude')
+            if p != 2 or weights is not None:
+                raise ValueError('p and weights are not supported for spherical trees')
+        elif self.ndim != q_ndim:
+            raise ValueError('Data and query points must have same dimensions')
+
+    cdef void _attach_boxsize(KDTree self) noexcept:
+        """Make the C tree use the periodic box"""
+        if self._boxsize is None:
+            return
+        if self._kdtree_float_int32_t != NULL:
+            self._kdtree_float_int32_t.boxsize = <float *>np.PyArray_DATA(self._boxsize)
+        elif self._kdtree_float_int64_t != NULL:
+            self._kdtree_float_int64_t.boxsize = <float *>np.PyArray_DATA(self._boxsize)
+        elif self._kdtree_double_int32_t != NULL:
+            self._kdtree_double_int32_t.boxsize = <double *>np.PyArray_DATA(self._boxsize)
+        else:
+            self._kdtree_double_int64_t.boxsize = <double *>np.PyArray_DATA(self._boxsize)
+
+    cdef void _build_leaf_data(KDTree self) noexcept:
+        """Build the leaf ordered copy of the data points"""
+        self.reorder_data = True
+        if self._kdtree_float_int32_t != NULL:
+            with nogil:
+                build_leaf_data_float_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float)
+        elif self._kdtree_float_int64_t != NULL:
+            with nogil:
+                build_leaf_data_float_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float)
+        elif self._kdtree_double_int32_t != NULL:
+            with nogil:
+                build_leaf_data_double_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double)
+        else:
+            with nogil:
+                build_leaf_data_double_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double)
 
 
     def query(KDTree self, np.ndarray query_pts not None, k=1, eps=0,
-              distance_upper_bound=None, sqr_dists=False, mask=None):
+              distance_upper_bound=None, sqr_dists=False, mask=None,
+              workers=None, schedule='static', chunk_size=100,
+              out_dists=None, out_idxs=None, p=2, weights=None, return_stats=False,
+              index_dtype=None, return_distance=True, reorder_queries=False,
+              max_leaves=None, max_checks=None):
         """Query the kd-tree for nearest neighbors
 
         :Parameters:
         query_pts : numpy array
             Query points with shape (m, dims)
-        k : int
-            The number of nearest neighbours to return
+        k : int or numpy array of ints
+            The number of nearest neighbours to return, or the number of
+            neighbours of each query point with shape (m,). Per query point
+            numbers of neighbours are returned in compressed sparse row layout.
         eps : non-negative float
             Return approximate nearest neighbours; the k-th returned value
             is guaranteed to be no further than (1 + eps) times the distance
             to the real k-th nearest neighbour
-        distance_upper_bound : non-negative float
-            Return only neighbors within this distance.
+        distance_upper_bound : non-negative float or numpy array
+            Return only neighbors within this distance, or within a
+            distance per query point with shape (m,).
             This is used to prune tree searches.
         sqr_dists : bool, optional
-            Internally pykdtree works with squared distances.
-            Determines if the squared or Euclidean distances are returned.
+            Internally pykdtree works with squared distances, or the p-th
+            power of the distances for other norms.
+            Determines if these or the actual distances are returned.
         mask : numpy array, optional
             Array of booleans where neighbors are considered invalid and
             should not be returned. A mask value of True represents an
             invalid pixel. Mask should have shape (n,) to match data points.
-            By default all points are considered valid.
+            By default the mask set with set_mask is used, if any,
+            otherwise all points are considered valid.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+        schedule : str, optional
+            How the query points are distributed over the threads,
+            one of 'static', 'dynamic' or 'guided'
+        chunk_size : int, optional
+            Number of consecutive query points handed to a thread at a
+            time. Small chunks of spatially coherent query points avoid
+            cache thrashing, larger dynamic chunks balance the load when
+            query times vary.
+        out_dists : numpy array, optional
+            Array the distances are written to instead of allocating
+            a new one. It must have the shape and dtype of the returned
+            distances but may be a view into a larger buffer.
+        out_idxs : numpy array, optional
+            Array the indices are written to, like out_dists
+        p : float, optional
+            Which Minkowski p-norm to use, 1 <= p <= infinity.
+            1 is the sum of absolute values, 2 the Euclidean distance
+            and infinity the maximum coordinate difference.
+        weights : float or numpy array, optional
+            Factors the coordinate differences are multiplied with,
+            one per dimension. The distances are those between the data
+            and query points scaled by the weights.
+        return_stats : bool, optional
+            Also return counters of the work done by the search, for
+            finding out why queries are slow. Searches without stats run
+            code without the counters. Only supported for the Euclidean
+            distance without boxsize.
+        index_dtype : numpy dtype, optional
+            Integer type of the returned indices, e.g. numpy.intp for
+            indexing without a conversion. By default uint32 for trees
+            with less than 2**32 elements and uint64 otherwise.
+        return_distance : bool, optional
+            Return the distances. If False only the indices are returned
+            and the distances are neither stored nor converted.
+        reorder_queries : bool, optional
+            Search the query points in the order of a space filling
+            curve through the tree instead of the given order. This
+            speeds up shuffled or scattered query points, where each
+            thread would otherwise jump across the whole tree. The
+            results are returned in the order of the query points.
+        max_leaves : int, optional
+            Return approximate nearest neighbours found by searching at
+            most this many leaves per query point. The leaves are searched
+            in the order of their distance to the query point (best bin
+            first), so the cost of each query is bounded while most
+            neighbours found are the exact ones. Neighbours not found
+            are marked like those beyond distance_upper_bound.
+            Only supported for the Euclidean distance without boxsize.
+        max_checks : int, optional
+            Like max_leaves, but limits the number of distances computed
+            per query point. The leaf reaching the limit is searched
+            completely.
+
+        :Returns:
+        distances : numpy array, only with return_distance
+            The distances to the nearest neighbours with shape (m, k),
+            or (m,) for k=1
+        indices : numpy array
+            The indices of the nearest neighbours, shaped like distances.
+            Returned on their own if they are the only result.
+        stats : dict, only with return_stats
+            'nodes_visited' : number of tree nodes visited per query point
+            'leaves_visited' : number of leaves searched per query point
+            'dist_evals' : number of distances computed per query point
+            'pruned' : number of subtrees skipped per query point
+            'thread_times' : seconds spent searching by each thread
+            The counters are arrays with shape (m,), their sums are the
+            totals of the query.
+
+        For a per query point k, (offsets, distances, indices) is returned.
+        The neighbours of query point i are distances[offsets[i]:offsets[i + 1]]
+        and indices[offsets[i]:offsets[i + 1]], offsets has shape (m + 1,).
 
         """
 
         # Check arguments
-        if k < 1:
+        cdef np.ndarray query_k = None
+        cdef np.ndarray query_bounds = None
+        if np.ndim(k) > 0:
+            query_k = np.asarray(k)
+            if query_k.dtype.kind not in 'iu':
+                raise TypeError('k must be an integer or an array of integers')
+            if np.any(query_k < 0):
+                raise ValueError('Number of neighbours must be non-negative')
+        elif k < 1:
             raise ValueError('Number of neighbours must be greater than zero')
-        elif eps < 0:
+        if eps < 0:
             raise ValueError('eps must be non-negative')
-        elif distance_upper_bound is not None:
-            if distance_upper_bound < 0:
+        if distance_upper_bound is not None:
+            if np.ndim(distance_upper_bound) > 0:
+                query_bounds = np.asarray(distance_upper_bound, dtype=np.float64)
+                if np.any(query_bounds < 0):
+                    raise ValueError('distance_upper_bound must be non negative')
+            elif distance_upper_bound < 0:
                 raise ValueError('distance_upper_bound must be non negative')
+        cdef int num_threads = _num_threads(workers)
+        cdef int norm = _norm_kind(p, weights)
+        cdef float p_float = <float>p
+        cdef double p_double = <double>p
+        cdef float *weights_float = NULL
+        cdef double *weights_double = NULL
+        cdef np.ndarray norm_weights
+        if norm != 0 and self._boxsize is not None:
+            raise ValueError('p and weights are not supported with a periodic boxsize')
+        if return_stats and (norm != 0 or self._boxsize is not None):
+            raise ValueError('return_stats is only supported for the Euclidean distance without boxsize')
+        cdef uint64_t c_max_leaves = 0
+        cdef uint64_t c_max_checks = 0
+        if max_leaves is not None or max_checks is not None:
+            if norm != 0 or self._boxsize is not None:
+                raise ValueError('max_leaves and max_checks are only supported for the Euclidean distance without boxsize')
+            if max_leaves is not None:
+                if max_leaves < 1:
+                    raise ValueError('max_leaves must be greater than zero')
+                c_max_leaves = max_leaves
+            if max_checks is not None:
+                if max_checks < 1:
+                    raise ValueError('max_checks must be greater than zero')
+                c_max_checks = max_checks
+        if weights is not None:
+            norm_weights = _norm_weights(weights, self.ndim, self.data_pts.dtype)
+            if self.data_pts.dtype == np.float32:
+                weights_float = <float *>np.PyArray_DATA(norm_weights)
+            else:
+                weights_double = <double *>np.PyArray_DATA(norm_weights)
+        cdef int schedule_kind = _schedule_kind(schedule, chunk_size)
+        cdef parallel_options saved_options
 
         # Check dimensions
-        if query_pts.ndim == 1:
-            q_ndim = 1
-        else:
-            q_ndim = query_pts.shape[1]
-
-        if self.ndim != q_ndim:
-            raise ValueError('Data and query points must have same dimensions')
-
-        if self.data_pts.dtype == np.float32 and query_pts.dtype != np.float32:
-            raise TypeError('Type mismatch. query points must be of type float32 when data points are of type float32')
+        self._check_query_dims(query_pts, p, weights)
 
         # Get query info
         cdef uint64_t num_qpoints = query_pts.shape[0]
-        cdef uint64_t num_n = k
-        cdef np.ndarray[uint32_t, ndim=1] closest_idxs_int32_t
-        cdef np.ndarray[uint64_t, ndim=1] closest_idxs_int64_t
-        cdef np.ndarray[float, ndim=1] closest_dists_float
-        cdef np.ndarray[double, ndim=1] closest_dists_double
-
-        # Set up return arrays
-        cdef uint32_t *closest_idxs_data_int32_t
-        cdef uint64_t *closest_idxs_data_int64_t
-        cdef float *closest_dists_data_float
-        cdef double *closest_dists_data_double
-        if self._use_int32_t:
-            closest_idxs_int32_t = np.empty(num_qpoints * k, dtype=np.uint32)
-            closest_idxs = closest_idxs_int32_t
-            closest_idxs_data_int32_t = <uint32_t *>closest_idxs_int32_t.data
+        cdef uint64_t num_n
+        cdef np.ndarray offsets = None
+        cdef int64_t *offsets_data = NULL
+        if query_k is not None:
+            if (query_k.ndim != 1 or query_k.shape[0] != num_qpoints):
+                raise ValueError('k must have one value per query point')
+            offsets = np.zeros(num_qpoints + 1, dtype=np.int64)
+            np.cumsum(query_k, out=offsets[1:])
+            offsets_data = <int64_t *>np.PyArray_DATA(offsets)
+            num_n = 0
+            result_shape = (offsets[num_qpoints],)
         else:
-            closest_idxs_int64_t = np.empty(num_qpoints * k, dtype=np.uint64)
-            closest_idxs = closest_idxs_int64_t
-            closest_idxs_data_int64_t = <uint64_t *>closest_idxs_int64_t.data
+            num_n = k
+            result_shape = (num_qpoints, k) if k > 1 else (num_qpoints,)
+        if query_bounds is not None and (query_bounds.ndim != 1 or query_bounds.shape[0] != num_qpoints):
+            raise ValueError('distance_upper_bound must have one value per query point')
+
+        # Set up return arrays, written in place by the C code
+        cdef uint64_t idxs_stride, dists_stride = 0
+        cdef void *closest_idxs_data
+        cdef float *closest_dists_data_float = NULL
+        cdef double *closest_dists_data_double = NULL
+        idxs_dtype = _index_dtype(index_dtype, self._use_int32_t, self.n)
+        dists_dtype = self.data_pts.dtype
+        if out_idxs is None:
+            out_idxs = np.empty(result_shape, dtype=idxs_dtype)
+        idxs_stride = _check_out(out_idxs, result_shape, idxs_dtype, 'out_idxs')
+        if not return_distance and out_dists is not None:
+            raise ValueError('out_dists cannot be used without return_distance')
+        if return_distance:
+            if out_dists is None:
+                out_dists = np.empty(result_shape, dtype=dists_dtype)
+            dists_stride = _check_out(out_dists, result_shape, dists_dtype, 'out_dists')
+        if query_k is not None and not (out_idxs.flags.c_contiguous and (out_dists is None or out_dists.flags.c_contiguous)):
+            raise ValueError('out_dists and out_idxs must be contiguous for a per query point k')
+        closest_idxs_data = np.PyArray_DATA(out_idxs)
+        cdef int idx_size = idxs_dtype.itemsize
+        if return_distance and self.data_pts.dtype == np.float32:
+            closest_dists_data_float = <float *>np.PyArray_DATA(out_dists)
+        elif return_distance:
+            closest_dists_data_double = <double *>np.PyArray_DATA(out_dists)
 
         # Get query points data      
-        cdef np.ndarray[float, ndim=1] query_array_float 
-        cdef np.ndarray[double, ndim=1] query_array_double 
-        cdef float *query_array_data_float 
-        cdef double *query_array_data_double
-        cdef np.ndarray[np.uint8_t, ndim=1] query_mask
+        cdef int point_type
+        cdef int64_t point_stride, dim_stride
+        query_pts, point_type, point_stride, dim_stride = _query_points(query_pts, self.data_pts.dtype)
+        cdef const char *query_data = <const char *>np.PyArray_DATA(query_pts)
+        cdef np.ndarray query_mask
         cdef np.uint8_t *query_mask_data
 
         if mask is not None and mask.size != self.n:
             raise ValueError('Mask must have the same size as data points')
-        elif mask is not None:
-            query_mask = np.ascontiguousarray(mask.ravel(), dtype=np.uint8)
-            query_mask_data = <uint8_t *>query_mask.data
+        if mask is not None:
+            query_mask = _mask_array(mask)
+            query_mask_data = <uint8_t *>np.PyArray_DATA(query_mask)
         else:
             query_mask_data = NULL
 
-
-        if query_pts.dtype == np.float32 and self.data_pts.dtype == np.float32:
-            closest_dists_float = np.empty(num_qpoints * k, dtype=np.float32)
-            closest_dists = closest_dists_float
-            closest_dists_data_float = <float *>closest_dists_float.data
-            query_array_float = np.ascontiguousarray(query_pts.ravel(), dtype=np.float32)
-            query_array_data_float = <float *>query_array_float.data
-        else:
-            closest_dists_double = np.empty(num_qpoints * k, dtype=np.float64)
-            closest_dists = closest_dists_double
-            closest_dists_data_double = <double *>closest_dists_double.data
-            query_array_double = np.ascontiguousarray(query_pts.ravel(), dtype=np.float64)
-            query_array_data_double = <double *>query_array_double.data
-
         # Setup distance_upper_bound
-        cdef float dub_float
-        cdef double dub_double
-        if distance_upper_bound is None:
+        cdef float dub_float = FLT_MAX
+        cdef double dub_double = DBL_MAX
+        cdef float *dubs_float = NULL
+        cdef double *dubs_double = NULL
+        # Neighbours not found within max_leaves or max_checks are marked as well
+        cdef int mark_out_of_bounds = distance_upper_bound is not None or c_max_leaves or c_max_checks
+        if query_bounds is not None:
+            query_bounds = np.ascontiguousarray(self._search_dist(query_bounds, p), dtype=self.data_pts.dtype)
             if self.data_pts.dtype == np.float32:
-                dub_float = <float>np.finfo(np.float32).max
+                dubs_float = <float *>np.PyArray_DATA(query_bounds)
             else:
-                dub_double = <double>np.finfo(np.float64).max
-        else:
+                dubs_double = <double *>np.PyArray_DATA(query_bounds)
+        elif distance_upper_bound is not None:
             if self.data_pts.dtype == np.float32:
-                dub_float = <float>(distance_upper_bound * distance_upper_bound)
+                dub_float = <float>self._search_dist(distance_upper_bound, p)
             else:
-                dub_double = <double>(distance_upper_bound * distance_upper_bound)
+                dub_double = <double>self._search_dist(distance_upper_bound, p)
 
         # Set epsilon
         cdef double epsilon_float = <float>eps
         cdef double epsilon_double = <double>eps
+        cdef int c_sqr_dists = bool(sqr_dists)
+        cdef int c_reorder_queries = bool(reorder_queries)
+
+        cdef np.ndarray query_stats = None
+        cdef np.ndarray thread_times = None
+        cdef uint64_t *query_stats_data = NULL
+        cdef double *thread_times_data = NULL
+
+        # Release GIL and query tree. The statistics arrays are sized by the
+        # thread count so they are allocated after setting the options.
+        set_parallel_options(num_threads, schedule_kind, chunk_size, &saved_options)
+        try:
+            if return_stats:
+                query_stats = np.zeros((num_qpoints, 4), dtype=np.uint64)
+                thread_times = np.zeros(get_max_threads(), dtype=np.float64)
+                query_stats_data = <uint64_t *>np.PyArray_DATA(query_stats)
+                thread_times_data = <double *>np.PyArray_DATA(thread_times)
+            if self.data_pts.dtype == np.float32:
+                if self._use_int32_t:
+                    with nogil:
+                        search_tree_float_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float,
+                                          query_data, point_type, point_stride, dim_stride, <uint32_t>num_qpoints, <uint32_t>num_n, offsets_data, dub_float, dubs_float, epsilon_float,
+                                          norm, p_float, weights_float, query_mask_data, closest_idxs_data, idx_size, idxs_stride, closest_dists_data_float, dists_stride,
+                                          mark_out_of_bounds, <uint32_t>self.n, c_sqr_dists,
+                                          query_stats_data, thread_times_data, c_reorder_queries, c_max_leaves, c_max_checks)
+                else:
+                    with nogil:
+                        search_tree_float_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float,
+                                          query_data, point_type, point_stride, dim_stride, num_qpoints, num_n, offsets_data, dub_float, dubs_float, epsilon_float,
+                                          norm, p_float, weights_float, query_mask_data, closest_idxs_data, idx_size, idxs_stride, closest_dists_data_float, dists_stride,
+                                          mark_out_of_bounds, self.n, c_sqr_dists,
+                                          query_stats_data, thread_times_data, c_reorder_queries, c_max_leaves, c_max_checks)
+            else:
+                if self._use_int32_t:
+                    with nogil:
+                        search_tree_double_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double,
+                                          query_data, point_type, point_stride, dim_stride, <uint32_t>num_qpoints, <uint32_t>num_n, offsets_data, dub_double, dubs_double, epsilon_double,
+                                          norm, p_double, weights_double, query_mask_data, closest_idxs_data, idx_size, idxs_stride, closest_dists_data_double, dists_stride,
+                                          mark_out_of_bounds, <uint32_t>self.n, c_sqr_dists,
+                                          query_stats_data, thread_times_data, c_reorder_queries, c_max_leaves, c_max_checks)
+                else:
+                    with nogil:
+                        search_tree_double_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double,
+                                          query_data, point_type, point_stride, dim_stride, num_qpoints, num_n, offsets_data, dub_double, dubs_double, epsilon_double,
+                                          norm, p_double, weights_double, query_mask_data, closest_idxs_data, idx_size, idxs_stride, closest_dists_data_double, dists_stride,
+                                          mark_out_of_bounds, self.n, c_sqr_dists,
+                                          query_stats_data, thread_times_data, c_reorder_queries, c_max_leaves, c_max_checks)
+        finally:
+            restore_parallel_options(&saved_options)
+
+        result = (out_dists, out_idxs) if return_distance else (out_idxs,)
+        if query_k is not None:
+            result = (offsets,) + result
+        if return_stats:
+            result += ({
+                'nodes_visited': query_stats[:, 0],
+                'leaves_visited': query_stats[:, 1],
+                'dist_evals': query_stats[:, 2],
+                'pruned': query_stats[:, 3],
+                'thread_times': thread_times,
+            },)
+        if len(result) == 1:
+            return out_idxs
+        return result
+
+    def query_iter(KDTree self, source, chunk_size=65536, **query_kwargs):
+        """Query the kd-tree for nearest neighbors one chunk of query points at a time
+
+        The next chunk is read while the current chunk is searched, so
+        reading overlaps with the search and only two chunks of query
+        points are held in memory.
+
+        :Parameters:
+        source : array-like or iterable
+            Query points with shape (m, dims). Arrays and array-like objects
+            with a shape that can be sliced, such as numpy memmaps or zarr
+            arrays, are split into chunks of chunk_size points. Any other
+            iterable is taken to yield the chunks of query points.
+        chunk_size : int, optional
+            Number of query points per chunk when slicing an array
+        **query_kwargs
+            Arguments of KDTree.query, such as k or distance_upper_bound.
+            Per query point arrays of k and distance_upper_bound are
+            split into chunks along with the query points.
+
+        :Returns:
+        Iterator of (dist, idx) tuples as returned by KDTree.query
+        for each chunk
+        """
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be greater than zero')
+        if hasattr(source, 'shape') and hasattr(source, '__getitem__'):
+            chunks = (source[start:start + chunk_size] for start in range(0, source.shape[0], chunk_size))
+        else:
+            chunks = iter(source)
+        return _iter_query(self, chunks, query_kwargs)
+
+    def query_ball_point(KDTree self, np.ndarray query_pts not None, r, eps=0,
+                         sqr_dists=False, mask=None, return_distance=False,
+                         workers=None, schedule='static', chunk_size=100, p=2, weights=None,
+                         reorder_queries=False):
+        """Find all data points within distance r of the query points
+
+        The result is returned in compressed sparse row layout so no
+        Python objects are created per query point. The neighbours of
+        query point i are idxs[offsets[i]:offsets[i + 1]], in no
+        particular order.
+
+        :Parameters:
+        query_pts : numpy array
+            Query points with shape (m, dims)
+        r : non-negative float or numpy array
+            Search radius, or the search radius of each query point
+            with shape (m,)
+        eps : non-negative float
+            Approximate search. Branches of the tree are not explored
+            if their nearest points are further than r / (1 + eps)
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances, or the p-th
+            power of the distances for other norms.
+            Determines if these or the actual distances are returned.
+        mask : numpy array, optional
+            Array of booleans where neighbors are considered invalid and
+            should not be returned. A mask value of True represents an
+            invalid pixel. Mask should have shape (n,) to match data points.
+            By default the mask set with set_mask is used, if any,
+            otherwise all points are considered valid.
+        return_distance : bool, optional
+            Also return the distances to the neighbours
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+        schedule : str, optional
+            How the query points are distributed over the threads,
+            one of 'static', 'dynamic' or 'guided'
+        chunk_size : int, optional
+            Number of consecutive query points handed to a thread at a
+            time. Small chunks of spatially coherent query points avoid
+            cache thrashing, larger dynamic chunks balance the load when
+            query times vary.
+        p : float, optional
+            Which Minkowski p-norm to use, see query
+        weights : float or numpy array, optional
+            Factors the coordinate differences are multiplied with, see query
+        reorder_queries : bool, optional
+            Search the query points in the order of a space filling
+            curve through the tree, see query
+
+        :Returns:
+        offsets : numpy array of int64
+            Start of the neighbours of each query point, shape (m + 1,)
+        idxs : numpy array
+            Indices of the neighbours
+        dists : numpy array
+            Distances to the neighbours, only if return_distance is True
+        """
+
+        # Check arguments
+        cdef np.ndarray query_radii = None
+        if np.ndim(r) > 0:
+            query_radii = np.asarray(r, dtype=np.float64)
+            if np.any(query_radii < 0):
+                raise ValueError('r must be non-negative')
+        elif r < 0:
+            raise ValueError('r must be non-negative')
+        if eps < 0:
+            raise ValueError('eps must be non-negative')
+        cdef int num_threads = _num_threads(workers)
+        cdef int schedule_kind = _schedule_kind(schedule, chunk_size)
+        cdef parallel_options saved_options
+        cdef int norm = _norm_kind(p, weights)
+        cdef float p_float = <float>p
+        cdef double p_double = <double>p
+        cdef float *weights_float = NULL
+        cdef double *weights_double = NULL
+        cdef np.ndarray norm_weights
+        if norm != 0 and self._boxsize is not None:
+            raise ValueError('p and weights are not supported with a periodic boxsize')
+        if weights is not None:
+            norm_weights = _norm_weights(weights, self.ndim, self.data_pts.dtype)
+            if self.data_pts.dtype == np.float32:
+                weights_float = <float *>np.PyArray_DATA(norm_weights)
+            else:
+                weights_double = <double *>np.PyArray_DATA(norm_weights)
+
+        # Check dimensions
+        self._check_query_dims(query_pts, p, weights)
 
+        cdef uint64_t num_qpoints = query_pts.shape[0]
+        cdef np.ndarray[int64_t, ndim=1] offsets = np.empty(num_qpoints + 1, dtype=np.int64)
+        cdef int64_t *offsets_data = <int64_t *>offsets.data
+
+        # Get query points data
+        cdef int point_type
+        cdef int64_t point_stride, dim_stride
+        query_pts, point_type, point_stride, dim_stride = _query_points(query_pts, self.data_pts.dtype)
+        cdef const char *query_data = <const char *>np.PyArray_DATA(query_pts)
+        cdef np.ndarray query_mask
+        cdef np.uint8_t *query_mask_data
+
+        if mask is not None and mask.size != self.n:
+            raise ValueError('Mask must have the same size as data points')
+        if mask is not None:
+            query_mask = _mask_array(mask)
+            query_mask_data = <uint8_t *>np.PyArray_DATA(query_mask)
+        else:
+            query_mask_data = NULL
         # Release GIL and query tree
+        cdef float radius_float = 0
+        cdef double radius_double = 0
+        cdef float *radii_float = NULL
+        cdef double *radii_double = NULL
+        if query_radii is not None:
+            if (query_radii.ndim != 1 or query_radii.shape[0] != num_qpoints):
+                raise ValueError('r must have one value per query point')
+            query_radii = np.ascontiguousarray(self._search_dist(query_radii, p), dtype=self.data_pts.dtype)
+            if self.data_pts.dtype == np.float32:
+                radii_float = <float *>np.PyArray_DATA(query_radii)
+            else:
+                radii_double = <double *>np.PyArray_DATA(query_radii)
+        else:
+            radius_float = <float>self._search_dist(r, p)
+            radius_double = <double>self._search_dist(r, p)
+        cdef float epsilon_float = <float>eps
+        cdef double epsilon_double = <double>eps
+        cdef uint32_t *idxs_int32_t = NULL
+        cdef uint64_t *idxs_int64_t = NULL
+        cdef float *dists_float = NULL
+        cdef double *dists_double = NULL
+        cdef float **dists_float_ptr = &dists_float if return_distance else NULL
+        cdef double **dists_double_ptr = &dists_double if return_distance else NULL
+        cdef int c_reorder_queries = bool(reorder_queries)
+        set_parallel_options(num_threads, schedule_kind, chunk_size, &saved_options)
+        try:
+            if self.data_pts.dtype == np.float32:
+                if self._use_int32_t:
+                    with nogil:
+                        search_tree_ball_float_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float,
+                                          query_data, point_type, point_stride, dim_stride, <uint32_t>num_qpoints, radius_float, radii_float, epsilon_float,
+                                          norm, p_float, weights_float, query_mask_data, offsets_data, &idxs_int32_t, dists_float_ptr, c_reorder_queries)
+                else:
+                    with nogil:
+                        search_tree_ball_float_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float,
+                                          query_data, point_type, point_stride, dim_stride, num_qpoints, radius_float, radii_float, epsilon_float,
+                                          norm, p_float, weights_float, query_mask_data, offsets_data, &idxs_int64_t, dists_float_ptr, c_reorder_queries)
+            else:
+                if self._use_int32_t:
+                    with nogil:
+                        search_tree_ball_double_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double,
+                                          query_data, point_type, point_stride, dim_stride, <uint32_t>num_qpoints, radius_double, radii_double, epsilon_double,
+                                          norm, p_double, weights_double, query_mask_data, offsets_data, &idxs_int32_t, dists_double_ptr, c_reorder_queries)
+                else:
+                    with nogil:
+                        search_tree_ball_double_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double,
+                                          query_data, point_type, point_stride, dim_stride, num_qpoints, radius_double, radii_double, epsilon_double,
+                                          norm, p_double, weights_double, query_mask_data, offsets_data, &idxs_int64_t, dists_double_ptr, c_reorder_queries)
+        finally:
+            restore_parallel_options(&saved_options)
+
+        # Hand the result arrays over to numpy
+        cdef np.npy_intp num_results = offsets[num_qpoints]
+        if self._use_int32_t:
+            idxs = _owned_array(idxs_int32_t, num_results, np.NPY_UINT32)
+        else:
+            idxs = _owned_array(idxs_int64_t, num_results, np.NPY_UINT64)
+        if not return_distance:
+            return offsets, idxs
+
         if self.data_pts.dtype == np.float32:
-            if self._use_int32_t:
+            dists = _owned_array(dists_float, num_results, np.NPY_FLOAT32)
+        else:
+            dists = _owned_array(dists_double, num_results, np.NPY_FLOAT64)
+        if not sqr_dists: # Return actual distances
+            if self._sphere_radius > 0:
+                _arc_dist(dists, self._sphere_radius)
+            elif p == 2:
+                np.sqrt(dists, out=dists)
+            elif p != 1 and p != np.inf:
+                np.power(dists, 1 / p, out=dists)
+        return offsets, idxs, dists
+
+    def knn_graph(KDTree self, k, include_self=False, sqr_dists=False, workers=None):
+        """Find the k nearest neighbours of every data point of the tree
+
+        The data points are not queried from the root one by one. The
+        leaves are walked directly, the distances between the points of
+        a leaf are computed once and the nearest of them bound the search
+        of each point from the start.
+
+        :Parameters:
+        k : int
+            Number of neighbours per data point
+        include_self : bool, optional
+            Count each point as its own nearest neighbour. By default the
+            point itself is left out of its neighbours.
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or actual distances are returned.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        offsets : numpy array of int32 or int64
+            Start of the neighbours of each data point, shape (n + 1,)
+        idxs : numpy array of int32 or int64
+            Indices of the neighbours sorted by distance, shape (n * k,)
+        dists : numpy array
+            Distances to the neighbours, shape (n * k,)
+
+        The result is the compressed sparse row layout of the adjacency
+        matrix. offsets and idxs are int32 if n * k < 2**31, as scipy.sparse
+        uses for such matrices, so scipy.sparse.csr_matrix((dists, idxs,
+        offsets), shape=(n, n)) uses the arrays without copying them.
+        The mask set with set_mask is not applied.
+        """
+        if k < 1:
+            raise ValueError('Number of neighbours must be greater than zero')
+        if k + (not include_self) > self.n:
+            raise ValueError('Number of neighbours must be less than the number of data points')
+        if self._boxsize is not None:
+            raise ValueError('knn_graph is not supported with a periodic boxsize')
+        cdef int num_threads = _num_threads(workers)
+        cdef parallel_options saved_options
+        cdef uint64_t num_k = k
+        cdef int c_include_self = bool(include_self)
+        cdef int c_sqr_dists = bool(sqr_dists)
+        # scipy.sparse keeps int32 indices as they are while the values fit
+        idxs_dtype = np.dtype(np.int32 if self.n * k < 2**31 else np.int64)
+        cdef int idx_size = idxs_dtype.itemsize
+        cdef np.ndarray offsets = np.arange(0, self.n * k + 1, k, dtype=idxs_dtype)
+        cdef np.ndarray idxs = np.empty(self.n * k, dtype=idxs_dtype)
+        cdef np.ndarray dists = np.empty(self.n * k, dtype=self.data_pts.dtype)
+        cdef void *idxs_data = np.PyArray_DATA(idxs)
+        cdef float *dists_float = NULL
+        cdef double *dists_double = NULL
+        if self.data_pts.dtype == np.float32:
+            dists_float = <float *>np.PyArray_DATA(dists)
+        else:
+            dists_double = <double *>np.PyArray_DATA(dists)
+
+        set_parallel_options(num_threads, 0, 0, &saved_options)
+        try:
+            if self._kdtree_float_int32_t != NULL:
+                with nogil:
+                    search_knn_graph_float_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float, <uint32_t>num_k,
+                                                   c_include_self, c_sqr_dists, idxs_data, idx_size, dists_float)
+            elif self._kdtree_float_int64_t != NULL:
+                with nogil:
+                    search_knn_graph_float_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float, <uint64_t>num_k,
+                                                   c_include_self, c_sqr_dists, idxs_data, idx_size, dists_float)
+            elif self._kdtree_double_int32_t != NULL:
                 with nogil:
-                    search_tree_float_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float,
-                                      query_array_data_float, <uint32_t>num_qpoints, <uint32_t>num_n, dub_float, epsilon_float,
-                                      query_mask_data, closest_idxs_data_int32_t, closest_dists_data_float)
+                    search_knn_graph_double_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double, <uint32_t>num_k,
+                                                    c_include_self, c_sqr_dists, idxs_data, idx_size, dists_double)
             else:
                 with nogil:
-                    search_tree_float_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float,
-                                      query_array_data_float, num_qpoints, num_n, dub_float, epsilon_float,
-                                      query_mask_data, closest_idxs_data_int64_t, closest_dists_data_float)
+                    search_knn_graph_double_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double, <uint64_t>num_k,
+                                                    c_include_self, c_sqr_dists, idxs_data, idx_size, dists_double)
+        finally:
+            restore_parallel_options(&saved_options)
+        return offsets, idxs, dists
+
+    def interpolate(KDTree self, np.ndarray query_pts not None, values not None, k=8,
+                    weighting='idw', radius=None, power=2, sigma=None, fill_value=np.nan,
+                    eps=0, mask=None, workers=None, reorder_queries=False):
+        """Interpolate values of the data points at the query points
+
+        Each query point gets the weighted average of the values of its k
+        nearest neighbours. The weights are computed while searching, so
+        the neighbours and their distances are never stored. This needs
+        far less memory than query followed by a weighted sum in numpy.
+
+        :Parameters:
+        query_pts : numpy array
+            Query points with shape (m, dims)
+        values : numpy array
+            Values of the data points with shape (n,) or (n, channels).
+            They are converted to the type of the data points.
+        k : int, optional
+            Number of neighbours averaged
+        weighting : str, optional
+            'idw' for inverse distance weights 1 / dist**power, or
+            'gaussian' for weights exp(-dist**2 / (2 * sigma**2)).
+            With 'idw', query points that coincide with data points
+            get the values of those points.
+        radius : non-negative float, optional
+            Only use neighbours within this distance
+        power : positive float, optional
+            Power of the inverse distance weights
+        sigma : positive float
+            Width of the Gaussian weights, required for 'gaussian'
+        fill_value : float, optional
+            Value of query points without neighbours within radius
+        eps : non-negative float
+            Use approximate nearest neighbours, see query
+        mask : numpy array, optional
+            Array of booleans where data points should not be used,
+            see query. By default the mask set with set_mask is used.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+        reorder_queries : bool, optional
+            Search the query points in the order of a space filling
+            curve through the tree, see query
+
+        :Returns:
+        interpolated : numpy array
+            Values at the query points with shape (m,) or (m, channels)
+            and the type of the data points
+
+        For spherical trees radius and sigma are great-circle distances.
+        """
+
+        # Check arguments
+        if k < 1:
+            raise ValueError('Number of neighbours must be greater than zero')
+        if eps < 0:
+            raise ValueError('eps must be non-negative')
+        if radius is not None and radius < 0:
+            raise ValueError('radius must be non negative')
+        cdef int c_weighting
+        cdef double weight_param
+        if weighting == 'idw':
+            if power <= 0:
+                raise ValueError('power must be positive')
+            c_weighting = 0
+            weight_param = power
+        elif weighting == 'gaussian':
+            if sigma is None or sigma <= 0:
+                raise ValueError('weighting gaussian requires a positive sigma')
+            c_weighting = 1
+            weight_param = sigma
         else:
-            if self._use_int32_t:
+            raise ValueError("weighting must be 'idw' or 'gaussian'")
+        self._check_query_dims(query_pts, 2, None)
+        cdef np.ndarray point_values = np.ascontiguousarray(values, dtype=self.data_pts.dtype)
+        if point_values.ndim not in (1, 2) or point_values.shape[0] != self.n:
+            raise ValueError('values must have shape (n,) or (n, channels) to match data points')
+        cdef int64_t num_channels = 1 if point_values.ndim == 1 else point_values.shape[1]
+        cdef int num_threads = _num_threads(workers)
+        cdef parallel_options saved_options
+
+        # Get query points data
+        cdef uint64_t num_qpoints = query_pts.shape[0]
+        cdef uint64_t num_k = k
+        cdef int point_type
+        cdef int64_t point_stride, dim_stride
+        query_pts, point_type, point_stride, dim_stride = _query_points(query_pts, self.data_pts.dtype)
+        cdef const char *query_data = <const char *>np.PyArray_DATA(query_pts)
+        cdef np.ndarray query_mask
+        cdef uint8_t *query_mask_data = NULL
+        if mask is not None and mask.size != self.n:
+            raise ValueError('Mask must have the same size as data points')
+        if mask is not None:
+            query_mask = _mask_array(mask)
+            query_mask_data = <uint8_t *>np.PyArray_DATA(query_mask)
+
+        # Set up the return array, written in place by the C code
+        cdef np.ndarray interpolated = np.empty((num_qpoints,) + (<object>point_values).shape[1:], dtype=self.data_pts.dtype)
+        cdef float *values_float = NULL
+        cdef double *values_double = NULL
+        cdef float *out_float = NULL
+        cdef double *out_double = NULL
+        cdef float dub_float = FLT_MAX
+        cdef double dub_double = DBL_MAX
+        cdef float eps_float = <float>eps
+        cdef double eps_double = <double>eps
+        cdef float fill_float = <float>fill_value
+        cdef double fill_double = <double>fill_value
+        cdef int c_reorder_queries = bool(reorder_queries)
+        if self.data_pts.dtype == np.float32:
+            values_float = <float *>np.PyArray_DATA(point_values)
+            out_float = <float *>np.PyArray_DATA(interpolated)
+            if radius is not None:
+                dub_float = <float>self._search_dist(radius, 2)
+        else:
+            values_double = <double *>np.PyArray_DATA(point_values)
+            out_double = <double *>np.PyArray_DATA(interpolated)
+            if radius is not None:
+                dub_double = <double>self._search_dist(radius, 2)
+
+        set_parallel_options(num_threads, 0, 0, &saved_options)
+        try:
+            if self._kdtree_float_int32_t != NULL:
+                with nogil:
+                    interpolate_tree_float_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float, query_data, point_type,
+                                                   point_stride, dim_stride, <uint32_t>num_qpoints, <uint32_t>num_k, dub_float,
+                                                   eps_float, query_mask_data, values_float, num_channels, c_weighting,
+                                                   weight_param, fill_float, out_float, c_reorder_queries)
+            elif self._kdtree_float_int64_t != NULL:
                 with nogil:
-                    search_tree_double_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double,
-                                      query_array_data_double, <uint32_t>num_qpoints, <uint32_t>num_n, dub_double, epsilon_double,
-                                       query_mask_data, closest_idxs_data_int32_t, closest_dists_data_double)
+                    interpolate_tree_float_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float, query_data, point_type,
+                                                   point_stride, dim_stride, num_qpoints, num_k, dub_float,
+                                                   eps_float, query_mask_data, values_float, num_channels, c_weighting,
+                                                   weight_param, fill_float, out_float, c_reorder_queries)
+            elif self._kdtree_double_int32_t != NULL:
+                with nogil:
+                    interpolate_tree_double_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double, query_data, point_type,
+                                                    point_stride, dim_stride, <uint32_t>num_qpoints, <uint32_t>num_k, dub_double,
+                                                    eps_double, query_mask_data, values_double, num_channels, c_weighting,
+                                                    weight_param, fill_double, out_double, c_reorder_queries)
             else:
                 with nogil:
-                    search_tree_double_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double,
-                                      query_array_data_double, num_qpoints, num_n, dub_double, epsilon_double,
-                                       query_mask_data, closest_idxs_data_int64_t, closest_dists_data_double)
-
-        # Shape result
-        if k > 1:
-            closest_dists_res = closest_dists.reshape(num_qpoints, k)
-            closest_idxs_res = closest_idxs.reshape(num_qpoints, k)
+                    interpolate_tree_double_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double, query_data, point_type,
+                                                    point_stride, dim_stride, num_qpoints, num_k, dub_double,
+                                                    eps_double, query_mask_data, values_double, num_channels, c_weighting,
+                                                    weight_param, fill_double, out_double, c_reorder_queries)
+        finally:
+            restore_parallel_options(&saved_options)
+        return interpolated
+
+    def query_pairs(KDTree self, r, sqr_dists=False, return_distance=False, workers=None):
+        """Find all pairs of data points within distance r of each other
+
+        The pairs are found with a dual tree traversal and returned in
+        coordinate (COO) layout, in no particular order. Each pair is
+        returned once with i < j.
+
+        :Parameters:
+        r : non-negative float
+            Maximum distance
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or Euclidean distances are returned.
+        return_distance : bool, optional
+            Also return the distances between the pairs
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        i : numpy array
+            Index of first point of each pair
+        j : numpy array
+            Index of second point of each pair
+        dists : numpy array
+            Distances between the pairs, only if return_distance is True
+        """
+        i, j, dists = self._search_pairs(self, r, True, False, sqr_dists, workers)
+        if return_distance:
+            return i, j, dists
+        return i, j
+
+    def sparse_distance_matrix(KDTree self, KDTree other not None, r, sqr_dists=False, workers=None):
+        """Distances between all pairs of points of this tree and another
+        tree that are within distance r of each other
+
+        The result is returned in coordinate (COO) layout, in no particular
+        order, and can be passed directly to scipy.sparse.coo_matrix as
+        ``coo_matrix((dists, (i, j)), shape=(self.n, other.n))``.
+
+        :Parameters:
+        other : KDTree
+            Tree of the other set of points
+        r : non-negative float
+            Maximum distance
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or Euclidean distances are returned.
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        i : numpy array
+            Index into the data points of this tree
+        j : numpy array
+            Index into the data points of the other tree
+        dists : numpy array
+            Distance between the points
+        """
+        return self._search_pairs(other, r, False, False, sqr_dists, workers)
+
+    def count_neighbors(KDTree self, KDTree other not None, r, workers=None):
+        """Count the pairs of points of this tree and another tree that
+        are within distance r of each other
+
+        Pairs of tree nodes that are completely within distance r are
+        counted without visiting their points.
+
+        :Parameters:
+        other : KDTree
+            Tree of the other set of points
+        r : non-negative float
+            Maximum distance
+        workers : int, optional
+            Number of threads used for this call. -1 uses all processors.
+            By default the OpenMP setting (OMP_NUM_THREADS) is used.
+
+        :Returns:
+        count : int
+            Number of pairs
+        """
+        return self._search_pairs(other, r, False, True, False, workers)
+
+    def set_mask(KDTree self, mask):
+        """Set the mask used by queries that are not given a mask
+
+        The mask is stored once, bit-packed in the order of the leaves of
+        the tree, so the queries neither copy it nor read it scattered
+        across memory. Subtrees whose points are all masked are skipped
+        by the search. The mask is not saved or pickled with the tree.
+
+        :Parameters:
+        mask : numpy array or None
+            Array of booleans with shape (n,) where True marks data points
+            that are not returned by the queries. None removes the mask.
+        """
+        cdef np.ndarray tree_mask
+        cdef uint8_t *tree_mask_data = NULL
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.size != self.n:
+                raise ValueError('Mask must have the same size as data points')
+            tree_mask = _mask_array(mask)
+            tree_mask_data = <uint8_t *>np.PyArray_DATA(tree_mask)
+        with nogil:
+            if self._kdtree_float_int32_t != NULL:
+                build_mask_float_int32_t(self._kdtree_float_int32_t, tree_mask_data)
+            elif self._kdtree_float_int64_t != NULL:
+                build_mask_float_int64_t(self._kdtree_float_int64_t, tree_mask_data)
+            elif self._kdtree_double_int32_t != NULL:
+                build_mask_double_int32_t(self._kdtree_double_int32_t, tree_mask_data)
+            else:
+                build_mask_double_int64_t(self._kdtree_double_int64_t, tree_mask_data)
+        self._has_mask = mask is not None
+
+    @property
+    def mask(KDTree self):
+        """Mask set with set_mask as an array of booleans, or None"""
+        if not self._has_mask:
+            return None
+        cdef uint8_t *leaf_mask
+        if self._kdtree_float_int32_t != NULL:
+            leaf_mask = self._kdtree_float_int32_t.leaf_mask
+        elif self._kdtree_float_int64_t != NULL:
+            leaf_mask = self._kdtree_float_int64_t.leaf_mask
+        elif self._kdtree_double_int32_t != NULL:
+            leaf_mask = self._kdtree_double_int32_t.leaf_mask
         else:
-            closest_dists_res = closest_dists
-            closest_idxs_res = closest_idxs
+            leaf_mask = self._kdtree_double_int64_t.leaf_mask
+        bits = self._array_view(leaf_mask, (self.n + 7) // 8, np.NPY_UINT8)
+        mask = np.empty(self.n, dtype=np.bool_)
+        mask[self._get_state()['pidx']] = np.unpackbits(bits, count=self.n, bitorder='little')
+        return mask
 
-        if distance_upper_bound is not None: # Mark out of bounds results
-            if self.data_pts.dtype == np.float32:
-                idx_out = (closest_dists_res >= dub_float)
+    def tree_stats(KDTree self):
+        """Statistics of the shape of the tree
+
+        Useful for comparing split rules on a data set.
+        Queries are fastest for shallow trees with full leaves.
+
+        :Returns:
+        stats : dict
+            'num_nodes' : number of nodes
+            'num_leaves' : number of leaves
+            'max_depth' : depth of the deepest leaf, the root is at depth 0
+            'mean_depth' : mean depth of the leaf holding a data point
+            'leaf_depths' : depth of every leaf in depth-first order
+            'leaf_sizes' : number of points in every leaf in depth-first order
+            'leaf_size_hist' : number of leaves holding 0, 1, 2, ... points
+            'nodes_nbytes' : memory used by the nodes in bytes
+            'pidx_nbytes' : memory used by the permutation index of the
+                            data points in bytes
+            'leaf_data_nbytes' : memory used by the leaf ordered copy of
+                                 the data points in bytes, see reorder_data
+        """
+        cdef uint64_t num_nodes
+        if self._kdtree_float_int32_t != NULL:
+            num_nodes = self._kdtree_float_int32_t.num_nodes
+        elif self._kdtree_float_int64_t != NULL:
+            num_nodes = self._kdtree_float_int64_t.num_nodes
+        elif self._kdtree_double_int32_t != NULL:
+            num_nodes = self._kdtree_double_int32_t.num_nodes
+        else:
+            num_nodes = self._kdtree_double_int64_t.num_nodes
+
+        # A binary tree has fewer leaves than nodes
+        cdef np.ndarray[uint32_t, ndim=1] leaf_depths = np.empty(num_nodes, dtype=np.uint32)
+        cdef np.ndarray[uint64_t, ndim=1] leaf_sizes = np.empty(num_nodes, dtype=np.uint64)
+        cdef uint32_t *leaf_depths_data = <uint32_t *>leaf_depths.data
+        cdef uint64_t *leaf_sizes_data = <uint64_t *>leaf_sizes.data
+        cdef uint64_t num_leaves
+        if self._kdtree_float_int32_t != NULL:
+            num_leaves = get_leaf_stats_float_int32_t(self._kdtree_float_int32_t, leaf_depths_data, leaf_sizes_data)
+        elif self._kdtree_float_int64_t != NULL:
+            num_leaves = get_leaf_stats_float_int64_t(self._kdtree_float_int64_t, leaf_depths_data, leaf_sizes_data)
+        elif self._kdtree_double_int32_t != NULL:
+            num_leaves = get_leaf_stats_double_int32_t(self._kdtree_double_int32_t, leaf_depths_data, leaf_sizes_data)
+        else:
+            num_leaves = get_leaf_stats_double_int64_t(self._kdtree_double_int64_t, leaf_depths_data, leaf_sizes_data)
+
+        depths = leaf_depths[:num_leaves].copy()
+        sizes = leaf_sizes[:num_leaves].copy()
+        state = self._get_state()
+        return {
+            'num_nodes': num_nodes,
+            'num_leaves': num_leaves,
+            'max_depth': int(depths.max()),
+            'mean_depth': float(np.dot(depths, sizes) / self.n),
+            'leaf_depths': depths,
+            'leaf_sizes': sizes,
+            'leaf_size_hist': np.bincount(sizes),
+            'nodes_nbytes': state['nodes'].nbytes,
+            'pidx_nbytes': state['pidx'].nbytes,
+            'leaf_data_nbytes': self.data_pts.nbytes if self.reorder_data else 0,
+        }
+
+    def _search_pairs(KDTree self, KDTree other, r, bint self_join, bint count_only, sqr_dists, workers):
+        """Run a dual tree search of this tree and another tree"""
+
+        # Check arguments
+        if r < 0:
+            raise ValueError('r must be non-negative')
+        if self.ndim != other.ndim:
+            raise ValueError('Trees must have same dimensions')
+        if self.data_pts.dtype != other.data_pts.dtype:
+            raise TypeError('Type mismatch. Both trees must have data points of the same type')
+        if not np.array_equal(self.boxsize, other.boxsize):
+            raise ValueError('Trees must have the same periodic box')
+        if self._sphere_radius != other._sphere_radius:
+            raise ValueError('Trees must be both spherical with the same sphere_radius or both not spherical')
+        cdef int num_threads = _num_threads(workers)
+        cdef parallel_options saved_options
+
+        cdef float radius_float = <float>self._search_dist(r, 2)
+        cdef double radius_double = <double>self._search_dist(r, 2)
+        cdef uint64_t count = 0
+        cdef uint32_t *idxs1_int32_t = NULL
+        cdef uint64_t *idxs1_int64_t = NULL
+        cdef uint32_t *idxs2_int32_t = NULL
+        cdef uint64_t *idxs2_int64_t = NULL
+        cdef float *dists_float = NULL
+        cdef double *dists_double = NULL
+        # Pairs are only counted when no index output is requested
+        cdef uint32_t **idxs1_int32_t_ptr = NULL if count_only else &idxs1_int32_t
+        cdef uint64_t **idxs1_int64_t_ptr = NULL if count_only else &idxs1_int64_t
+
+        # Release GIL and search trees
+        set_parallel_options(num_threads, 0, 0, &saved_options)
+        try:
+            if self._kdtree_float_int32_t != NULL and other._kdtree_float_int32_t != NULL:
+                with nogil:
+                    search_tree_pairs_float_int32_t_int32_t(self._kdtree_float_int32_t, self._data_pts_data_float,
+                                      other._kdtree_float_int32_t, other._data_pts_data_float, radius_float, self_join,
+                                      &count, idxs1_int32_t_ptr, &idxs2_int32_t, &dists_float)
+            elif self._kdtree_float_int32_t != NULL and other._kdtree_float_int64_t != NULL:
+                with nogil:
+                    search_tree_pairs_float_int32_t_int64_t(self._kdtree_float_int32_t, self._data_pts_data_float,
+                                      other._kdtree_float_int64_t, other._data_pts_data_float, radius_float, self_join,
+                                      &count, idxs1_int32_t_ptr, &idxs2_int64_t, &dists_float)
+            elif self._kdtree_float_int64_t != NULL and other._kdtree_float_int32_t != NULL:
+                with nogil:
+                    search_tree_pairs_float_int64_t_int32_t(self._kdtree_float_int64_t, self._data_pts_data_float,
+                                      other._kdtree_float_int32_t, other._data_pts_data_float, radius_float, self_join,
+                                      &count, idxs1_int64_t_ptr, &idxs2_int32_t, &dists_float)
+            elif self._kdtree_float_int64_t != NULL and other._kdtree_float_int64_t != NULL:
+                with nogil:
+                    search_tree_pairs_float_int64_t_int64_t(self._kdtree_float_int64_t, self._data_pts_data_float,
+                                      other._kdtree_float_int64_t, other._data_pts_data_float, radius_float, self_join,
+                                      &count, idxs1_int64_t_ptr, &idxs2_int64_t, &dists_float)
+            elif self._kdtree_double_int32_t != NULL and other._kdtree_double_int32_t != NULL:
+                with nogil:
+                    search_tree_pairs_double_int32_t_int32_t(self._kdtree_double_int32_t, self._data_pts_data_double,
+                                      other._kdtree_double_int32_t, other._data_pts_data_double, radius_double, self_join,
+                                      &count, idxs1_int32_t_ptr, &idxs2_int32_t, &dists_double)
+            elif self._kdtree_double_int32_t != NULL and other._kdtree_double_int64_t != NULL:
+                with nogil:
+                    search_tree_pairs_double_int32_t_int64_t(self._kdtree_double_int32_t, self._data_pts_data_double,
+                                      other._kdtree_double_int64_t, other._data_pts_data_double, radius_double, self_join,
+                                      &count, idxs1_int32_t_ptr, &idxs2_int64_t, &dists_double)
+            elif self._kdtree_double_int64_t != NULL and other._kdtree_double_int32_t != NULL:
+                with nogil:
+                    search_tree_pairs_double_int64_t_int32_t(self._kdtree_double_int64_t, self._data_pts_data_double,
+                                      other._kdtree_double_int32_t, other._data_pts_data_double, radius_double, self_join,
+                                      &count, idxs1_int64_t_ptr, &idxs2_int32_t, &dists_double)
+            elif self._kdtree_double_int64_t != NULL and other._kdtree_double_int64_t != NULL:
+                with nogil:
+                    search_tree_pairs_double_int64_t_int64_t(self._kdtree_double_int64_t, self._data_pts_data_double,
+                                      other._kdtree_double_int64_t, other._data_pts_data_double, radius_double, self_join,
+                                      &count, idxs1_int64_t_ptr, &idxs2_int64_t, &dists_double)
+        finally:
+            restore_parallel_options(&saved_options)
+
+        if count_only:
+            return count
+
+        # Hand the result arrays over to numpy
+        cdef np.npy_intp num_results = count
+        if self._use_int32_t:
+            idxs1 = _owned_array(idxs1_int32_t, num_results, np.NPY_UINT32)
+        else:
+            idxs1 = _owned_array(idxs1_int64_t, num_results, np.NPY_UINT64)
+        if other._use_int32_t:
+            idxs2 = _owned_array(idxs2_int32_t, num_results, np.NPY_UINT32)
+        else:
+            idxs2 = _owned_array(idxs2_int64_t, num_results, np.NPY_UINT64)
+        if self.data_pts.dtype == np.float32:
+            dists = _owned_array(dists_float, num_results, np.NPY_FLOAT32)
+        else:
+            dists = _owned_array(dists_double, num_results, np.NPY_FLOAT64)
+        if not sqr_dists: # Return actual distances
+            if self._sphere_radius > 0:
+                _arc_dist(dists, self._sphere_radius)
             else:
-                idx_out = (closest_dists_res >= dub_double)
+                np.sqrt(dists, out=dists)
+        return idxs1, idxs2, dists
 
-            closest_dists_res[idx_out] = np.inf
-            closest_idxs_res[idx_out] = self.n
+    cdef np.ndarray _array_view(KDTree self, void *data, np.npy_intp size, int typenum):
+        """Read-only array of memory owned by the C tree. The array keeps the tree alive."""
+        cdef np.ndarray arr = np.PyArray_SimpleNewFromData(1, &size, typenum, data)
+        np.PyArray_CLEARFLAGS(arr, np.NPY_ARRAY_WRITEABLE)
+        np.set_array_base(arr, self)
+        return arr
 
-        if not sqr_dists: # Return actual cartesian distances
-            closest_dists_res = np.sqrt(closest_dists_res)
+    def _get_state(KDTree self):
+        """Arrays and metadata describing the tree.
+        The arrays are read-only views of the tree memory.
+        """
+        cdef np.ndarray pidx, bbox, nodes
+        cdef np.npy_intp bbox_size = 2 * self.ndim
+        cdef size_t node_size
+        if self._kdtree_float_int32_t != NULL:
+            node_size = sizeof(node_float_int32_t)
+            pidx = self._array_view(self._kdtree_float_int32_t.pidx, self.n, np.NPY_UINT32)
+            bbox = self._array_view(self._kdtree_float_int32_t.bbox, bbox_size, np.NPY_FLOAT32)
+            nodes = self._array_view(self._kdtree_float_int32_t.nodes, self._kdtree_float_int32_t.num_nodes * node_size, np.NPY_UINT8)
+        elif self._kdtree_float_int64_t != NULL:
+            node_size = sizeof(node_float_int64_t)
+            pidx = self._array_view(self._kdtree_float_int64_t.pidx, self.n, np.NPY_UINT64)
+            bbox = self._array_view(self._kdtree_float_int64_t.bbox, bbox_size, np.NPY_FLOAT32)
+            nodes = self._array_view(self._kdtree_float_int64_t.nodes, self._kdtree_float_int64_t.num_nodes * node_size, np.NPY_UINT8)
+        elif self._kdtree_double_int32_t != NULL:
+            node_size = sizeof(node_double_int32_t)
+            pidx = self._array_view(self._kdtree_double_int32_t.pidx, self.n, np.NPY_UINT32)
+            bbox = self._array_view(self._kdtree_double_int32_t.bbox, bbox_size, np.NPY_FLOAT64)
+            nodes = self._array_view(self._kdtree_double_int32_t.nodes, self._kdtree_double_int32_t.num_nodes * node_size, np.NPY_UINT8)
+        else:
+            node_size = sizeof(node_double_int64_t)
+            pidx = self._array_view(self._kdtree_double_int64_t.pidx, self.n, np.NPY_UINT64)
+            bbox = self._array_view(self._kdtree_double_int64_t.bbox, bbox_size, np.NPY_FLOAT64)
+            nodes = self._array_view(self._kdtree_double_int64_t.nodes, self._kdtree_double_int64_t.num_nodes * node_size, np.NPY_UINT8)
+
+        return {
+            'version': _FILE_VERSION,
+            'n': self.n,
+            'ndim': self.ndim,
+            'leafsize': self.leafsize,
+            'reorder_data': self.reorder_data,
+            'split_rule': self.split_rule,
+            'boxsize': None if self._boxsize is None else self._boxsize.tolist(),
+            'sphere_radius': self.sphere_radius,
+            'node_size': node_size,
+            'data_pts': self.data_pts,
+            'pidx': pidx,
+            'bbox': bbox,
+            'nodes': nodes,
+        }
 
-        return closest_dists_res, closest_idxs_res
+    def _set_state(KDTree self, dict state):
+        """Set up the tree from the state returned by _get_state.
+        The C tree references the arrays of the state without copying them.
+        """
+        if state['version'] > _FILE_VERSION:
+            raise ValueError('Unsupported kd-tree format version %d' % state['version'])
+
+        cdef np.ndarray data_pts = state['data_pts']
+        cdef np.ndarray pidx = state['pidx']
+        cdef np.ndarray bbox = state['bbox']
+        cdef np.ndarray nodes = state['nodes']
+        cdef uint64_t n = state['n']
+        cdef int8_t ndim = state['ndim']
+        cdef uint32_t leafsize = state['leafsize']
+        cdef uint64_t num_nodes
+        cdef size_t node_size
+
+        # The C tree reads the arrays without bounds checks
+        if data_pts.dtype not in (np.float32, np.float64) or bbox.dtype != data_pts.dtype:
+            raise ValueError('kd-tree data points must be float32 or float64')
+        expected_pidx_dtype = np.uint32 if n * max(ndim, 2) < _INT32_INDEX_LIMIT else np.uint64
+        if pidx.dtype != expected_pidx_dtype or nodes.dtype != np.uint8:
+            raise ValueError('kd-tree index arrays have the wrong type')
+        if pidx.size != n or data_pts.size != n * ndim or bbox.size != 2 * ndim:
+            raise ValueError('kd-tree arrays do not match the number of points and dimensions')
+        if n > 0 and pidx.max() >= n:
+            raise ValueError('kd-tree point indices are out of range')
+        if data_pts.dtype == np.float32:
+            node_size = sizeof(node_float_int32_t) if pidx.dtype == np.uint32 else sizeof(node_float_int64_t)
+        else:
+            node_size = sizeof(node_double_int32_t) if pidx.dtype == np.uint32 else sizeof(node_double_int64_t)
+        if node_size != state['node_size']:
+            # Node layout differs on this platform, rebuild the tree from the data points
+            self.__init__(data_pts.reshape(n, ndim), leafsize, reorder_data=state.get('reorder_data', False),
+                          split_rule=state.get('split_rule', 'sliding_midpoint'), boxsize=state.get('boxsize'))
+            # The data points of spherical trees are already unit vectors
+            self._sphere_radius = state.get('sphere_radius') or 0
+            self._attach_sphere_radius()
+            return
+
+        if nodes.size == 0 or nodes.size % node_size != 0:
+            raise ValueError('kd-tree nodes do not match the node size')
+        _check_nodes(nodes, data_pts.dtype, pidx.dtype == np.uint32, n, ndim)
+        num_nodes = nodes.size // node_size
+        self.data_pts = data_pts
+        self.data = data_pts
+        self.n = n
+        self.ndim = ndim
+        self.leafsize = leafsize
+        self.split_rule = state.get('split_rule', 'sliding_midpoint')
+        self._use_int32_t = pidx.dtype == np.uint32
+        self._tree_arrays = (pidx, bbox, nodes)
+
+        if data_pts.dtype == np.float32:
+            self._data_pts_data_float = <float *>np.PyArray_DATA(data_pts)
+            if self._use_int32_t:
+                self._kdtree_float_int32_t = create_tree_view_float_int32_t(ndim, <float *>np.PyArray_DATA(bbox),
+                    <uint32_t *>np.PyArray_DATA(pidx), <node_float_int32_t *>np.PyArray_DATA(nodes), <uint32_t>num_nodes)
+            else:
+                self._kdtree_float_int64_t = create_tree_view_float_int64_t(ndim, <float *>np.PyArray_DATA(bbox),
+                    <uint64_t *>np.PyArray_DATA(pidx), <node_float_int64_t *>np.PyArray_DATA(nodes), num_nodes)
+        else:
+            self._data_pts_data_double = <double *>np.PyArray_DATA(data_pts)
+            if self._use_int32_t:
+                self._kdtree_double_int32_t = create_tree_view_double_int32_t(ndim, <double *>np.PyArray_DATA(bbox),
+                    <uint32_t *>np.PyArray_DATA(pidx), <node_double_int32_t *>np.PyArray_DATA(nodes), <uint32_t>num_nodes)
+            else:
+                self._kdtree_double_int64_t = create_tree_view_double_int64_t(ndim, <double *>np.PyArray_DATA(bbox),
+                    <uint64_t *>np.PyArray_DATA(pidx), <node_double_int64_t *>np.PyArray_DATA(nodes), num_nodes)
+        # The leaf ordered copy is not stored, it is rebuilt from the data points
+        if state.get('reorder_data', False):
+            self._build_leaf_data()
+        if state.get('boxsize') is not None:
+            self._boxsize = np.array(state['boxsize'], dtype=data_pts.dtype)
+            self._attach_boxsize()
+        self._sphere_radius = state.get('sphere_radius') or 0
+        self._attach_sphere_radius()
+
+    def __reduce__(KDTree self):
+        return _kdtree_from_state, (self._get_state(),)
+
+    def save(KDTree self, path):
+        """Save the kd-tree to a file
+
+        The tree is stored in a versioned binary format holding the
+        data points and the internal tree arrays so it can be loaded
+        without rebuilding it.
+
+        :Parameters:
+        path : str or path-like
+            File to write
+        """
+        state = self._get_state()
+        arrays = {name: state.pop(name) for name in ('data_pts', 'pidx', 'bbox', 'nodes')}
+
+        # Array offsets are relative to the aligned start of the data section
+        offset = 0
+        state['arrays'] = {}
+        for name, arr in arrays.items():
+            state['arrays'][name] = {'dtype': arr.dtype.str, 'offset': offset, 'size': arr.size}
+            offset += -(-arr.nbytes // _FILE_ALIGNMENT) * _FILE_ALIGNMENT
+        header = json.dumps(state).encode('utf-8')
+        data_start = -(-(len(_FILE_MAGIC) + 8 + len(header)) // _FILE_ALIGNMENT) * _FILE_ALIGNMENT
+
+        with open(path, 'wb') as fp:
+            fp.write(_FILE_MAGIC)
+            fp.write(np.uint64(len(header)).astype('<u8').tobytes())
+            fp.write(header)
+            for name, arr in arrays.items():
+                fp.seek(data_start + state['arrays'][name]['offset'])
+                fp.write(np.ascontiguousarray(arr).data)
+            fp.truncate(data_start + offset)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a kd-tree saved with KDTree.save
+
+        :Parameters:
+        path : str or path-like
+            File to read
+        mmap : bool, optional
+            Memory-map the file instead of reading it. Loading is then
+            almost instant and the pages are shared between processes
+            loading the same file. The data points of the loaded tree
+            are read-only.
+        """
+        with open(path, 'rb') as fp:
+            magic = fp.read(len(_FILE_MAGIC))
+            if magic != _FILE_MAGIC:
+                raise ValueError('%s is not a pykdtree file' % os.fspath(path))
+            header_len = int(np.frombuffer(fp.read(8), dtype='<u8')[0])
+            state = json.loads(fp.read(header_len).decode('utf-8'))
+            data_start = -(-(len(_FILE_MAGIC) + 8 + header_len) // _FILE_ALIGNMENT) * _FILE_ALIGNMENT
+            if mmap:
+                buf = np.memmap(fp, dtype=np.uint8, mode='r')
+            else:
+                fp.seek(0)
+                buf = np.fromfile(fp, dtype=np.uint8)
+
+        if state['version'] > _FILE_VERSION:
+            raise ValueError('Unsupported kd-tree format version %d' % state['version'])
+        for name, desc in state.pop('arrays').items():
+            dtype = np.dtype(desc['dtype'])
+            if not dtype.isnative:
+                raise ValueError('kd-tree file was written on a platform with a different byte order')
+            start = data_start + desc['offset']
+            array_buf = buf[start:start + desc['size'] * dtype.itemsize]
+            if array_buf.size != desc['size'] * dtype.itemsize:
+                raise ValueError('%s is truncated' % os.fspath(path))
+            state[name] = array_buf.view(dtype)
+        return _kdtree_from_state(state)
 
     def __dealloc__(KDTree self):
         if self._kdtree_float_int32_t != NULL:
@@ -365,3 +1944,273 @@ cdef class KDTree:
             delete_tree_float_int64_t(self._kdtree_float_int64_t)
         elif self._kdtree_double_int64_t != NULL:
             delete_tree_double_int64_t(self._kdtree_double_int64_t)
+
+
+class DynamicKDTree:
+    """kd-tree supporting insertion and removal of points.
+
+    The points are kept in a forest of static kd-trees of decreasing size
+    (Bentley-Saxe). Inserted points form a new tree which is merged with
+    the smaller trees, so every point is part of O(log n) rebuilds and the
+    forest has O(log n) trees. Removed points are masked in their tree and
+    a tree is rebuilt from its remaining points once half of its points
+    are removed.
+
+    Every point gets an index when it is inserted. Indices are assigned
+    consecutively and are not reused after the point is removed.
+
+    :Parameters:
+    data_pts : numpy array
+        Initial data points with shape (n, dims). n may be 0.
+    leafsize : int, optional
+        Maximum number of data points in tree leaf
+    workers : int, optional
+        Number of threads used to construct the trees. -1 uses all
+        processors. By default the OpenMP setting (OMP_NUM_THREADS)
+        is used.
+    **tree_kwargs
+        Other options passed to KDTree, e.g. split_rule
+    """
+
+    # Every tree is at least this many times larger than the next newer tree.
+    # Larger factors give fewer trees to query but rebuild points more often.
+    _MERGE_FACTOR = 4
+
+    def __init__(self, np.ndarray data_pts not None, int leafsize=16, workers=None, **tree_kwargs):
+        if data_pts.ndim != 2:
+            raise ValueError('data_pts array should have exactly 2 dimensions')
+        if data_pts.shape[1] > 127:
+            raise ValueError('Max 127 dimensions allowed')
+        if leafsize < 1:
+            raise ValueError('leafsize must be greater than zero')
+        if tree_kwargs.get('spherical'):
+            raise ValueError('spherical trees are not supported by DynamicKDTree')
+        self._ndim = data_pts.shape[1]
+        self._dtype = np.float32 if data_pts.dtype == np.float32 else np.float64
+        self._leafsize = leafsize
+        self._tree_kwargs = tree_kwargs
+        self._num_inserted = 0
+        # Trees from oldest to newest with the indices of their points in
+        # ascending order, their removed points and the number of them
+        self._trees = []
+        self._ids = []
+        self._removed = []
+        self._num_removed = []
+        self.insert(data_pts, workers=workers)
+
+    @property
+    def n(self):
+        """Number of data points"""
+        return sum(tree.n for tree in self._trees) - sum(self._num_removed)
+
+    @property
+    def ndim(self):
+        """Number of dimensions"""
+        return self._ndim
+
+    @property
+    def leafsize(self):
+        """Maximum number of data points in tree leaf"""
+        return self._leafsize
+
+    @property
+    def num_inserted(self):
+        """Number of points inserted so far, including removed points"""
+        return self._num_inserted
+
+    @property
+    def num_trees(self):
+        """Number of static kd-trees in the forest"""
+        return len(self._trees)
+
+    def _live_points(self, int i):
+        """Remaining points of tree i and their indices"""
+        data_pts = self._trees[i].data_pts.reshape(-1, self._ndim)
+        if self._num_removed[i] == 0:
+            return data_pts, self._ids[i]
+        keep = ~self._removed[i]
+        return data_pts[keep], self._ids[i][keep]
+
+    def _build(self, data_pts, ids, workers):
+        tree = KDTree(data_pts, self._leafsize, workers=workers, **self._tree_kwargs)
+        return tree, ids, np.zeros(ids.size, dtype=np.bool_), 0
+
+    def insert(self, points, workers=None):
+        """Insert points
+
+        :Parameters:
+        points : numpy array
+            Points with shape (m, dims)
+        workers : int, optional
+            Number of threads used to construct the trees
+
+        :Returns:
+        indices : numpy array of uint64
+            Indices of the inserted points
+        """
+        points = np.asarray(points, dtype=self._dtype)
+        if points.ndim != 2 or points.shape[1] != self._ndim:
+            raise ValueError('points must have shape (m, %d)' % self._ndim)
+        ids = np.arange(self._num_inserted, self._num_inserted + points.shape[0], dtype=np.int64)
+        if ids.size == 0:
+            return ids.astype(np.uint64)
+        self._num_inserted += ids.size
+
+        # Merge all newer trees that are less than _MERGE_FACTOR times larger than the new points
+        all_pts = [points]
+        all_ids = [ids]
+        size = ids.size
+        while self._trees and self._trees[-1].n - self._num_removed[-1] < size * self._MERGE_FACTOR:
+            data_pts, tree_ids = self._live_points(len(self._trees) - 1)
+            all_pts.insert(0, data_pts)
+            all_ids.insert(0, tree_ids)
+            size += tree_ids.size
+            for lst in (self._trees, self._ids, self._removed, self._num_removed):
+                lst.pop()
+
+        tree, tree_ids, removed, num_removed = self._build(np.concatenate(all_pts), np.concatenate(all_ids), workers)
+        self._trees.append(tree)
+        self._ids.append(tree_ids)
+        self._removed.append(removed)
+        self._num_removed.append(num_removed)
+        return ids.astype(np.uint64)
+
+    def remove(self, indices, workers=None):
+        """Remove points
+
+        :Parameters:
+        indices : array_like
+            Indices of the points returned by insert
+        workers : int, optional
+            Number of threads used to rebuild trees
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64).ravel())
+        if indices.size == 0:
+            return
+        starts = np.array([tree_ids[0] for tree_ids in self._ids], dtype=np.int64)
+        tree_nos = np.searchsorted(starts, indices, side='right') - 1
+
+        # Locate all points before changing anything
+        locations = []
+        for i in np.unique(tree_nos):
+            if i < 0:
+                raise ValueError('indices must be indices of points in the tree')
+            tree_indices = indices[tree_nos == i]
+            pos = np.minimum(np.searchsorted(self._ids[i], tree_indices), self._ids[i].size - 1)
+            if np.any(self._ids[i][pos] != tree_indices) or np.any(self._removed[i][pos]):
+                raise ValueError('indices must be indices of points in the tree')
+            locations.append((i, pos))
+
+        for i, pos in locations:
+            self._removed[i][pos] = True
+            self._num_removed[i] += pos.size
+
+        # Rebuild trees with more removed than remaining points, last first
+        # so the positions of the other trees stay valid
+        for i, _ in reversed(locations):
+            if 2 * self._num_removed[i] <= self._trees[i].n:
+                continue
+            data_pts, tree_ids = self._live_points(i)
+            if tree_ids.size == 0:
+                for lst in (self._trees, self._ids, self._removed, self._num_removed):
+                    del lst[i]
+            else:
+                self._trees[i], self._ids[i], self._removed[i], self._num_removed[i] = \
+                    self._build(data_pts, tree_ids, workers)
+
+    def rebuild(self, workers=None):
+        """Rebuild the forest as a single kd-tree of the remaining points
+
+        :Parameters:
+        workers : int, optional
+            Number of threads used to construct the tree
+        """
+        if not self._trees:
+            return
+        live = [self._live_points(i) for i in range(len(self._trees))]
+        data_pts = np.concatenate([pts for pts, _ in live])
+        tree_ids = np.concatenate([ids for _, ids in live])
+        self._trees, self._ids, self._removed, self._num_removed = [], [], [], []
+        if tree_ids.size > 0:
+            tree, tree_ids, removed, num_removed = self._build(data_pts, tree_ids, workers)
+            self._trees.append(tree)
+            self._ids.append(tree_ids)
+            self._removed.append(removed)
+            self._num_removed.append(num_removed)
+
+    def query(self, np.ndarray query_pts not None, k=1, eps=0,
+              distance_upper_bound=None, sqr_dists=False, workers=None):
+        """Query the kd-tree for nearest neighbors
+
+        The trees of the forest are queried one after another, from the
+        largest to the smallest, and the results are merged. The distance
+        to the k-th neighbour found so far bounds the search of each
+        query point in the following trees.
+
+        :Parameters:
+        query_pts : numpy array
+            Query points with shape (m, dims)
+        k : int
+            The number of nearest neighbours to return
+        eps : non-negative float
+            Return approximate nearest neighbours; the k-th returned value
+            is guaranteed to be no further than (1 + eps) times the distance
+            to the real k-th nearest neighbour
+        distance_upper_bound : non-negative float or numpy array
+            Return only neighbors within this distance, or within a
+            distance per query point with shape (m,).
+        sqr_dists : bool, optional
+            Internally pykdtree works with squared distances.
+            Determines if the squared or Euclidean distances are returned.
+        workers : int, optional
+            Number of threads used for this call
+
+        :Returns:
+        distances : array of floats
+            The distances to the nearest neighbours. Missing neighbours
+            are indicated with infinite distances.
+        indices : array of uint64
+            The indices of the neighbours. Missing neighbours are
+            indicated with num_inserted.
+        """
+        if query_pts.ndim != 2 or query_pts.shape[1] != self._ndim:
+            raise ValueError('Data and query points must have same dimensions')
+        if k < 1:
+            raise ValueError('Number of neighbours must be greater than zero')
+        cdef uint64_t num_qpoints = query_pts.shape[0]
+
+        dists = np.full((num_qpoints, k), np.inf, dtype=self._dtype)
+        idxs = np.full((num_qpoints, k), self._num_inserted, dtype=np.uint64)
+        # Slack for the rounding of the bounds between squared and actual distances
+        bound_fac = 1 + 4 * np.finfo(self._dtype).eps
+        for i, tree in enumerate(self._trees):
+            tree_k = min(k, tree.n)
+            mask = self._removed[i] if self._num_removed[i] > 0 else None
+            if i == 0:
+                bound = distance_upper_bound
+            else:
+                # Only points closer than the k-th neighbour found so far can be neighbours
+                bound = np.sqrt(dists[:, k - 1].astype(np.float64)) * bound_fac
+                if distance_upper_bound is not None:
+                    np.minimum(bound, distance_upper_bound, out=bound)
+            tree_dists, tree_idxs = tree.query(query_pts, k=tree_k, eps=eps, distance_upper_bound=bound,
+                                               sqr_dists=True, mask=mask, workers=workers)
+            tree_dists = tree_dists.reshape(num_qpoints, tree_k)
+            tree_idxs = tree_idxs.reshape(num_qpoints, tree_k)
+            missing = tree_idxs >= tree.n
+            tree_dists = np.where(missing, np.inf, tree_dists).astype(self._dtype, copy=False)
+            tree_idxs = np.where(missing, self._num_inserted, self._ids[i][np.where(missing, 0, tree_idxs)])
+            if i == 0:
+                dists[:, :tree_k] = tree_dists
+                idxs[:, :tree_k] = tree_idxs
+                continue
+            merged_dists = np.concatenate((dists, tree_dists), axis=1)
+            merged_idxs = np.concatenate((idxs, tree_idxs.astype(np.uint64, copy=False)), axis=1)
+            order = np.argsort(merged_dists, axis=1, kind='stable')[:, :k]
+            dists = np.take_along_axis(merged_dists, order, axis=1)
+            idxs = np.take_along_axis(merged_idxs, order, axis=1)
+        if not sqr_dists:
+            dists = np.sqrt(dists)
+        if k == 1:
+            return dists.ravel(), idxs.ravel()
+        return dists, idxs
@@ -1,7 +1,10 @@
+import pickle
+
 import numpy as np
 import pytest
 
-from pykdtree.kdtree import KDTree
+import pykdtree.kdtree
+from pykdtree.kdtree import DynamicKDTree, KDTree
 
 data_pts_real = np.array([[  790535.062,  -369324.656,  6310963.5  ],
        [  790024.312,  -365155.688,  6311270.   ],
@@ -174,11 +177,31 @@ def test3d_float32_mismatch2():
                           [769957.188, -202418.125, 6321069.5]])
 
     kdtree = KDTree(data_pts_real.astype(np.float32))
-    try:
-        dist, idx = kdtree.query(query_pts, sqr_dists=True)
-        assert False
-    except TypeError:
-        assert True
+    dist, idx = kdtree.query(query_pts, sqr_dists=True)
+    exp_dist, exp_idx = kdtree.query(query_pts.astype(np.float32), sqr_dists=True)
+    assert dist.dtype == np.float32
+    assert np.array_equal(idx, exp_idx)
+    assert np.array_equal(dist, exp_dist)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("query_dtype", [np.float32, np.float64, np.int16, np.uint8, np.int64, np.float16])
+def test_query_types_strides(dtype, query_dtype):
+    rng = np.random.default_rng(6)
+    data_pts = (rng.random((3000, 3)) * 100).astype(dtype)
+    query_buf = (rng.random((400, 5)) * 100).astype(query_dtype)
+    # Non-contiguous view of every other point and column
+    query_pts = query_buf[::2, ::2]
+    kdtree = KDTree(data_pts)
+    exp_query = np.ascontiguousarray(query_pts, dtype=dtype)
+    exp_dist, exp_idx = kdtree.query(exp_query, k=3)
+    dist, idx = kdtree.query(query_pts, k=3)
+    assert np.array_equal(idx, exp_idx)
+    assert np.array_equal(dist, exp_dist)
+    offsets, idx = kdtree.query_ball_point(query_pts, 5.)
+    exp_offsets, exp_idx = kdtree.query_ball_point(exp_query, 5.)
+    assert np.array_equal(offsets, exp_offsets)
+    assert np.array_equal(idx, exp_idx)
 
 
 def test3d_8n():
@@ -385,6 +408,787 @@ def test_empty_fail():
     except ValueError as e:
         assert 'non-empty' in str(e), str(e)
 
+def test_parallel_construction():
+    # Large enough for the subtrees to be built as OpenMP tasks
+    rng = np.random.default_rng(0)
+    data_pts = rng.random((200000, 3))
+    # Duplicates force the single point fallback in the partitioning
+    data_pts[:5000] = data_pts[0]
+    kdtree = KDTree(data_pts, workers=4)
+    # The tasks must give the same point order and nodes as a single thread
+    state = kdtree._get_state()
+    serial_state = KDTree(data_pts, workers=1)._get_state()
+    assert np.array_equal(state['pidx'], serial_state['pidx'])
+    assert np.array_equal(state['nodes'], serial_state['nodes'])
+    query_pts = data_pts[::997]
+    dist, idx = kdtree.query(query_pts, k=4)
+    for i, pt in enumerate(query_pts):
+        exp_dist = np.sort(np.sqrt(((data_pts - pt) ** 2).sum(axis=1)))[:4]
+        assert np.allclose(dist[i], exp_dist)
+        assert np.allclose(np.sqrt(((data_pts[idx[i]] - pt) ** 2).sum(axis=1)), exp_dist)
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_pickle(dtype):
+    query_pts = np.array([[  787014.438,  -340616.906,  6313018.],
+                          [751763.125, -59925.969, 6326205.5],
+                          [769957.188, -202418.125, 6321069.5]], dtype=dtype)
+    kdtree = KDTree(data_pts_real.astype(dtype), leafsize=4)
+    kdtree2 = pickle.loads(pickle.dumps(kdtree))
+    assert kdtree2.n == kdtree.n
+    assert kdtree2.ndim == kdtree.ndim
+    assert kdtree2.leafsize == kdtree.leafsize
+    assert kdtree2.data_pts.dtype == kdtree.data_pts.dtype
+    dist, idx = kdtree.query(query_pts, k=8)
+    dist2, idx2 = kdtree2.query(query_pts, k=8)
+    assert np.array_equal(idx, idx2)
+    assert np.array_equal(dist, dist2)
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load(tmp_path, mmap):
+    rng = np.random.default_rng(0)
+    data_pts = rng.random((10000, 3))
+    query_pts = rng.random((100, 3))
+    kdtree = KDTree(data_pts)
+    kdtree.save(tmp_path / "tree.kdtree")
+    kdtree2 = KDTree.load(tmp_path / "tree.kdtree", mmap=mmap)
+    assert isinstance(kdtree2.data_pts, np.memmap) == mmap
+    assert np.array_equal(kdtree2.data_pts, kdtree.data_pts)
+    dist, idx = kdtree.query(query_pts, k=4)
+    dist2, idx2 = kdtree2.query(query_pts, k=4)
+    assert np.array_equal(idx, idx2)
+    assert np.array_equal(dist, dist2)
+    # Loaded trees can be pickled as well
+    dist3, idx3 = pickle.loads(pickle.dumps(kdtree2)).query(query_pts, k=4)
+    assert np.array_equal(idx, idx3)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_node_padding_zeroed(dtype):
+    state = KDTree(np.random.default_rng(0).random((100000, 3)).astype(dtype))._get_state()
+    # Nodes hold three cut values, then start_idx, n, right_child and cut_dim.
+    # The padding after cut_dim is saved and pickled, so it must not be heap garbage.
+    padding_start = 3 * np.dtype(dtype).itemsize + 3 * state['pidx'].itemsize + 1
+    nodes = state['nodes'].reshape(-1, state['node_size'])
+    assert padding_start < state['node_size']
+    assert not nodes[:, padding_start:].any()
+
+
+def test_load_invalid(tmp_path):
+    path = tmp_path / "tree.kdtree"
+    path.write_bytes(b"not a tree")
+    with pytest.raises(ValueError, match="not a pykdtree file"):
+        KDTree.load(path)
+
+    KDTree(np.random.default_rng(0).random((50000, 3)).astype(np.float32)).save(path)
+    path.write_bytes(path.read_bytes()[:500])
+    for mmap in [True, False]:
+        with pytest.raises(ValueError, match="truncated"):
+            KDTree.load(path, mmap=mmap)
+    # Unpickled states are checked as well
+    func, (state,) = KDTree(np.random.default_rng(0).random((100, 3))).__reduce__()
+    for name, size in [('nodes', 0), ('pidx', 50), ('bbox', 3)]:
+        bad_state = dict(state, **{name: state[name][:size]})
+        with pytest.raises(ValueError):
+            func(bad_state)
+    bad_arrays = [('data_pts', state['data_pts'].astype(np.float32)), ('pidx', state['pidx'].astype(np.uint64)),
+                  ('pidx', state['pidx'] + 1), ('nodes', np.full_like(state['nodes'], 0xff))]
+    for name, array in bad_arrays:
+        with pytest.raises(ValueError, match="kd-tree"):
+            func(dict(state, **{name: array}))
+
+def test_query_iter(tmp_path):
+    rng = np.random.default_rng(7)
+    data_pts = rng.random((5000, 3))
+    query_pts = rng.random((1000, 3))
+    kdtree = KDTree(data_pts)
+    exp_dist, exp_idx = kdtree.query(query_pts, k=3, distance_upper_bound=0.05)
+
+    path = tmp_path / 'query.npy'
+    np.save(path, query_pts)
+    source = np.load(path, mmap_mode='r')
+    results = list(kdtree.query_iter(source, chunk_size=300, k=3, distance_upper_bound=0.05))
+    assert [len(idx) for dist, idx in results] == [300, 300, 300, 100]
+    assert np.array_equal(np.concatenate([idx for dist, idx in results]), exp_idx)
+    assert np.array_equal(np.concatenate([dist for dist, idx in results]), exp_dist)
+
+    chunks = (query_pts[i:i + 250] for i in range(0, 1000, 250))
+    results = list(kdtree.query_iter(chunks, k=3, distance_upper_bound=0.05))
+    assert len(results) == 4
+    assert np.array_equal(np.concatenate([idx for dist, idx in results]), exp_idx)
+
+    with pytest.raises(ValueError):
+        kdtree.query_iter(query_pts, chunk_size=0)
+
+
+@pytest.mark.parametrize("k", [1, 63, 64, 300])
+def test_query_large_k(k):
+    rng = np.random.default_rng(3)
+    data_pts = rng.random((2000, 3))
+    query_pts = rng.random((50, 3))
+    mask = rng.random(2000) < 0.1
+    kdtree = KDTree(data_pts, leafsize=10)
+    dist, idx = kdtree.query(query_pts, k=k, mask=mask, distance_upper_bound=0.3)
+    dist = dist.reshape(50, k)
+    idx = idx.reshape(50, k)
+    for i, pt in enumerate(query_pts):
+        all_dist = np.sqrt(((data_pts - pt) ** 2).sum(axis=1))
+        all_dist[mask | (all_dist >= 0.3)] = np.inf
+        order = np.argsort(all_dist, kind='stable')[:k]
+        found = np.isfinite(all_dist[order])
+        assert np.array_equal(idx[i][found], order[found])
+        assert np.allclose(dist[i][found], all_dist[order][found])
+        assert np.all(idx[i][~found] == 2000)
+        assert np.all(np.isinf(dist[i][~found]))
+
+
+def test_query_out():
+    rng = np.random.default_rng(5)
+    data_pts = rng.random((5000, 3))
+    query_pts = rng.random((300, 3))
+    kdtree = KDTree(data_pts)
+    exp_dist, exp_idx = kdtree.query(query_pts, k=4, distance_upper_bound=0.05)
+
+    # Views into larger buffers
+    dist_buf = np.full((400, 6), -1.)
+    idx_buf = np.zeros((300, 5), dtype=np.uint32)
+    dist, idx = kdtree.query(query_pts, k=4, distance_upper_bound=0.05,
+                             out_dists=dist_buf[50:350, 1:5], out_idxs=idx_buf[:, :4])
+    assert np.shares_memory(dist, dist_buf)
+    assert np.shares_memory(idx, idx_buf)
+    assert np.array_equal(dist, exp_dist)
+    assert np.array_equal(idx, exp_idx)
+    assert np.all(dist_buf[:50] == -1.) and np.all(dist_buf[:, 0] == -1.)
+    assert np.all(idx_buf[:, 4] == 0)
+
+    out_dists = np.empty(300)
+    out_idxs = np.empty(300, dtype=np.uint32)
+    dist, idx = kdtree.query(query_pts, sqr_dists=True, out_dists=out_dists, out_idxs=out_idxs)
+    assert dist is out_dists and idx is out_idxs
+    exp_dist, exp_idx = kdtree.query(query_pts, sqr_dists=True)
+    assert np.array_equal(dist, exp_dist)
+    assert np.array_equal(idx, exp_idx)
+
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, k=4, out_dists=np.empty((300, 3)))
+    with pytest.raises(TypeError):
+        kdtree.query(query_pts, out_dists=np.empty(300, dtype=np.float32))
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, k=4, out_dists=np.empty((4, 300)).T)
+
+
+@pytest.mark.parametrize("schedule", ["static", "dynamic", "guided"])
+def test_workers_schedule(schedule):
+    rng = np.random.default_rng(4)
+    data_pts = rng.random((20000, 3))
+    query_pts = rng.random((3000, 3))
+    exp_dist, exp_idx = KDTree(data_pts).query(query_pts, k=4)
+    kdtree = KDTree(data_pts, workers=2)
+    dist, idx = kdtree.query(query_pts, k=4, workers=3, schedule=schedule, chunk_size=7)
+    assert np.array_equal(idx, exp_idx)
+    assert np.array_equal(dist, exp_dist)
+    offsets, idx = kdtree.query_ball_point(query_pts, 0.05, workers=-1, schedule=schedule, chunk_size=7)
+    exp_offsets, exp_idx = kdtree.query_ball_point(query_pts, 0.05)
+    assert np.array_equal(offsets, exp_offsets)
+    assert kdtree.count_neighbors(kdtree, 0.01, workers=2) == kdtree.count_neighbors(kdtree, 0.01)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, workers=0)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, schedule='auto')
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, chunk_size=0)
+    with pytest.raises(ValueError):
+        KDTree(data_pts, workers=-2)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_query_ball_point(dtype):
+    rng = np.random.default_rng(0)
+    data_pts = rng.random((5000, 3)).astype(dtype)
+    query_pts = rng.random((200, 3)).astype(dtype)
+    mask = rng.random(5000) < 0.2
+    kdtree = KDTree(data_pts, leafsize=10)
+    offsets, idx, dist = kdtree.query_ball_point(query_pts, 0.1, mask=mask, return_distance=True)
+    assert offsets.shape == (201,)
+    assert offsets[0] == 0
+    assert offsets[-1] == idx.size == dist.size
+    assert dist.dtype == dtype
+    for i, pt in enumerate(query_pts):
+        all_dist = np.sqrt(((data_pts.astype(np.float64) - pt) ** 2).sum(axis=1))
+        exp_idx = np.nonzero((all_dist <= 0.1) & ~mask)[0]
+        res_idx = idx[offsets[i]:offsets[i + 1]]
+        assert np.array_equal(np.sort(res_idx), exp_idx)
+        assert np.allclose(dist[offsets[i]:offsets[i + 1]], all_dist[res_idx], atol=1e-6)
+
+    offsets2, idx2 = kdtree.query_ball_point(query_pts, 0.1, mask=mask)
+    assert np.array_equal(offsets, offsets2)
+    assert np.array_equal(idx, idx2)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_query_per_point(dtype):
+    rng = np.random.default_rng(8)
+    data_pts = rng.random((5000, 3)).astype(dtype)
+    query_pts = rng.random((400, 3)).astype(dtype)
+    mask = rng.random(5000) < 0.2
+    kdtree = KDTree(data_pts, leafsize=10)
+    all_dist = np.sqrt(((query_pts[:, None, :].astype(np.float64) - data_pts[None, :, :]) ** 2).sum(axis=2))
+    all_dist[:, mask] = np.inf
+    sorted_dist = np.sort(all_dist, axis=1)
+    atol = 1e-5 if dtype == np.float32 else 1e-10
+    bounds = rng.random(400) * 0.1
+    k = rng.integers(0, 70, 400)
+
+    dist, idx = kdtree.query(query_pts, k=4, mask=mask, distance_upper_bound=bounds)
+    exp_dist = sorted_dist[:, :4].copy()
+    exp_dist[exp_dist >= bounds[:, None]] = np.inf
+    found = np.isfinite(exp_dist)
+    assert np.array_equal(np.isfinite(dist), found)
+    assert np.allclose(dist[found], exp_dist[found], atol=atol)
+    assert np.all(idx[~found] == kdtree.n)
+
+    offsets, dist, idx = kdtree.query(query_pts, k=k, mask=mask, distance_upper_bound=bounds)
+    assert np.array_equal(offsets, np.concatenate(([0], np.cumsum(k))))
+    for i in range(len(query_pts)):
+        exp_dist = sorted_dist[i, :k[i]].copy()
+        exp_dist[exp_dist >= bounds[i]] = np.inf
+        res_dist = dist[offsets[i]:offsets[i + 1]]
+        res_idx = idx[offsets[i]:offsets[i + 1]]
+        assert np.array_equal(np.isfinite(res_dist), np.isfinite(exp_dist))
+        assert np.allclose(res_dist[np.isfinite(res_dist)], exp_dist[np.isfinite(exp_dist)], atol=atol)
+        assert np.allclose(all_dist[i, res_idx[np.isfinite(res_dist)]], res_dist[np.isfinite(res_dist)], atol=atol)
+
+    out_dists = np.empty(offsets[-1], dtype=dtype)
+    out_idxs = np.empty(offsets[-1], dtype=idx.dtype)
+    kdtree.query(query_pts, k=k, mask=mask, distance_upper_bound=bounds, out_dists=out_dists, out_idxs=out_idxs)
+    assert np.array_equal(out_idxs, idx)
+
+    results = list(kdtree.query_iter(query_pts, chunk_size=150, k=k, mask=mask, distance_upper_bound=bounds))
+    assert np.array_equal(np.concatenate([res[2] for res in results]), idx)
+
+    offsets, idx = kdtree.query_ball_point(query_pts, bounds, mask=mask)
+    for i in range(len(query_pts)):
+        exp_idx = np.nonzero(all_dist[i] <= bounds[i])[0]
+        assert np.array_equal(np.sort(idx[offsets[i]:offsets[i + 1]]), exp_idx)
+
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, k=k[:10])
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, k=-k - 1)
+    with pytest.raises(TypeError):
+        kdtree.query(query_pts, k=k * 1.)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, distance_upper_bound=-bounds)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, distance_upper_bound=bounds[:10])
+    with pytest.raises(ValueError):
+        kdtree.query_ball_point(query_pts, bounds[:10])
+
+
+@pytest.mark.parametrize("ndim", [2, 3, 4, 5])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_reorder_data(dtype, ndim):
+    rng = np.random.default_rng(ndim)
+    data_pts = rng.random((5000, ndim)).astype(dtype)
+    query_pts = rng.random((300, ndim)).astype(dtype)
+    mask = rng.random(5000) < 0.3
+    kdtree = KDTree(data_pts, leafsize=10)
+    kdtree2 = KDTree(data_pts, leafsize=10, reorder_data=True)
+    assert not kdtree.reorder_data
+    assert kdtree2.reorder_data
+    for kwargs in [dict(k=1), dict(k=10), dict(k=100), dict(k=5, mask=mask),
+                   dict(k=5, distance_upper_bound=0.1)]:
+        dist, idx = kdtree.query(query_pts, **kwargs)
+        dist2, idx2 = kdtree2.query(query_pts, **kwargs)
+        assert np.array_equal(idx, idx2)
+        assert np.allclose(dist, dist2)
+
+    offsets, idx = kdtree.query_ball_point(query_pts, 0.2, mask=mask)
+    offsets2, idx2 = kdtree2.query_ball_point(query_pts, 0.2, mask=mask)
+    assert np.array_equal(offsets, offsets2)
+    assert np.array_equal(idx, idx2)
+
+    # The leaf ordered copy is rebuilt when unpickling
+    kdtree3 = pickle.loads(pickle.dumps(kdtree2))
+    assert kdtree3.reorder_data
+    dist, idx = kdtree.query(query_pts, k=10)
+    dist3, idx3 = kdtree3.query(query_pts, k=10)
+    assert np.array_equal(idx, idx3)
+    assert np.allclose(dist, dist3)
+
+
+@pytest.mark.parametrize("split_rule", ["sliding_midpoint", "median", "cost"])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_split_rule(dtype, split_rule):
+    rng = np.random.default_rng(2)
+    # Dense clusters in a mostly empty domain, with duplicated points
+    centers = rng.random((20, 3)) * 100
+    data_pts = (centers[rng.integers(0, 20, 20000)] + rng.normal(0, 0.1, (20000, 3))).astype(dtype)
+    data_pts[:2000] = data_pts[0]
+    query_pts = (centers[rng.integers(0, 20, 500)] + rng.normal(0, 0.1, (500, 3))).astype(dtype)
+    kdtree = KDTree(data_pts, leafsize=10, split_rule=split_rule)
+    assert kdtree.split_rule == split_rule
+
+    dist, idx = kdtree.query(query_pts, k=5)
+    all_dist = ((data_pts[None, :, :].astype(np.float64) - query_pts[:, None, :]) ** 2).sum(axis=2)
+    exp_dist = np.sqrt(np.sort(all_dist, axis=1)[:, :5])
+    assert np.allclose(dist, exp_dist, rtol=1e-4)
+
+    offsets, idx = kdtree.query_ball_point(query_pts, 0.05)
+    assert np.array_equal(np.diff(offsets), (all_dist <= 0.05 ** 2).sum(axis=1))
+
+    stats = kdtree.tree_stats()
+    assert stats['num_leaves'] == (stats['num_nodes'] + 1) // 2
+    assert stats['leaf_sizes'].sum() == 20000
+    assert stats['leaf_size_hist'].sum() == stats['num_leaves']
+    assert stats['max_depth'] == stats['leaf_depths'].max()
+    # Only leaves of the duplicated point may exceed leafsize
+    assert stats['leaf_sizes'][stats['leaf_sizes'] > 10].sum() <= 2000
+    if split_rule == 'median':
+        assert stats['max_depth'] <= np.ceil(np.log2(20000 / 5)) + 1
+
+    kdtree2 = pickle.loads(pickle.dumps(kdtree))
+    assert kdtree2.split_rule == split_rule
+    assert np.array_equal(kdtree2.tree_stats()['leaf_sizes'], stats['leaf_sizes'])
+
+
+def test_split_rule_parallel():
+    # Subtrees of large trees are built by tasks and must give the same tree
+    rng = np.random.default_rng(3)
+    data_pts = rng.random((200000, 3)) ** 4
+    for split_rule in ["median", "cost"]:
+        stats = KDTree(data_pts, split_rule=split_rule, workers=1).tree_stats()
+        stats2 = KDTree(data_pts, split_rule=split_rule, workers=4).tree_stats()
+        assert np.array_equal(stats['leaf_sizes'], stats2['leaf_sizes'])
+        assert np.array_equal(stats['leaf_depths'], stats2['leaf_depths'])
+    with pytest.raises(ValueError):
+        KDTree(data_pts, split_rule="middle")
+
+
+
+@pytest.mark.parametrize("reorder_data", [False, True])
+def test_query_stats(reorder_data):
+    rng = np.random.default_rng(4)
+    data_pts = rng.random((5000, 3))
+    query_pts = rng.random((300, 3))
+    mask = rng.random(5000) < 0.3
+    kdtree = KDTree(data_pts, leafsize=10, reorder_data=reorder_data)
+
+    dist, idx = kdtree.query(query_pts, k=4, mask=mask)
+    dist2, idx2, stats = kdtree.query(query_pts, k=4, mask=mask, return_stats=True, workers=2)
+    assert np.array_equal(idx, idx2)
+    assert np.array_equal(dist, dist2)
+    assert stats['nodes_visited'].shape == (300,)
+    assert np.all(stats['leaves_visited'] >= 1)
+    assert np.all(stats['nodes_visited'] > stats['leaves_visited'])
+    assert np.all(stats['dist_evals'] >= 4)
+    assert np.all(stats['dist_evals'] <= 10 * stats['leaves_visited'])
+    assert len(stats['thread_times']) >= 1
+    assert np.all(stats['thread_times'] >= 0)
+
+    # Approximate queries and distance bounds prune more of the tree
+    stats_eps = kdtree.query(query_pts, k=4, mask=mask, eps=1, return_stats=True)[2]
+    assert stats_eps['dist_evals'].sum() <= stats['dist_evals'].sum()
+    stats_bound = kdtree.query(query_pts, k=4, mask=mask, distance_upper_bound=0.01, return_stats=True)[2]
+    assert stats_bound['dist_evals'].sum() < stats['dist_evals'].sum()
+    offsets, _, _, stats_k = kdtree.query(query_pts, k=np.full(300, 4), mask=mask, return_stats=True)
+    assert np.array_equal(stats_k['dist_evals'], stats['dist_evals'])
+
+    # A single leaf holds all points
+    stats_leaf = KDTree(data_pts, leafsize=5000).query(query_pts, return_stats=True)[2]
+    assert np.all(stats_leaf['nodes_visited'] == 1)
+    assert np.all(stats_leaf['dist_evals'] == 5000)
+    assert np.all(stats_leaf['pruned'] == 0)
+
+    tree_stats = kdtree.tree_stats()
+    assert tree_stats['pidx_nbytes'] == 5000 * 4
+    assert tree_stats['nodes_nbytes'] % tree_stats['num_nodes'] == 0
+    assert tree_stats['leaf_data_nbytes'] == (data_pts.nbytes if reorder_data else 0)
+
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, p=1, return_stats=True)
+    with pytest.raises(ValueError):
+        KDTree(data_pts, boxsize=1.0).query(query_pts, return_stats=True)
+
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("int64_index", [False, True])
+def test_index_dtype(monkeypatch, dtype, int64_index):
+    if int64_index:
+        monkeypatch.setattr(pykdtree.kdtree, '_INT32_INDEX_LIMIT', 0)
+    rng = np.random.default_rng(5)
+    data_pts = rng.random((2000, 3)).astype(dtype)
+    query_pts = rng.random((100, 3)).astype(dtype)
+    kdtree = KDTree(data_pts, leafsize=10)
+    dist, idx = kdtree.query(query_pts, k=6, distance_upper_bound=0.08)
+    assert idx.dtype == (np.uint64 if int64_index else np.uint32)
+
+    for index_dtype in [np.intp, np.int32, np.uint32, np.uint64]:
+        dist2, idx2 = kdtree.query(query_pts, k=6, distance_upper_bound=0.08, index_dtype=index_dtype)
+        assert idx2.dtype == index_dtype
+        assert np.array_equal(idx2, idx)
+        assert np.array_equal(dist2, dist)
+        idx3 = kdtree.query(query_pts, k=6, distance_upper_bound=0.08, index_dtype=index_dtype,
+                            return_distance=False)
+        assert idx3.dtype == index_dtype
+        assert np.array_equal(idx3, idx)
+
+    idx4 = kdtree.query(query_pts, k=6, return_distance=False, p=3)
+    assert np.array_equal(idx4, kdtree.query(query_pts, k=6, p=3)[1])
+    k = rng.integers(0, 8, 100)
+    offsets, dist5, idx5 = kdtree.query(query_pts, k=k)
+    offsets6, idx6 = kdtree.query(query_pts, k=k, return_distance=False, index_dtype=np.intp)
+    assert np.array_equal(offsets6, offsets)
+    assert np.array_equal(idx6, idx5)
+    idx7, stats = kdtree.query(query_pts, k=6, distance_upper_bound=0.08, return_distance=False,
+                               return_stats=True)
+    assert np.array_equal(idx7, idx)
+
+    with pytest.raises(TypeError):
+        kdtree.query(query_pts, index_dtype=np.float64)
+    with pytest.raises(TypeError):
+        kdtree.query(query_pts, index_dtype=np.int16)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, return_distance=False, out_dists=np.empty(100, dtype=dtype))
+
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("reorder_data", [False, True])
+def test_set_mask(dtype, reorder_data):
+    rng = np.random.default_rng(6)
+    data_pts = rng.random((6000, 3)).astype(dtype)
+    query_pts = rng.random((200, 3)).astype(dtype)
+    # Half of the space is masked so whole subtrees can be skipped
+    mask = (data_pts[:, 0] < 0.5) | (rng.random(6000) < 0.2)
+    kdtree = KDTree(data_pts, leafsize=10, reorder_data=reorder_data)
+    assert kdtree.mask is None
+    dist, idx = kdtree.query(query_pts, k=5, mask=mask)
+    offsets, ball_idx = kdtree.query_ball_point(query_pts, 0.1, mask=mask)
+    stats = kdtree.query(query_pts, k=5, mask=mask, return_stats=True)[2]
+
+    kdtree.set_mask(mask)
+    assert np.array_equal(kdtree.mask, mask)
+    dist2, idx2, stats2 = kdtree.query(query_pts, k=5, return_stats=True)
+    assert np.array_equal(idx2, idx)
+    assert np.array_equal(dist2, dist)
+    assert stats2['dist_evals'].sum() < stats['dist_evals'].sum()
+    offsets2, ball_idx2 = kdtree.query_ball_point(query_pts, 0.1)
+    assert np.array_equal(offsets2, offsets)
+    for i in range(200):
+        assert np.array_equal(np.sort(ball_idx2[offsets2[i]:offsets2[i + 1]]),
+                              np.sort(ball_idx[offsets[i]:offsets[i + 1]]))
+    # Other norms read the bit-packed mask as well
+    assert np.array_equal(kdtree.query(query_pts, k=5, p=1)[1], kdtree.query(query_pts, k=5, p=1, mask=mask)[1])
+    assert np.array_equal(kdtree.query_ball_point(query_pts, 0.1, p=np.inf)[1],
+                          kdtree.query_ball_point(query_pts, 0.1, p=np.inf, mask=mask)[1])
+    # A mask of the query replaces the mask of the tree
+    assert np.array_equal(kdtree.query(query_pts, k=5, mask=np.zeros(6000, dtype=bool))[1],
+                          KDTree(data_pts, leafsize=10).query(query_pts, k=5)[1])
+
+    kdtree.set_mask(None)
+    assert kdtree.mask is None
+    assert not np.array_equal(kdtree.query(query_pts, k=5)[1], idx)
+
+    periodic = KDTree(data_pts, boxsize=1.0)
+    periodic.set_mask(mask)
+    assert np.array_equal(periodic.query(query_pts, k=5)[1], periodic.query(query_pts, k=5, mask=mask)[1])
+    assert np.array_equal(periodic.query_ball_point(query_pts, 0.1)[1], periodic.query_ball_point(query_pts, 0.1, mask=mask)[1])
+    values = rng.random(6000)
+    assert np.array_equal(periodic.interpolate(query_pts, values), periodic.interpolate(query_pts, values, mask=mask))
+
+    with pytest.raises(ValueError):
+        kdtree.set_mask(mask[:10])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_reorder_queries(dtype):
+    rng = np.random.default_rng(7)
+    data_pts = rng.random((5000, 3)).astype(dtype)
+    # Query points partly outside the tree, one with a NaN coordinate
+    query_pts = (rng.random((1000, 3)) * 1.2 - 0.1).astype(dtype)
+    query_pts[17, 1] = np.nan
+    kdtree = KDTree(data_pts, leafsize=10)
+
+    dist, idx = kdtree.query(query_pts, k=6)
+    dist2, idx2 = kdtree.query(query_pts, k=6, reorder_queries=True)
+    assert np.array_equal(idx2, idx)
+    assert np.array_equal(dist2, dist, equal_nan=True)
+
+    k = rng.integers(0, 8, 1000)
+    bounds = rng.random(1000) * 0.1
+    offsets, dist, idx = kdtree.query(query_pts, k=k, distance_upper_bound=bounds)
+    offsets2, dist2, idx2 = kdtree.query(query_pts, k=k, distance_upper_bound=bounds, reorder_queries=True)
+    assert np.array_equal(offsets2, offsets)
+    assert np.array_equal(idx2, idx)
+
+    stats = kdtree.query(query_pts, k=6, return_stats=True)[2]
+    stats2 = kdtree.query(query_pts[::-1], k=6, return_stats=True, reorder_queries=True)[2]
+    assert np.array_equal(stats2['dist_evals'], stats['dist_evals'][::-1])
+    # Non-contiguous query points of another type
+    float_pts = query_pts[:, ::-1] * 100
+    float_pts[17] = 0
+    int_pts = float_pts.astype(np.int64)
+    assert np.array_equal(KDTree(data_pts * 100).query(int_pts, k=3, p=1, reorder_queries=True)[1],
+                          KDTree(data_pts * 100).query(int_pts, k=3, p=1)[1])
+
+    offsets, ball_idx, ball_dist = kdtree.query_ball_point(query_pts, 0.1, return_distance=True)
+    offsets2, ball_idx2, ball_dist2 = kdtree.query_ball_point(query_pts, 0.1, return_distance=True,
+                                                              reorder_queries=True)
+    assert np.array_equal(offsets2, offsets)
+    assert np.array_equal(ball_idx2, ball_idx)
+    assert np.array_equal(ball_dist2, ball_dist)
+
+
+def test_dynamic_kdtree():
+    rng = np.random.default_rng(4)
+    all_pts = rng.random((0, 3))
+    alive = np.zeros(0, dtype=bool)
+    tree = DynamicKDTree(all_pts, leafsize=8)
+    query_pts = rng.random((100, 3))
+    for step in range(30):
+        points = rng.random((rng.integers(0, 300), 3))
+        ids = tree.insert(points)
+        assert np.array_equal(ids, np.arange(len(all_pts), len(all_pts) + len(points)))
+        all_pts = np.concatenate([all_pts, points])
+        alive = np.concatenate([alive, np.ones(len(points), dtype=bool)])
+        if step % 3 == 2:
+            removed = rng.choice(np.nonzero(alive)[0], alive.sum() // 3, replace=False)
+            tree.remove(removed)
+            alive[removed] = False
+        assert tree.n == alive.sum()
+        assert tree.num_trees <= np.log2(max(tree.n, 1)) + 2
+
+        dist, idx = tree.query(query_pts, k=7)
+        all_dist = np.sqrt(((all_pts[None, :, :] - query_pts[:, None, :]) ** 2).sum(axis=2))
+        all_dist[:, ~alive] = np.inf
+        exp_idx = np.argsort(all_dist, axis=1)[:, :7]
+        exp_dist = np.take_along_axis(all_dist, exp_idx, axis=1)
+        assert np.allclose(dist, exp_dist)
+        found = idx < tree.num_inserted
+        assert np.array_equal(found, np.isfinite(exp_dist))
+        assert np.allclose(np.take_along_axis(all_dist, np.where(found, idx, 0).astype(np.int64), axis=1)[found],
+                           exp_dist[found])
+
+    dist, idx = tree.query(query_pts, k=1, distance_upper_bound=0.05)
+    tree.rebuild()
+    assert tree.num_trees == 1
+    dist2, idx2 = tree.query(query_pts, k=1, distance_upper_bound=0.05)
+    assert np.array_equal(idx, idx2)
+    assert np.array_equal(dist, dist2)
+    assert np.all((idx < tree.num_inserted) == np.isfinite(dist))
+
+    with pytest.raises(ValueError):
+        tree.remove(np.nonzero(~alive)[0][:1])
+    with pytest.raises(ValueError):
+        tree.remove([tree.num_inserted])
+    with pytest.raises(ValueError):
+        tree.insert(rng.random((5, 2)))
+
+    tree.remove(np.nonzero(alive)[0])
+    assert tree.n == 0
+    assert tree.num_trees == 0
+    dist, idx = tree.query(query_pts, k=2)
+    assert np.all(np.isinf(dist))
+    assert np.all(idx == tree.num_inserted)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_boxsize(dtype):
+    rng = np.random.default_rng(5)
+    boxsize = np.array([1., 2., 0.5])
+    data_pts = (rng.random((3000, 3)) * boxsize).astype(dtype)
+    # Query points outside the box are wrapped into it
+    query_pts = ((rng.random((300, 3)) * 3 - 1) * boxsize).astype(dtype)
+    mask = rng.random(3000) < 0.2
+    kdtree = KDTree(data_pts, leafsize=8, boxsize=boxsize)
+    assert np.array_equal(kdtree.boxsize, boxsize)
+
+    diff = np.abs(query_pts[:, None, :].astype(np.float64) % boxsize - data_pts[None, :, :])
+    diff = np.minimum(diff, boxsize - diff)
+    all_dist = np.sqrt((diff ** 2).sum(axis=2))
+    atol = 1e-5 if dtype == np.float32 else 1e-10
+
+    dist, idx = kdtree.query(query_pts, k=5)
+    assert np.allclose(dist, np.sort(all_dist, axis=1)[:, :5], atol=atol)
+    assert np.allclose(np.take_along_axis(all_dist, idx.astype(np.int64), axis=1), dist, atol=atol)
+
+    dist, idx = kdtree.query(query_pts, k=3, mask=mask, distance_upper_bound=0.1)
+    masked_dist = np.where(mask, np.inf, all_dist)
+    exp_dist = np.sort(masked_dist, axis=1)[:, :3]
+    exp_dist[exp_dist >= 0.1] = np.inf
+    found = np.isfinite(exp_dist)
+    assert np.array_equal(np.isfinite(dist), found)
+    assert np.allclose(dist[found], exp_dist[found], atol=atol)
+
+    offsets, idx = kdtree.query_ball_point(query_pts, 0.15)
+    for i in range(len(query_pts)):
+        exp_idx = np.nonzero(all_dist[i] <= 0.15)[0]
+        assert np.array_equal(np.sort(idx[offsets[i]:offsets[i + 1]]), exp_idx)
+
+    pair_dist = np.abs(data_pts[:, None, :].astype(np.float64) - data_pts[None, :, :])
+    pair_dist = np.sqrt((np.minimum(pair_dist, boxsize - pair_dist) ** 2).sum(axis=2))
+    i, j = kdtree.query_pairs(0.05)
+    exp_i, exp_j = np.nonzero(np.triu(pair_dist <= 0.05, k=1))
+    order = np.lexsort((j, i))
+    assert np.array_equal(i[order], exp_i)
+    assert np.array_equal(j[order], exp_j)
+    assert kdtree.count_neighbors(kdtree, 0.2) == (pair_dist <= 0.2).sum()
+
+    kdtree2 = pickle.loads(pickle.dumps(kdtree))
+    assert np.array_equal(kdtree2.boxsize, boxsize)
+    dist, idx = kdtree.query(query_pts, k=5)
+    dist2, idx2 = kdtree2.query(query_pts, k=5)
+    assert np.array_equal(idx, idx2)
+
+    with pytest.raises(ValueError):
+        kdtree.count_neighbors(KDTree(data_pts), 0.1)
+    with pytest.raises(ValueError):
+        KDTree(data_pts, boxsize=0.5)
+    with pytest.raises(ValueError):
+        KDTree(data_pts, boxsize=[1., 2.])
+    with pytest.raises(ValueError):
+        KDTree(data_pts, boxsize=-1.)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('p', [1, 2, 3.5, np.inf])
+@pytest.mark.parametrize('weights', [None, np.array([1., 0.5, 3.])])
+def test_norm(dtype, p, weights):
+    rng = np.random.default_rng(6)
+    data_pts = rng.random((3000, 3)).astype(dtype)
+    query_pts = rng.random((300, 3)).astype(dtype)
+    mask = rng.random(3000) < 0.2
+    kdtree = KDTree(data_pts, leafsize=8)
+
+    diff = np.abs(query_pts[:, None, :].astype(np.float64) - data_pts[None, :, :])
+    if weights is not None:
+        diff *= weights
+    if p == np.inf:
+        all_dist = diff.max(axis=2)
+    else:
+        all_dist = (diff ** p).sum(axis=2) ** (1 / p)
+    rtol = 1e-4 if dtype == np.float32 else 1e-10
+
+    dist, idx = kdtree.query(query_pts, k=5, p=p, weights=weights)
+    assert np.allclose(dist, np.sort(all_dist, axis=1)[:, :5], rtol=rtol)
+    assert np.allclose(np.take_along_axis(all_dist, idx.astype(np.int64), axis=1), dist, rtol=rtol)
+
+    dist, idx = kdtree.query(query_pts, k=3, mask=mask, distance_upper_bound=0.1, p=p, weights=weights)
+    exp_dist = np.sort(np.where(mask, np.inf, all_dist), axis=1)[:, :3]
+    exp_dist[exp_dist >= 0.1] = np.inf
+    found = np.isfinite(exp_dist)
+    assert np.array_equal(np.isfinite(dist), found)
+    assert np.allclose(dist[found], exp_dist[found], rtol=rtol)
+
+    sqr_dist, _ = kdtree.query(query_pts, k=3, sqr_dists=True, p=p, weights=weights)
+    dist, _ = kdtree.query(query_pts, k=3, p=p, weights=weights)
+    exp_sqr_dist = dist if p in (1, np.inf) else dist ** p
+    assert np.allclose(sqr_dist, exp_sqr_dist, rtol=rtol)
+
+    # The k-th neighbour of an approximate search is within (1 + eps) of the exact one
+    dist, _ = kdtree.query(query_pts, k=5, eps=0.5, p=p, weights=weights)
+    assert np.all(dist[:, -1] <= np.sort(all_dist, axis=1)[:, 4] * 1.5 * (1 + rtol))
+
+    offsets, idx, dist = kdtree.query_ball_point(query_pts, 0.15, p=p, weights=weights, return_distance=True)
+    for i in range(len(query_pts)):
+        exp_idx = np.nonzero(all_dist[i] <= 0.15)[0]
+        order = np.argsort(idx[offsets[i]:offsets[i + 1]])
+        assert np.array_equal(idx[offsets[i]:offsets[i + 1]][order], exp_idx)
+        assert np.allclose(dist[offsets[i]:offsets[i + 1]][order], all_dist[i, exp_idx], rtol=rtol)
+
+
+def test_norm_errors():
+    data_pts = np.random.default_rng(7).random((100, 3))
+    kdtree = KDTree(data_pts)
+    with pytest.raises(ValueError):
+        kdtree.query(data_pts, p=0.5)
+    with pytest.raises(ValueError):
+        kdtree.query(data_pts, weights=[1., 2.])
+    with pytest.raises(ValueError):
+        kdtree.query_ball_point(data_pts, 0.1, weights=-1.)
+    with pytest.raises(ValueError):
+        KDTree(data_pts, boxsize=1.).query(data_pts, p=1)
+
+
+def test_query_ball_point_empty():
+    kdtree = KDTree(data_pts_real)
+    query_pts = np.array([[0., 0., 0.], [787014.438, -340616.906, 6313018.]])
+    offsets, idx = kdtree.query_ball_point(query_pts, 1.)
+    assert np.array_equal(offsets, [0, 0, 1])
+    assert np.array_equal(idx, [7])
+    with pytest.raises(ValueError):
+        kdtree.query_ball_point(query_pts, -1.)
+
+def test_query_pairs():
+    rng = np.random.default_rng(1)
+    data_pts = rng.random((3000, 3))
+    kdtree = KDTree(data_pts, leafsize=8)
+    i, j, dist = kdtree.query_pairs(0.05, return_distance=True)
+    all_dist = np.sqrt(((data_pts[:, None, :] - data_pts[None, :, :]) ** 2).sum(axis=2))
+    exp_i, exp_j = np.nonzero(np.triu(all_dist <= 0.05, k=1))
+    assert np.all(i < j)
+    order = np.lexsort((j, i))
+    assert np.array_equal(i[order], exp_i)
+    assert np.array_equal(j[order], exp_j)
+    assert np.allclose(dist, all_dist[i, j])
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_sparse_distance_matrix(dtype):
+    rng = np.random.default_rng(2)
+    data_pts = rng.random((2000, 2)).astype(dtype)
+    other_pts = rng.random((1500, 2)).astype(dtype)
+    kdtree = KDTree(data_pts, leafsize=4)
+    other = KDTree(other_pts, leafsize=16)
+    i, j, dist = kdtree.sparse_distance_matrix(other, 0.03)
+    assert dist.dtype == dtype
+    all_dist = np.sqrt(((data_pts[:, None, :].astype(np.float64) - other_pts[None, :, :]) ** 2).sum(axis=2))
+    exp_i, exp_j = np.nonzero(all_dist <= 0.03)
+    order = np.lexsort((j, i))
+    assert np.array_equal(i[order], exp_i)
+    assert np.array_equal(j[order], exp_j)
+    assert np.allclose(dist, all_dist[i, j], atol=1e-6)
+
+    assert kdtree.count_neighbors(other, 0.03) == exp_i.size
+    assert kdtree.count_neighbors(other, 2.) == 2000 * 1500
+    assert kdtree.count_neighbors(kdtree, 0.) == 2000
+    other_dtype = np.float64 if dtype == np.float32 else np.float32
+    with pytest.raises(TypeError):
+        kdtree.count_neighbors(KDTree(other_pts.astype(other_dtype)), 0.1)
+    with pytest.raises(ValueError):
+        kdtree.count_neighbors(KDTree(rng.random((10, 3)).astype(dtype)), 0.1)
+
+def test_int64_index(monkeypatch):
+    # Trees too small for 64-bit indices are built with them by lowering the limit
+    monkeypatch.setattr(pykdtree.kdtree, '_INT32_INDEX_LIMIT', 0)
+    rng = np.random.default_rng(9)
+    data_pts = rng.random((3000, 3))
+    query_pts = rng.random((200, 3))
+    mask = rng.random(3000) < 0.2
+    kdtree = KDTree(data_pts, leafsize=8)
+    all_dist = np.sqrt(((query_pts[:, None, :] - data_pts[None, :, :]) ** 2).sum(axis=2))
+    all_dist[:, mask] = np.inf
+
+    dist, idx = kdtree.query(query_pts, k=5, mask=mask)
+    assert idx.dtype == np.uint64
+    assert np.allclose(dist, np.sort(all_dist, axis=1)[:, :5])
+    offsets, idx = kdtree.query_ball_point(query_pts, 0.1, mask=mask)
+    assert idx.dtype == np.uint64
+    for i in range(len(query_pts)):
+        assert np.array_equal(np.sort(idx[offsets[i]:offsets[i + 1]]), np.nonzero(all_dist[i] <= 0.1)[0])
+
+    pair_dist = np.sqrt(((data_pts[:, None, :] - data_pts[None, :, :]) ** 2).sum(axis=2))
+    i, j = kdtree.query_pairs(0.02)
+    assert i.dtype == np.uint64
+    assert len(i) == np.triu(pair_dist <= 0.02, k=1).sum()
+    assert np.all(pair_dist[i, j] <= 0.02)
+
+    kdtree2 = pickle.loads(pickle.dumps(kdtree))
+    assert np.array_equal(kdtree2.query(query_pts, k=5, mask=mask)[1], kdtree.query(query_pts, k=5, mask=mask)[1])
+
+
 @pytest.mark.skip(reason="Requires ~50G RAM")
 def test_tree_n_lt_maxint32_n_query_k_gt_maxint32():
     # n_points < UINT32_MAX but n_query * k > UINT32_MAX -> still uses 32-bit index
@@ -428,3 +1232,205 @@ def test_tree_n_points_n_dim_gt_maxint32():
     assert np.all(idx < data_pts.shape[0])
     assert dist.shape == (3, 4)
     assert dist.dtype == np.float32
+
+
+def _haversine(lonlat1, lonlat2, radius):
+    lon1, lat1 = np.radians(lonlat1[..., 0]), np.radians(lonlat1[..., 1])
+    lon2, lat2 = np.radians(lonlat2[..., 0]), np.radians(lonlat2[..., 1])
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * radius * np.arcsin(np.sqrt(h))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_spherical(tmp_path, dtype):
+    rng = np.random.default_rng(8)
+    radius = 6371e3
+    data_pts = np.column_stack([rng.uniform(-180, 180, 3000),
+                                np.degrees(np.arcsin(rng.uniform(-1, 1, 3000)))]).astype(dtype)
+    query_pts = np.column_stack([rng.uniform(-180, 180, 200),
+                                 np.degrees(np.arcsin(rng.uniform(-1, 1, 200)))]).astype(dtype)
+    # Neighbours across the antimeridian
+    data_pts[0] = [179.99, 10]
+    query_pts[0] = [-179.99, 10]
+    kdtree = KDTree(data_pts, leafsize=10, spherical=True, sphere_radius=radius)
+    assert kdtree.spherical and kdtree.sphere_radius == radius
+    assert kdtree.ndim == 3
+    assert np.allclose(np.linalg.norm(kdtree.data_pts.reshape(-1, 3), axis=1), 1, atol=1e-6)
+
+    all_dist = _haversine(query_pts[:, None, :].astype(np.float64), data_pts[None, :, :].astype(np.float64), radius)
+    exp_idx = np.argsort(all_dist, axis=1)[:, :4]
+    exp_dist = np.take_along_axis(all_dist, exp_idx, axis=1)
+    dist, idx = kdtree.query(query_pts, k=4)
+    assert idx[0, 0] == 0
+    assert np.allclose(dist, exp_dist, rtol=1e-4, atol=1)
+    assert np.array_equal(idx[:, 0], exp_idx[:, 0])
+
+    bound = 300e3
+    dist, idx = kdtree.query(query_pts, k=4, distance_upper_bound=bound)
+    assert np.array_equal(np.isinf(dist), exp_dist >= bound)
+    assert np.all(idx[np.isinf(dist)] == 3000)
+    # Bounds in radians on the unit sphere
+    unit_tree = KDTree(data_pts, leafsize=10, spherical=True)
+    dist2, idx2 = unit_tree.query(query_pts, k=4, distance_upper_bound=bound / radius)
+    assert np.array_equal(idx2, idx)
+    assert np.allclose(dist2 * radius, dist, rtol=1e-5)
+    # Query points of another type are converted while searching
+    dist3, idx3 = kdtree.query(np.asfortranarray(query_pts.astype(np.float64)), k=4)
+    assert np.allclose(dist3, exp_dist, rtol=1e-4, atol=1)
+
+    offsets, ball_idx, ball_dist = kdtree.query_ball_point(query_pts, bound, return_distance=True)
+    for i in range(200):
+        assert np.array_equal(np.sort(ball_idx[offsets[i]:offsets[i + 1]]), np.nonzero(all_dist[i] <= bound)[0])
+    assert np.allclose(ball_dist, all_dist[np.repeat(np.arange(200), np.diff(offsets)), ball_idx], rtol=1e-4, atol=1)
+
+    i, j, pair_dist = kdtree.sparse_distance_matrix(KDTree(query_pts, spherical=True, sphere_radius=radius), bound)
+    assert len(i) == len(ball_idx)
+    assert np.allclose(pair_dist, all_dist[j, i], rtol=1e-4, atol=1)
+
+    kdtree.save(tmp_path / 'tree.kdtree')
+    for loaded in [KDTree.load(tmp_path / 'tree.kdtree'), pickle.loads(pickle.dumps(kdtree))]:
+        assert loaded.sphere_radius == radius
+        assert np.array_equal(loaded.query(query_pts, k=4)[1], kdtree.query(query_pts, k=4)[1])
+
+    with pytest.raises(ValueError):
+        KDTree(data_pts, spherical=True, sphere_radius=0)
+    with pytest.raises(ValueError):
+        KDTree(np.zeros((10, 3)), spherical=True)
+    with pytest.raises(ValueError):
+        kdtree.query(np.zeros((10, 3)))
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, p=1)
+    with pytest.raises(ValueError):
+        kdtree.sparse_distance_matrix(unit_tree, 0.1)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+@pytest.mark.parametrize("reorder_data", [False, True])
+def test_knn_graph(dtype, reorder_data):
+    rng = np.random.default_rng(9)
+    data_pts = rng.random((3000, 3)).astype(dtype)
+    data_pts[10] = data_pts[11]
+    kdtree = KDTree(data_pts, leafsize=10, reorder_data=reorder_data)
+    exp_dist, exp_idx = kdtree.query(data_pts, k=6)
+    # Self is the first neighbour except for the duplicated point
+    exp_dist, exp_idx = exp_dist[:, 1:], exp_idx[:, 1:]
+    exp_idx[10, 0], exp_idx[11, 0] = 11, 10
+
+    offsets, idx, dist = kdtree.knn_graph(5)
+    assert offsets.dtype == idx.dtype == np.int32 and dist.dtype == dtype
+    assert np.array_equal(offsets, np.arange(0, 3000 * 5 + 1, 5))
+    assert np.array_equal(idx.reshape(-1, 5)[:, 0], exp_idx[:, 0])
+    assert np.allclose(dist.reshape(-1, 5), exp_dist, rtol=1e-5)
+    assert np.all(idx.reshape(-1, 5) != np.arange(3000)[:, None])
+
+    _, _, sqr_dist = kdtree.knn_graph(5, sqr_dists=True)
+    assert np.allclose(sqr_dist, dist ** 2, rtol=1e-5)
+    _, self_idx, self_dist = kdtree.knn_graph(5, include_self=True, workers=1)
+    assert np.allclose(self_dist.reshape(-1, 5), kdtree.query(data_pts, k=5)[0], rtol=1e-5)
+    assert np.all(self_dist.reshape(-1, 5)[:, 0] == 0)
+
+    with pytest.raises(ValueError):
+        kdtree.knn_graph(0)
+    with pytest.raises(ValueError):
+        kdtree.knn_graph(3000)
+    with pytest.raises(ValueError):
+        KDTree(data_pts, boxsize=1).knn_graph(5)
+
+
+def test_knn_graph_scipy():
+    sparse = pytest.importorskip('scipy.sparse')
+    data_pts = np.random.default_rng(13).random((2000, 3))
+    offsets, idx, dist = KDTree(data_pts).knn_graph(4)
+    graph = sparse.csr_matrix((dist, idx, offsets), shape=(2000, 2000))
+    assert np.shares_memory(graph.indices, idx)
+    assert np.shares_memory(graph.indptr, offsets)
+    assert np.shares_memory(graph.data, dist)
+
+
+def test_knn_graph_spherical():
+    rng = np.random.default_rng(10)
+    data_pts = np.column_stack([rng.uniform(-180, 180, 1000), rng.uniform(-80, 80, 1000)])
+    kdtree = KDTree(data_pts, spherical=True, sphere_radius=6371e3)
+    offsets, idx, dist = kdtree.knn_graph(3)
+    exp_dist, exp_idx = kdtree.query(data_pts, k=4)
+    assert np.allclose(dist.reshape(-1, 3), exp_dist[:, 1:], rtol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_max_leaves(dtype):
+    rng = np.random.default_rng(11)
+    data_pts = rng.random((5000, 12)).astype(dtype)
+    query_pts = rng.random((300, 12)).astype(dtype)
+    kdtree = KDTree(data_pts, leafsize=10)
+    exact_dist, exact_idx = kdtree.query(query_pts, k=5)
+
+    # Without a binding limit the best-bin-first search is exact
+    dist, idx = kdtree.query(query_pts, k=5, max_leaves=10 ** 6)
+    assert np.array_equal(idx, exact_idx)
+    assert np.allclose(dist, exact_dist)
+    mask = rng.random(5000) < 0.3
+    assert np.array_equal(kdtree.query(query_pts, k=5, mask=mask, max_checks=10 ** 6)[1],
+                          kdtree.query(query_pts, k=5, mask=mask)[1])
+
+    recalls = []
+    for max_leaves in [1, 4, 16, 64]:
+        dist, idx, stats = kdtree.query(query_pts, k=5, max_leaves=max_leaves, return_stats=True)
+        assert np.all(stats['leaves_visited'] <= max_leaves)
+        found = idx < 5000
+        # Neighbours found are sorted and never closer than the exact ones
+        assert np.all(dist[found] >= exact_dist[found] * (1 - 1e-5))
+        assert np.array_equal(np.sort(dist, axis=1), dist)
+        assert np.all(np.isinf(dist[~found]))
+        recalls.append(np.mean(np.any(idx[:, :, None] == exact_idx[:, None, :], axis=1)))
+    assert recalls == sorted(recalls) and recalls[-1] > 0.5
+
+    _, _, stats = kdtree.query(query_pts, k=5, max_checks=50, return_stats=True)
+    assert np.all(stats['dist_evals'] < 50 + 10)
+
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, max_leaves=0)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, max_checks=0)
+    with pytest.raises(ValueError):
+        kdtree.query(query_pts, max_leaves=10, p=1)
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_interpolate(dtype):
+    rng = np.random.default_rng(12)
+    data_pts = rng.random((4000, 2)).astype(dtype)
+    query_pts = rng.random((500, 2)).astype(dtype)
+    query_pts[0] = data_pts[5]
+    values = rng.random((4000, 3))
+    kdtree = KDTree(data_pts, leafsize=10)
+    dist, idx = kdtree.query(query_pts, k=6)
+    dist = dist.astype(np.float64)
+
+    result = kdtree.interpolate(query_pts, values, k=6, power=3)
+    assert result.shape == (500, 3) and result.dtype == dtype
+    weights = 1 / np.maximum(dist, 1e-30) ** 3
+    weights[0] = dist[0] == 0
+    expected = np.einsum('mk,mkc->mc', weights, values[idx]) / weights.sum(axis=1)[:, None]
+    assert np.allclose(result, expected, rtol=1e-5)
+    assert np.allclose(result[0], values[5], rtol=1e-5)
+
+    result = kdtree.interpolate(query_pts, values[:, 0], k=6, weighting='gaussian', sigma=0.05, workers=1)
+    weights = np.exp(-dist ** 2 / (2 * 0.05 ** 2))
+    assert result.shape == (500,)
+    assert np.allclose(result, (weights * values[idx, 0]).sum(axis=1) / weights.sum(axis=1), rtol=1e-5)
+
+    # Query points without neighbours within radius get the fill value
+    result = kdtree.interpolate(query_pts, values[:, 0], k=6, radius=0.01, fill_value=-1)
+    no_neighbours = np.isinf(kdtree.query(query_pts, k=1, distance_upper_bound=0.01)[0])
+    assert np.array_equal(result == -1, no_neighbours)
+    mask = np.ones(4000, dtype=bool)
+    assert np.all(np.isnan(kdtree.interpolate(query_pts, values, mask=mask)))
+
+    with pytest.raises(ValueError):
+        kdtree.interpolate(query_pts, values[:10])
+    with pytest.raises(ValueError):
+        kdtree.interpolate(query_pts, values, weighting='gaussian')
+    with pytest.raises(ValueError):
+        kdtree.interpolate(query_pts, values, weighting='linear')
+    with pytest.raises(ValueError):
+        kdtree.interpolate(query_pts, values, k=0)